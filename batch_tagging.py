@@ -0,0 +1,345 @@
+import os
+import sys
+import json
+import time
+import argparse
+from bson import ObjectId, json_util
+from pymongo import MongoClient, UpdateOne
+from dotenv import load_dotenv
+from tagging_utils import (
+    build_tag_messages, chat_request, embedding_request, embedding_text,
+    validate_tag_item, flatten_tags, version_fields
+)
+from token_usage import record_usage
+from product_search import build_search_fields
+from near_duplicate import dedup_text, signature_fields
+from match_cache import bump_index_version
+from brand_profile import brand_query_for_product, rebuild_brand_centroid
+
+load_dotenv(override=True)
+
+# Configuration
+MONGODB_URI = os.getenv("MONGODB_URI")
+DB_NAME = os.getenv("DB_NAME")
+COLLECTIONS = ["influencers", "brands", "products"]
+
+# Phases: tags first (chat), then embeddings (the embedding text includes the tags)
+PHASE_TAGS = "tags"
+PHASE_EMBED = "embed"
+ENDPOINTS = {
+    PHASE_TAGS: "/v1/chat/completions",
+    PHASE_EMBED: "/v1/embeddings"
+}
+
+# Exported documents are marked `batch_pending: <request file name>` (plus
+# batch_pending_at) so watch_db.py and retag_stale.py leave them alone while the
+# job runs. A tags import switches the marker to BATCH_AWAITING_EMBED until the
+# embed phase is imported. Markers older than BATCH_PENDING_TTL_HOURS (the
+# Batch API window is 24h) are released and the documents go back to live tagging.
+BATCH_AWAITING_EMBED = "awaiting_embed"
+BATCH_PENDING_TTL = float(os.getenv("BATCH_PENDING_TTL_HOURS", 26)) * 3600
+MARK_BATCH_SIZE = 1000
+
+
+def make_custom_id(phase, collection_name, doc_id):
+    return f"{phase}|{collection_name}|{doc_id}"
+
+
+def parse_custom_id(custom_id):
+    phase, collection_name, raw_id = custom_id.split("|", 2)
+    if phase not in ENDPOINTS or collection_name not in COLLECTIONS:
+        raise ValueError(f"Unknown custom_id: {custom_id}")
+    doc_id = ObjectId(raw_id) if ObjectId.is_valid(raw_id) else raw_id
+    return phase, collection_name, doc_id
+
+
+def export_requests(db, collection_name, phase, out_path, limit=0):
+    """
+    Writes one Batch API request line per pending document, built with the
+    same prompts/bodies as the live tagging_utils calls, and marks the exported
+    documents as in flight (batch_pending). Returns the line count.
+    """
+    collection = db[collection_name]
+    if phase == PHASE_TAGS:
+        query = {"structured_tags": {"$exists": False}, "batch_pending": {"$exists": False}}
+    else:
+        query = {
+            "structured_tags": {"$exists": True},
+            "embedding": {"$exists": False},
+            "$or": [{"batch_pending": {"$exists": False}}, {"batch_pending": BATCH_AWAITING_EMBED}]
+        }
+
+    exported = []
+    with open(out_path, "w", encoding="utf-8") as f:
+        for doc in collection.find(query).limit(limit):
+            if phase == PHASE_TAGS:
+                body = chat_request(build_tag_messages(collection_name, doc))
+            else:
+                text = embedding_text(collection_name, doc)
+                if not text:
+                    continue
+                body = embedding_request(text)
+
+            line = {
+                "custom_id": make_custom_id(phase, collection_name, doc["_id"]),
+                "method": "POST",
+                "url": ENDPOINTS[phase],
+                "body": body
+            }
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+            exported.append(doc["_id"])
+
+    marker = {"batch_pending": os.path.basename(out_path), "batch_pending_at": time.time()}
+    for i in range(0, len(exported), MARK_BATCH_SIZE):
+        collection.update_many({"_id": {"$in": exported[i:i + MARK_BATCH_SIZE]}}, {"$set": marker})
+    return len(exported)
+
+
+def release_expired_batches(db, ttl=BATCH_PENDING_TTL):
+    """
+    Clears batch_pending markers older than `ttl` seconds (expired, cancelled or
+    never imported jobs). Returns the number of released documents.
+    """
+    cutoff = time.time() - ttl
+    released = 0
+    for collection_name in COLLECTIONS:
+        result = db[collection_name].update_many(
+            {"batch_pending_at": {"$lt": cutoff}},
+            {"$unset": {"batch_pending": "", "batch_pending_at": ""}}
+        )
+        released += result.modified_count
+    return released
+
+
+def parse_result_line(line):
+    """
+    Parses one Batch API output line.
+    Returns (phase, collection_name, doc_id, payload, body) where payload is the
+    tag dict or embedding vector; raises ValueError for failed/malformed lines.
+    """
+    record = json.loads(line)
+    phase, collection_name, doc_id = parse_custom_id(record["custom_id"])
+
+    if record.get("error"):
+        raise ValueError(f"Request failed: {record['error']}")
+    response = record.get("response") or {}
+    if response.get("status_code") != 200:
+        raise ValueError(f"HTTP {response.get('status_code')}")
+    body = response.get("body") or {}
+
+    if phase == PHASE_TAGS:
+        tag_data = json.loads(body["choices"][0]["message"]["content"])
+        if not validate_tag_item(collection_name, tag_data):
+            raise ValueError("Malformed tag object")
+        return phase, collection_name, doc_id, tag_data, body
+
+    embedding = body["data"][0]["embedding"]
+    if not embedding:
+        raise ValueError("Empty embedding")
+    return phase, collection_name, doc_id, embedding, body
+
+
+def _line_target(line):
+    """
+    (collection_name, doc_id) a result line refers to, even for failed requests; None if unreadable.
+    """
+    try:
+        _, collection_name, doc_id = parse_custom_id(json.loads(line)["custom_id"])
+    except (ValueError, KeyError, TypeError):
+        return None
+    return collection_name, doc_id
+
+
+def _release_targets(db, targets):
+    """
+    Clears the in-flight marker of every document a results chunk referred to.
+    Documents that just got their tags keep BATCH_AWAITING_EMBED for the embed phase.
+    """
+    ids_by_collection = {}
+    for collection_name, doc_id in targets:
+        ids_by_collection.setdefault(collection_name, []).append(doc_id)
+    for collection_name, ids in ids_by_collection.items():
+        db[collection_name].update_many(
+            {"_id": {"$in": ids}, "batch_pending": {"$exists": True, "$ne": BATCH_AWAITING_EMBED}},
+            {"$unset": {"batch_pending": "", "batch_pending_at": ""}}
+        )
+
+
+def _apply_chunk(db, entries, stats, touched_brands):
+    """
+    Bulk-writes one chunk of parsed results. Filters only match documents that
+    still lack the field, so re-importing the same file changes nothing (and
+    token usage is only recorded for results that are actually written).
+    """
+    ops_by_collection = {}
+    ids_by_collection = {}
+    for phase, collection_name, doc_id, payload, body in entries:
+        ids_by_collection.setdefault(collection_name, []).append(doc_id)
+
+    docs = {}
+    for collection_name, ids in ids_by_collection.items():
+        for doc in db[collection_name].find({"_id": {"$in": ids}}):
+            docs[(collection_name, doc["_id"])] = doc
+
+    now = time.time()
+    for phase, collection_name, doc_id, payload, body in entries:
+        doc = docs.get((collection_name, doc_id))
+        field = "structured_tags" if phase == PHASE_TAGS else "embedding"
+        if doc is None or field in doc:
+            # Deleted, or already imported (re-run / resumed chunk)
+            stats["skipped"] += 1
+            continue
+
+        record_usage(f"batch_{phase}", collection_name, body.get("model"), body.get("usage"))
+
+        if phase == PHASE_TAGS:
+            update = {
+                "structured_tags": payload,
+                "tags": flatten_tags(collection_name, payload),
+                "last_updated": now
+            }
+            update.update(version_fields(collection_name, doc, embedded=False))
+            update.update(signature_fields(dedup_text(collection_name, doc)))
+            if collection_name == "products":
+                update.update(build_search_fields(doc))
+            # Embedded by the embed phase, not by watch_db.py in real time
+            update.update({"batch_pending": BATCH_AWAITING_EMBED, "batch_pending_at": now})
+            op = UpdateOne({"_id": doc_id, "structured_tags": {"$exists": False}}, {"$set": update})
+        else:
+            update = {
+                "embedding": payload,
+                "embedding_dim": len(payload),
+                "last_updated": now
+            }
+            update.update(version_fields(collection_name, doc, tagged=False))
+            op = UpdateOne(
+                {"_id": doc_id, "embedding": {"$exists": False}},
+                {"$set": update, "$unset": {"batch_pending": "", "batch_pending_at": ""}}
+            )
+
+        if collection_name == "products":
+            brand_query = brand_query_for_product(doc)
+            if brand_query:
+                touched_brands[json.dumps(brand_query, default=str)] = brand_query
+
+        ops_by_collection.setdefault(collection_name, []).append(op)
+
+    for collection_name, ops in ops_by_collection.items():
+        result = db[collection_name].bulk_write(ops, ordered=False)
+        stats["imported"] += result.modified_count
+        stats["skipped"] += len(ops) - result.modified_count
+        if collection_name == "influencers" and result.modified_count > 0:
+            bump_index_version(db)
+
+
+def _load_progress(progress_path):
+    """
+    Returns (next line, touched brand queries) from a checkpoint file.
+    """
+    if not os.path.exists(progress_path):
+        return 0, {}
+    with open(progress_path) as f:
+        progress = json_util.loads(f.read() or "{}")
+    return progress.get("line", 0), progress.get("brands", {})
+
+
+def _save_progress(progress_path, next_line, touched_brands):
+    with open(progress_path, "w") as f:
+        f.write(json_util.dumps({"line": next_line, "brands": touched_brands}))
+
+
+def import_results(db, path, chunk_size=500, dry_run=False):
+    """
+    Imports a Batch API results file. Progress (next line + brands whose
+    centroids need a rebuild) is checkpointed to '<path>.progress' after every
+    chunk, so an interrupted import resumes where it stopped; already written
+    documents are never overwritten. Every document the file refers to (failed
+    lines included) is released from batch_pending.
+    """
+    progress_path = path + ".progress"
+    start_line, touched_brands = 0, {}
+    if not dry_run:
+        start_line, touched_brands = _load_progress(progress_path)
+        if start_line:
+            print(f"Resuming from line {start_line}")
+
+    stats = {"valid": 0, "imported": 0, "skipped": 0, "failed": 0}
+    entries = []
+    targets = []
+    line_no = start_line
+
+    def flush(next_line):
+        if entries and not dry_run:
+            _apply_chunk(db, entries, stats, touched_brands)
+        if targets and not dry_run:
+            _release_targets(db, targets)
+        if not dry_run:
+            _save_progress(progress_path, next_line, touched_brands)
+        entries.clear()
+        targets.clear()
+
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            if line_no < start_line or not line.strip():
+                continue
+            target = _line_target(line)
+            if target:
+                targets.append(target)
+            try:
+                entries.append(parse_result_line(line))
+                stats["valid"] += 1
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                stats["failed"] += 1
+                print(f"  ❌ Line {line_no + 1}: {e}")
+                continue
+
+            if len(targets) >= chunk_size:
+                flush(line_no + 1)
+                print(f"  ... line {line_no + 1}: {stats}")
+
+    flush(line_no + 1)
+
+    if not dry_run:
+        # Product tags/embeddings changed -> refresh cached brand centroids once per brand
+        for brand_query in touched_brands.values():
+            brand = db["brands"].find_one(brand_query, {"name": 1, "product_centroid": 1})
+            if brand:
+                rebuild_brand_centroid(db, brand)
+
+    return stats
+
+
+def main():
+    sys.stdout.reconfigure(encoding='utf-8')
+    parser = argparse.ArgumentParser(description="Offline bulk tagging via Batch API JSONL files.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    exp = sub.add_parser("export", help="Write request JSONL for pending documents")
+    exp.add_argument("collection", choices=COLLECTIONS)
+    exp.add_argument("out_path")
+    exp.add_argument("--phase", choices=list(ENDPOINTS), default=PHASE_TAGS,
+                     help="tags: chat tagging requests; embed: embeddings for tagged documents")
+    exp.add_argument("--limit", type=int, default=0)
+
+    imp = sub.add_parser("import", help="Import a results JSONL (idempotent, resumable)")
+    imp.add_argument("results_path")
+    imp.add_argument("--chunk", type=int, default=500)
+    imp.add_argument("--dry-run", action="store_true", help="Validate lines without writing")
+
+    args = parser.parse_args()
+
+    if not all([MONGODB_URI, DB_NAME]):
+        print("Error: Missing environment variables.")
+        exit(1)
+    db = MongoClient(MONGODB_URI)[DB_NAME]
+
+    if args.command == "export":
+        count = export_requests(db, args.collection, args.phase, args.out_path, args.limit)
+        print(f"✅ Exported {count} {args.phase} requests for '{args.collection}' -> {args.out_path}")
+    else:
+        stats = import_results(db, args.results_path, args.chunk, args.dry_run)
+        print(f"✅ Import complete: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import time
+import numpy as np
+from pymongo import ASCENDING
+
+# How many of the most frequent product tags are blended into a brand query.
+# A large catalog would otherwise dilute keyword_score (overlap / len(tags)).
+MAX_PRODUCT_TAGS = 20
+
+
+def brand_query_for_product(product_doc):
+    """
+    MongoDB query for the brand a product belongs to ('brand_id' ref, or 'brand' name).
+    """
+    if product_doc.get("brand_id"):
+        return {"_id": product_doc["brand_id"]}
+    if product_doc.get("brand"):
+        return {"name": product_doc["brand"]}
+    return None
+
+
+def products_query_for_brand(brand_doc):
+    """
+    MongoDB query for all products of a brand.
+    """
+    clauses = [{"brand_id": brand_doc["_id"]}]
+    if brand_doc.get("name"):
+        clauses.append({"brand": brand_doc["name"]})
+    return {"$or": clauses}
+
+
+def brand_centroid_revision(db, product_doc):
+    """
+    Current centroid revision of the product's brand (-1 if it has none yet).
+    Read it BEFORE writing the product and pass it to update_brand_centroid.
+    """
+    brand_query = brand_query_for_product(product_doc)
+    brand = db["brands"].find_one(brand_query, {"product_centroid.revision": 1}) if brand_query else None
+    return ((brand or {}).get("product_centroid") or {}).get("revision", -1)
+
+
+def rebuild_brand_centroid(db, brand_doc, max_attempts=3):
+    """
+    Recomputes the cached product centroid of a brand from scratch and stores it.
+    Used once per brand (or after a conflicting concurrent update). The write only
+    applies if no incremental update landed meanwhile; otherwise it recomputes.
+    """
+    db["products"].create_index([("brand_id", ASCENDING)])
+    db["products"].create_index([("brand", ASCENDING)])
+
+    for _ in range(max_attempts):
+        current = db["brands"].find_one({"_id": brand_doc["_id"]}, {"product_centroid.revision": 1}) or {}
+        revision = (current.get("product_centroid") or {}).get("revision")
+
+        total = None
+        count = 0
+        tag_counts = {}
+
+        cursor = db["products"].find(products_query_for_brand(brand_doc), {"embedding": 1, "tags": 1})
+        for prod in cursor:
+            for tag in set(prod.get("tags", [])):
+                tag_counts[tag] = tag_counts.get(tag, 0) + 1
+
+            emb = prod.get("embedding")
+            if not emb:
+                continue
+            if total is None:
+                total = np.zeros(len(emb))
+            if len(emb) != len(total):
+                continue
+            total += np.asarray(emb)
+            count += 1
+
+        centroid = _centroid_doc(total, count, tag_counts, revision=(-1 if revision is None else revision) + 1)
+        # A missing revision also matches brands without a centroid
+        result = db["brands"].update_one(
+            {"_id": brand_doc["_id"], "product_centroid.revision": revision},
+            {"$set": {"product_centroid": centroid}}
+        )
+        if result.matched_count:
+            return centroid
+    return centroid
+
+
+def verify_brand_centroid(db, brand_doc):
+    """
+    Returns the brand's cached centroid, rebuilding it when missing or when the
+    number of products embedded at its dimension no longer matches (deleted
+    products, or products re-embedded without their old vector being subtracted).
+    """
+    centroid = brand_doc.get("product_centroid")
+    if centroid is None:
+        return rebuild_brand_centroid(db, brand_doc)
+
+    dim = len(centroid.get("sum") or [])
+    if dim:
+        query = {"$and": [products_query_for_brand(brand_doc), {"embedding": {"$size": dim}}]}
+        if db["products"].count_documents(query) != centroid.get("count", 0):
+            return rebuild_brand_centroid(db, brand_doc)
+    return centroid
+
+
+def update_brand_centroid(db, product_doc, new_embedding=None, new_tags=None, expected_revision=None):
+    """
+    Incrementally applies one product change (added or re-embedded/re-tagged)
+    to its brand's cached centroid. `product_doc` is the document BEFORE the
+    update, so its old contribution can be subtracted.
+
+    `expected_revision` is brand_centroid_revision() read before the product was
+    written. If the centroid changed since (e.g. a rebuild that already includes
+    the product), applying the delta would count it twice, so it is rebuilt instead.
+    """
+    brand_query = brand_query_for_product(product_doc)
+    if not brand_query:
+        return False
+
+    brand = db["brands"].find_one(brand_query, {"name": 1, "product_centroid": 1})
+    if not brand:
+        return False
+
+    centroid = brand.get("product_centroid")
+    if not centroid:
+        # First time: the product update is already written, so a rebuild includes it
+        rebuild_brand_centroid(db, brand)
+        return True
+
+    revision = centroid.get("revision", 0)
+    if expected_revision is not None and expected_revision != revision:
+        rebuild_brand_centroid(db, brand)
+        return True
+
+    old_embedding = product_doc.get("embedding")
+    old_tags = set(product_doc.get("tags", []))
+    new_tags = old_tags if new_tags is None else set(new_tags)
+
+    total = np.asarray(centroid["sum"]) if centroid.get("sum") else None
+    count = centroid.get("count", 0)
+
+    if new_embedding:
+        if total is None:
+            total = np.zeros(len(new_embedding))
+        if len(new_embedding) != len(total):
+            # Dimension change (re-embedding migration) -> start over
+            rebuild_brand_centroid(db, brand)
+            return True
+        if old_embedding and len(old_embedding) == len(total):
+            total = total - np.asarray(old_embedding)
+        else:
+            count += 1
+        total = total + np.asarray(new_embedding)
+
+    tag_counts = {t["tag"]: t["count"] for t in centroid.get("tag_counts", [])}
+    for tag in old_tags - new_tags:
+        tag_counts[tag] = tag_counts.get(tag, 0) - 1
+        if tag_counts[tag] <= 0:
+            del tag_counts[tag]
+    for tag in new_tags - old_tags:
+        tag_counts[tag] = tag_counts.get(tag, 0) + 1
+
+    result = db["brands"].update_one(
+        # Optimistic concurrency: another writer bumped the revision -> rebuild
+        {"_id": brand["_id"], "product_centroid.revision": revision},
+        {"$set": {"product_centroid": _centroid_doc(total, count, tag_counts, revision + 1)}}
+    )
+    if result.matched_count == 0:
+        rebuild_brand_centroid(db, brand)
+    return True
+
+
+def _centroid_doc(total, count, tag_counts, revision):
+    return {
+        "sum": total.tolist() if total is not None else [],
+        "count": count,
+        "tag_counts": [{"tag": t, "count": c} for t, c in tag_counts.items()],
+        "revision": revision,
+        "updated_at": time.time()
+    }
+
+
+def centroid_vector(centroid):
+    """
+    Mean product embedding from a cached centroid (None if no product has one).
+    """
+    if not centroid or not centroid.get("count") or not centroid.get("sum"):
+        return None
+    return np.asarray(centroid["sum"]) / centroid["count"]
+
+
+def top_product_tags(centroid, limit=MAX_PRODUCT_TAGS):
+    """
+    Most frequent tags across the brand's products.
+    """
+    counts = centroid.get("tag_counts", []) if centroid else []
+    ranked = sorted(counts, key=lambda t: t["count"], reverse=True)
+    return [t["tag"] for t in ranked[:limit]]
+
+
+def blend_embeddings(brand_embedding, product_centroid, brand_weight=0.5):
+    """
+    Weighted blend of the (L2-normalized) brand embedding and product centroid.
+    Falls back to whichever one exists / matches in dimension.
+    """
+    vecs = []
+    for vec, weight in ((brand_embedding, brand_weight), (product_centroid, 1.0 - brand_weight)):
+        if vec is None or len(vec) == 0:
+            continue
+        arr = np.asarray(vec, dtype=np.float64)
+        norm = np.linalg.norm(arr)
+        if norm > 0:
+            vecs.append((arr / norm, weight))
+
+    if not vecs:
+        return None
+    if len(vecs) == 2 and len(vecs[0][0]) != len(vecs[1][0]):
+        return vecs[0][0].tolist()
+
+    blended = sum(v * w for v, w in vecs)
+    return blended.tolist()
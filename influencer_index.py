@@ -0,0 +1,387 @@
+import os
+import re
+import time
+import unicodedata
+import numpy as np
+from bson import ObjectId
+from pymongo import ASCENDING
+from scipy.sparse import csr_matrix
+
+_SPACE_RE = re.compile(r"\s+")
+
+# refresh() re-reads documents updated up to this many seconds before the last
+# synced timestamp, so writes from other processes with slightly older clocks
+# (or committed out of order) are not skipped by the high-water mark.
+INDEX_SYNC_OVERLAP = float(os.getenv("INDEX_SYNC_OVERLAP", 300))
+
+# Even without a version bump, refresh() pulls recently updated rows and checks
+# for deleted influencers at most this often (seconds).
+INDEX_RECONCILE_INTERVAL = float(os.getenv("INDEX_RECONCILE_INTERVAL", 60))
+
+# Live ids checked per _id-only $in query when looking for deleted influencers
+RECONCILE_BATCH_SIZE = 5000
+
+
+def normalize_tag(tag):
+    """
+    Light tag normalization shared by products and influencers:
+    NFKC, lowercase, whitespace collapsed ('데일리 룩' == '데일리  룩', 'Gaming' == 'gaming').
+    """
+    if not tag:
+        return ""
+    text = unicodedata.normalize("NFKC", str(tag)).lower()
+    return _SPACE_RE.sub(" ", text).strip()
+
+
+class TagVocabulary:
+    """
+    Maps normalized tag strings to integer ids. Grows incrementally.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.tags = []
+
+    def __len__(self):
+        return len(self.tags)
+
+    def add(self, tag):
+        norm = normalize_tag(tag)
+        if not norm:
+            return None
+        tag_id = self.ids.get(norm)
+        if tag_id is None:
+            tag_id = len(self.tags)
+            self.ids[norm] = tag_id
+            self.tags.append(norm)
+        return tag_id
+
+    def add_all(self, tags):
+        """
+        Returns the sorted unique ids for tags, adding unseen ones.
+        """
+        ids = {self.add(t) for t in tags or []}
+        ids.discard(None)
+        return sorted(ids)
+
+    def lookup(self, tags):
+        """
+        Returns the sorted unique ids of known tags (unknown tags are ignored).
+        """
+        ids = {self.ids.get(normalize_tag(t)) for t in tags or []}
+        ids.discard(None)
+        return sorted(ids)
+
+
+class InfluencerIndex:
+    """
+    Resident, column-oriented view of the influencer collection used by the matcher.
+
+    - tag_matrix: CSR incidence matrix (influencers x vocabulary), 1 if the influencer has the tag
+    - embeddings: L2-normalized embedding matrix per vector dimension, so a
+      re-embedding migration in progress never mixes 1536-d and reduced vectors
+    - er_scores: precomputed engagement score per influencer
+    - subscribers / category ids: filter columns applied before scoring
+
+    Rows are appended/replaced incrementally on refresh(); deleted influencers
+    are masked out (never scored). The dense/sparse arrays are rebuilt lazily
+    only when something changed.
+    """
+
+    PROJECTION = {
+        "_id": 1,
+        "tags": 1,
+        "embedding": 1,
+        "stats.subscribers": 1,
+        "stats.avg_likes": 1,
+        "structured_tags.industry": 1,
+        "last_updated": 1
+    }
+
+    def __init__(self, collection=None, categorize=None):
+        self.collection = collection
+        # Maps a raw industry string to its normalized category (for filters)
+        self.categorize = categorize or (lambda text: text or "N/A")
+        self.vocab = TagVocabulary()
+        self.version = None
+        self.last_synced = 0
+        self.last_reconciled = 0
+
+        self.ids = []
+        self.row_of = {}
+        self._tag_rows = []
+        self._embeddings = []
+        self._subscribers = []
+        self._avg_likes = []
+        self._alive = []
+        self.industries = []
+        self.category_ids = {}
+        self._categories = []
+
+        self._dirty = True
+        self._tag_matrix = None
+        # dim -> (row -> position map (-1 if absent), normalized matrix)
+        self._embedding_matrices = {}
+        self._er_rates = None
+        self._er_scores = None
+        self._subscriber_array = None
+        self._category_array = None
+        self._alive_array = None
+
+    @classmethod
+    def from_documents(cls, docs, categorize=None):
+        """
+        Builds a transient index from already-fetched documents.
+        """
+        index = cls(categorize=categorize)
+        for doc in docs:
+            index._upsert(doc)
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _category_id(self, industry):
+        category = self.categorize(industry)
+        if category not in self.category_ids:
+            self.category_ids[category] = len(self.category_ids)
+        return self.category_ids[category]
+
+    # --- Loading ---
+
+    def load(self, version=None):
+        """
+        Full scan of the collection.
+        """
+        self.collection.create_index([("last_updated", ASCENDING)])
+        for doc in self.collection.find({}, self.PROJECTION):
+            self._upsert(doc)
+        self.version = version
+        self.last_reconciled = time.time()
+        return self
+
+    def refresh(self, version):
+        """
+        Pulls influencers updated since the last sync (range scan on the indexed
+        last_updated) and masks out deleted ones (see reconcile). Runs when the
+        index version (bumped by watch_db.py) has changed, otherwise at most every
+        INDEX_RECONCILE_INTERVAL seconds. Returns the number of changed rows.
+        """
+        if version == self.version and time.time() - self.last_reconciled < INDEX_RECONCILE_INTERVAL:
+            return 0
+
+        changed = 0
+        cursor = self.collection.find(
+            {"last_updated": {"$gt": self.last_synced - INDEX_SYNC_OVERLAP}},
+            self.PROJECTION
+        )
+        for doc in cursor:
+            self._upsert(doc)
+            changed += 1
+
+        changed += self.reconcile()
+        self.version = version
+        return changed
+
+    def reconcile(self):
+        """
+        Masks out deleted influencers with one _id-only $in query per
+        RECONCILE_BATCH_SIZE live rows (answered from the _id index).
+        Returns the number of masked rows.
+        """
+        alive = [_id for _id, row in self.row_of.items() if self._alive[row]]
+        missing = []
+        for start in range(0, len(alive), RECONCILE_BATCH_SIZE):
+            chunk = alive[start:start + RECONCILE_BATCH_SIZE]
+            found = {doc["_id"] for doc in self.collection.find({"_id": {"$in": chunk}}, {"_id": 1})}
+            missing.extend(_id for _id in chunk if _id not in found)
+
+        self.remove(missing)
+        self.last_reconciled = time.time()
+        return len(missing)
+
+    def remove(self, ids):
+        """
+        Masks out rows whose documents no longer exist.
+        """
+        for _id in ids:
+            row = self.row_of.get(_id)
+            if row is not None and self._alive[row]:
+                self._alive[row] = False
+                self._dirty = True
+
+    def _upsert(self, doc):
+        row = self.row_of.get(doc["_id"])
+        if row is None:
+            row = len(self.ids)
+            self.row_of[doc["_id"]] = row
+            self.ids.append(doc["_id"])
+            self._tag_rows.append(None)
+            self._embeddings.append(None)
+            self._subscribers.append(0)
+            self._avg_likes.append(0)
+            self._alive.append(True)
+            self.industries.append("")
+            self._categories.append(0)
+
+        stats = doc.get("stats", {}) or {}
+        self._alive[row] = True
+        self._tag_rows[row] = np.array(self.vocab.add_all(doc.get("tags", [])), dtype=np.int32)
+        self._embeddings[row] = doc.get("embedding") or None
+        self._subscribers[row] = stats.get("subscribers", 0) or 0
+        self._avg_likes[row] = stats.get("avg_likes", 0) or 0
+        self.industries[row] = (doc.get("structured_tags", {}) or {}).get("industry", "") or ""
+        self._categories[row] = self._category_id(self.industries[row])
+
+        last_updated = doc.get("last_updated")
+        if isinstance(last_updated, (int, float)) and last_updated > self.last_synced:
+            self.last_synced = last_updated
+
+        self._dirty = True
+
+    # --- Columns ---
+
+    def _build(self):
+        if not self._dirty:
+            return
+
+        n = len(self.ids)
+
+        # Tag incidence (CSR)
+        lengths = np.array([len(r) for r in self._tag_rows], dtype=np.int64)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        indices = np.concatenate(self._tag_rows) if n else np.zeros(0, dtype=np.int32)
+        data = np.ones(len(indices), dtype=np.int32)
+        self._tag_matrix = csr_matrix((data, indices, indptr), shape=(n, len(self.vocab)))
+
+        # Embeddings (L2-normalized, grouped by dimension)
+        rows_by_dim = {}
+        for row, emb in enumerate(self._embeddings):
+            if emb:
+                rows_by_dim.setdefault(len(emb), []).append(row)
+
+        self._embedding_matrices = {}
+        for dim, dim_rows in rows_by_dim.items():
+            matrix = np.array([self._embeddings[r] for r in dim_rows], dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1)
+            norms[norms == 0] = 1.0
+            positions = np.full(n, -1, dtype=np.int64)
+            positions[dim_rows] = np.arange(len(dim_rows))
+            self._embedding_matrices[dim] = (positions, matrix / norms[:, None])
+
+        # Engagement (missing/zero subscribers count as 1, as before)
+        self._subscriber_array = np.array(self._subscribers, dtype=np.int64)
+        subs = np.maximum(self._subscriber_array, 1).astype(np.float64)
+        likes = np.array(self._avg_likes, dtype=np.float64)
+        self._er_rates = likes / subs
+        self._er_scores = np.minimum(self._er_rates * 20, 1.0)
+
+        # Filter columns
+        self._category_array = np.array(self._categories, dtype=np.int32)
+        self._alive_array = np.array(self._alive, dtype=bool)
+
+        self._dirty = False
+
+    @property
+    def tag_matrix(self):
+        self._build()
+        return self._tag_matrix
+
+    @property
+    def er_scores(self):
+        self._build()
+        return self._er_scores
+
+    # --- Filters ---
+
+    def filter_mask(self, filters=None):
+        """
+        Boolean row mask for a filter dict, evaluated on the resident columns:
+          min_subscribers / max_subscribers: subscriber band (inclusive)
+          min_er: minimum engagement rate (avg_likes / subscribers, e.g. 0.02)
+          industries: allowed categories (normalized with `categorize`)
+          exclude_industries: blocked categories
+          exclude_ids: influencer _ids (ObjectId or str) to drop, e.g. already contracted
+        """
+        self._build()
+        mask = self._alive_array.copy()
+        if not filters:
+            return mask
+
+        if filters.get("min_subscribers") is not None:
+            mask &= self._subscriber_array >= filters["min_subscribers"]
+        if filters.get("max_subscribers") is not None:
+            mask &= self._subscriber_array <= filters["max_subscribers"]
+        if filters.get("min_er") is not None:
+            mask &= self._er_rates >= filters["min_er"]
+
+        if filters.get("industries"):
+            allowed = [self.category_ids.get(self.categorize(i)) for i in filters["industries"]]
+            mask &= np.isin(self._category_array, [c for c in allowed if c is not None])
+        if filters.get("exclude_industries"):
+            blocked = [self.category_ids.get(self.categorize(i)) for i in filters["exclude_industries"]]
+            mask &= ~np.isin(self._category_array, [c for c in blocked if c is not None])
+
+        if filters.get("exclude_ids"):
+            excluded = np.zeros(len(self.ids), dtype=bool)
+            for _id in filters["exclude_ids"]:
+                row = self.row_of.get(_id)
+                if row is None and isinstance(_id, str) and ObjectId.is_valid(_id):
+                    row = self.row_of.get(ObjectId(_id))
+                if row is not None:
+                    excluded[row] = True
+            mask &= ~excluded
+
+        return mask
+
+    # --- Scoring primitives ---
+
+    def overlap_counts(self, tag_id_lists, rows=None):
+        """
+        Tag overlap between influencers (all, or only `rows`) and one or more
+        products in a single sparse mat-mat product.
+        Returns an (n_rows, n_products) int array.
+        """
+        self._build()
+        cols = len(self.vocab)
+        indptr = np.zeros(len(tag_id_lists) + 1, dtype=np.int64)
+        np.cumsum([len(ids) for ids in tag_id_lists], out=indptr[1:])
+        indices = np.array([i for ids in tag_id_lists for i in ids], dtype=np.int32)
+        query = csr_matrix(
+            (np.ones(len(indices), dtype=np.int32), indices, indptr),
+            shape=(len(tag_id_lists), cols)
+        )
+        matrix = self._tag_matrix if rows is None else self._tag_matrix[rows]
+        return (matrix @ query.T).toarray()
+
+    def similarities(self, embedding, rows=None):
+        """
+        Cosine similarity of influencers (all, or only `rows`) to one vector (0 where missing).
+        """
+        self._build()
+        if rows is None:
+            rows = np.arange(len(self.ids))
+        n = len(rows)
+        # Dimension guard: only rows embedded at the same size are compared
+        if not embedding or len(embedding) not in self._embedding_matrices:
+            return np.zeros(n)
+
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        if norm == 0:
+            return np.zeros(n)
+
+        positions, matrix = self._embedding_matrices[len(embedding)]
+        pos = positions[rows]
+        valid = pos >= 0
+        sims = np.zeros(n)
+        sims[valid] = matrix[pos[valid]] @ (vec / norm)
+        return sims
+
+    def embedding_dims(self):
+        """
+        Row count per embedding dimension (more than one key = migration in progress).
+        """
+        self._build()
+        return {dim: int((positions >= 0).sum()) for dim, (positions, _) in self._embedding_matrices.items()}
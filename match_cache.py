@@ -0,0 +1,129 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Document in the 'meta' collection that tracks the influencer data version.
+# Every writer that changes influencer tags/embeddings must bump it.
+INDEX_VERSION_ID = "influencer_index"
+
+
+def get_index_version(db):
+    """
+    Returns the current influencer-index version (0 if never bumped).
+    """
+    doc = db["meta"].find_one({"_id": INDEX_VERSION_ID})
+    return doc.get("version", 0) if doc else 0
+
+
+def bump_index_version(db):
+    """
+    Marks influencer data as changed; invalidates every cached recommendation.
+    """
+    db["meta"].update_one(
+        {"_id": INDEX_VERSION_ID},
+        {"$inc": {"version": 1}, "$set": {"updated_at": time.time()}},
+        upsert=True
+    )
+
+
+def make_cache_key(product_doc, index_version, limit, weights, extra=None):
+    """
+    Builds a cache key from everything that can change a ranking.
+    """
+    key = [
+        str(product_doc.get("_id")),
+        product_doc.get("last_updated"),
+        index_version,
+        limit,
+        sorted(weights.items())
+    ]
+    if extra is not None:
+        key.append(extra)
+    return json.dumps(key, ensure_ascii=False, default=str)
+
+
+class ResultCache:
+    """
+    In-process LRU for recommendation results, optionally backed by a local
+    SQLite file so several recommend.py processes share hits.
+    Values are stored in the file as JSON (never pickled, so a writable cache file
+    cannot inject code); ObjectIds and other non-JSON values come back as strings.
+    """
+
+    def __init__(self, max_entries=128, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if self.path:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS match_cache ("
+                    " key TEXT PRIMARY KEY,"
+                    " index_version INTEGER,"
+                    " created_at REAL,"
+                    " value BLOB)"
+                )
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        if not self.path:
+            return None
+
+        conn = self._connect()
+        row = conn.execute("SELECT value FROM match_cache WHERE key = ?", (key,)).fetchone()
+        conn.close()
+        if not row:
+            return None
+
+        try:
+            value = json.loads(row[0])
+        except (TypeError, ValueError):
+            # Unreadable entry (e.g. written by an older, pickle-based version) -> miss
+            return None
+        self._put_local(key, value)
+        return value
+
+    def put(self, key, value, index_version=0):
+        self._put_local(key, value)
+
+        if not self.path:
+            return
+
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO match_cache (key, index_version, created_at, value) VALUES (?, ?, ?, ?)",
+                (key, index_version, time.time(), json.dumps(value, ensure_ascii=False, default=str))
+            )
+            # Entries from older influencer versions can never hit again
+            conn.execute("DELETE FROM match_cache WHERE index_version < ?", (index_version,))
+        conn.close()
+
+    def _put_local(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.path:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM match_cache")
+            conn.close()
@@ -1,25 +1,131 @@
 import os
 import time
 import math
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import MongoClient, ASCENDING
 from dotenv import load_dotenv
 from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
+from product_search import search_products, ensure_search_indexes, build_search_fields
+from near_duplicate import dedup_text, signature_fields
+from match_cache import ResultCache, get_index_version, make_cache_key
+from influencer_index import InfluencerIndex, normalize_tag
+from brand_profile import (
+    verify_brand_centroid, update_brand_centroid, brand_centroid_revision,
+    centroid_vector, top_product_tags, blend_embeddings
+)
 
 load_dotenv(override=True)
 
+# Hybrid score weights (see README: similarity 40% + keyword 30% + ER + category rule)
+DEFAULT_WEIGHTS = {
+    "similarity": 0.4,
+    "keyword": 0.3,
+    "engagement": 0.1,
+    "category_match": 0.3,
+    "category_mismatch": -0.5
+}
+
+# --- Category Normalization ---
+CATEGORY_SYNONYMS = {
+    "요가": "운동",
+    "러닝": "운동",
+    "헬스": "운동",
+    "피트니스": "운동",
+    "필라테스": "운동",
+    "운동": "운동",
+    "등산": "아웃도어",
+    "캠핑": "아웃도어",
+    "여행": "여행",
+    "패션": "패션",
+    "뷰티": "뷰티",
+    "육아": "육아",
+    "게임": "게임",
+    "IT": "테크",
+    "전자기기": "테크",
+    "자동차": "자동차",
+    "차": "자동차",
+    "시승": "자동차",
+    "모빌리티": "자동차"
+}
+
+def as_object_id(value):
+    """
+    ObjectId for a 24-hex string id (from CLI args or the JSON cache), else the value as-is.
+    """
+    if isinstance(value, str) and ObjectId.is_valid(value):
+        return ObjectId(value)
+    return value
+
+def normalize_category(text):
+    if not text: return "N/A"
+    text_str = str(text) # Handle list if passed accidently, though expected str
+    for key, value in CATEGORY_SYNONYMS.items():
+        if key in text_str: return value
+    return text_str
+
 class MatchingEngine:
-    def __init__(self):
-        self.uri = os.getenv("MONGODB_URI")
-        self.db_name = os.getenv("DB_NAME")
-        
-        if not self.uri or not self.db_name:
-            raise ValueError("MONGODB_URI or DB_NAME missing")
-            
-        self.client = MongoClient(self.uri)
-        self.db = self.client[self.db_name]
+    def __init__(self, cache_size=128, cache_path=None, use_index=True, db=None):
+        if db is None:
+            self.uri = os.getenv("MONGODB_URI")
+            self.db_name = os.getenv("DB_NAME")
+
+            if not self.uri or not self.db_name:
+                raise ValueError("MONGODB_URI or DB_NAME missing")
+
+            self.client = MongoClient(self.uri)
+            db = self.client[self.db_name]
+
+        self.db = db
         self.influencers = self.db["influencers"]
         self.products = self.db["products"]
+        self.brands = self.db["brands"]
+
+        # Indexes used by search_products (created once, not per query)
+        ensure_search_indexes(self.products)
+
+        # Result cache: in-process LRU + optional shared SQLite file
+        cache_path = cache_path or os.getenv("MATCH_CACHE_PATH")
+        self.cache = ResultCache(max_entries=cache_size, path=cache_path)
+
+        # Resident influencer index (loaded lazily on first match).
+        # With use_index=False every match runs an indexed MongoDB query instead.
+        self.use_index = use_index
+        self.index = None
+        if not use_index:
+            # Subscriber band pushdown in _query_candidates
+            self.influencers.create_index([("stats.subscribers", ASCENDING)])
+
+    def search_products(self, query, limit=5):
+        """
+        Ranked product lookup by name/title (exact -> prefix -> n-gram fuzzy).
+        """
+        return search_products(self.products, query, limit=limit)
+
+    def tag_product_now(self, product_doc):
+        """
+        Priority lane: tags and embeds one product synchronously instead of
+        waiting for watch_db.py to reach it. Returns the updated document
+        (or the original one if tagging failed).
+        """
+        # Imported lazily so the engine can run without an OpenAI key
+        from tagging_utils import tag_and_embed_product, version_fields
+        from token_usage import PRIORITY_HIGH
+
+        # Interactive request: never throttled by the token budget
+        update_data = tag_and_embed_product(product_doc, priority=PRIORITY_HIGH)
+        if not update_data:
+            return product_doc
+
+        update_data["last_updated"] = time.time()
+        update_data.update(version_fields("products", product_doc, tagged=not product_doc.get("structured_tags")))
+        update_data.update(build_search_fields(product_doc))
+        update_data.update(signature_fields(dedup_text("products", product_doc)))
+
+        revision = brand_centroid_revision(self.db, product_doc)
+        self.products.update_one({"_id": product_doc["_id"]}, {"$set": update_data})
+        update_brand_centroid(self.db, product_doc, update_data["embedding"], update_data["tags"], revision)
+        return {**product_doc, **update_data}
 
     def calculate_similarity(self, vec_a, vec_b):
         """
@@ -27,6 +133,10 @@ class MatchingEngine:
         """
         if not vec_a or not vec_b:
             return 0.0
+
+        # Vectors of different sizes (e.g. mid-migration) are not comparable
+        if len(vec_a) != len(vec_b):
+            return 0.0
         
         # Reshape for sklearn
         a = np.array(vec_a).reshape(1, -1)
@@ -34,141 +144,249 @@ class MatchingEngine:
         
         return cosine_similarity(a, b)[0][0]
 
-    def find_influencers_for_product(self, product_doc, limit=10):
+    def recommend_for_product(self, product_doc, limit=10, weights=None, filters=None):
+        """
+        Cached wrapper around find_influencers_for_product.
+        The key includes the product's last_updated and the influencer-index
+        version, so updates from watch_db.py invalidate entries automatically.
+        Returns {"results": [...], "cache_hit": bool}.
+        """
+        weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+        index_version = get_index_version(self.db)
+        key = make_cache_key(product_doc, index_version, limit, weights, extra=filters)
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            # Entries hold ids/scores only; documents are re-fetched (without embeddings kept in the cache).
+            # Ids read back from the shared SQLite file are strings.
+            ids = [as_object_id(c["influencer_id"]) for c in cached]
+            docs = {d["_id"]: d for d in self.influencers.find({"_id": {"$in": ids}})}
+            results = [
+                {"influencer": docs[_id], "score": c["score"], "details": c["details"]}
+                for _id, c in zip(ids, cached) if _id in docs
+            ]
+            return {"results": results, "cache_hit": True}
+
+        results = self.find_influencers_for_product(product_doc, limit=limit, weights=weights, filters=filters)
+        entries = [
+            {"influencer_id": r["influencer"]["_id"], "score": r["score"], "details": r["details"]}
+            for r in results
+        ]
+        self.cache.put(key, entries, index_version=index_version)
+        return {"results": results, "cache_hit": False}
+
+    def _get_index(self):
+        """
+        Returns the resident influencer index, loading it on first use and
+        pulling incremental updates when the influencer-index version changes.
+        """
+        version = get_index_version(self.db)
+        if self.index is None:
+            self.index = InfluencerIndex(self.influencers, categorize=normalize_category).load(version)
+        else:
+            self.index.refresh(version)
+        return self.index
+
+    def _query_candidates(self, filters):
+        """
+        No resident index: pushes the subscriber band and exclusions down to an
+        indexed MongoDB query and builds a transient index from the result.
+        Industry and engagement filters are applied on the transient columns
+        afterwards, since category synonyms cannot be expressed as an exact $in
+        and the engagement rate is a ratio of two fields.
+        """
+        query = {}
+        filters = filters or {}
+        subs_range = {}
+        if filters.get("min_subscribers") is not None:
+            subs_range["$gte"] = filters["min_subscribers"]
+        if filters.get("max_subscribers") is not None:
+            subs_range["$lte"] = filters["max_subscribers"]
+        if subs_range:
+            # Same rule as InfluencerIndex.filter_mask: a missing/null count is 0
+            min_subs = filters.get("min_subscribers")
+            max_subs = filters.get("max_subscribers")
+            if (min_subs is None or min_subs <= 0) and (max_subs is None or max_subs >= 0):
+                query["$or"] = [{"stats.subscribers": subs_range}, {"stats.subscribers": None}]
+            else:
+                query["stats.subscribers"] = subs_range
+        if filters.get("exclude_ids"):
+            query["_id"] = {"$nin": [as_object_id(i) for i in filters["exclude_ids"]]}
+
+        docs = self.influencers.find(query, InfluencerIndex.PROJECTION)
+        return InfluencerIndex.from_documents(docs, categorize=normalize_category)
+
+    def find_influencers_for_product(self, product_doc, limit=10, weights=None, filters=None):
         """
         Recommend influencers for a given product document.
+
+        filters (applied before scoring, see InfluencerIndex.filter_mask):
+          {"min_subscribers": int, "max_subscribers": int, "min_er": float,
+           "industries": [...], "exclude_industries": [...], "exclude_ids": [...]}
         """
+        weights = {**DEFAULT_WEIGHTS, **(weights or {})}
         product_name = product_doc.get("title") or product_doc.get("name", "Unknown")
         print(f"Match: Analyzing matching for '{product_name}'...")
         
         prod_embed = product_doc.get("embedding")
         prod_tags = set(product_doc.get("tags", []))
         prod_cat = product_doc.get("structured_tags", {}).get("category", "")
-        
-        # --- Normalization Logic ---
-        CATEGORY_SYNONYMS = {
-            "요가": "운동",
-            "러닝": "운동",
-            "헬스": "운동",
-            "피트니스": "운동",
-            "필라테스": "운동",
-            "운동": "운동",
-            "등산": "아웃도어",
-            "캠핑": "아웃도어",
-            "여행": "여행",
-            "패션": "패션",
-            "뷰티": "뷰티",
-            "육아": "육아",
-            "게임": "게임",
-            "IT": "테크",
-            "전자기기": "테크",
-            "자동차": "자동차",
-            "차": "자동차",
-            "시승": "자동차",
-            "모빌리티": "자동차"
-        }
 
-        def normalize(text):
-            if not text: return "N/A"
-            text_str = str(text) # Handle list if passed accidently, though expected str
-            for key, value in CATEGORY_SYNONYMS.items():
-                if key in text_str: return value
-            return text_str
-
-        norm_prod_cat = normalize(prod_cat)
+        norm_prod_cat = normalize_category(prod_cat)
         
         if not prod_embed:
             print("Warning: Product has no embedding. Results will be poor.")
 
-        # --- Step 1: Candidate Generation ---
-        candidates = list(self.influencers.find({}))
-        scored_candidates = []
-        
-        for inf in candidates:
-            inf_industry = inf.get("structured_tags", {}).get("industry", "")
-            
-            # --- Step 2: Semantic Similarity ---
-            sim_score = 0.0
-            inf_embed = inf.get("embedding")
-            if prod_embed and inf_embed:
-                sim_score = self.calculate_similarity(prod_embed, inf_embed)
-            
-            # --- Step 3: Keyword Overlap ---
-            inf_tags = set(inf.get("tags", []))
-            overlap = prod_tags.intersection(inf_tags)
-            keyword_score = len(overlap) / max(len(prod_tags), 1)
-
-            # Strict Filter: Require at least 1 keyword match
-            if len(overlap) == 0:
-                continue
-
-            # --- Step 4: Engagement Rate ---
-            stats = inf.get("stats", {})
-            subs = stats.get("subscribers", 1) or 1
-            avg_likes = stats.get("avg_likes", 0) or 0
-            er = avg_likes / subs if subs > 0 else 0
-            er_score = min(er * 20, 1.0)
-            
-            # --- Step 5: Multi-Category Matching ---
-            cat_score = 0.0
-            norm_inf_cat = normalize(inf_industry)
-            
-            # 1. Identify ALL valid categories for this product
-            #    (Primary Category + Tags that are actually categories)
-            valid_product_categories = set()
-            if norm_prod_cat != "N/A":
-                valid_product_categories.add(norm_prod_cat)
-                
-            for tag in prod_tags:
-                norm_tag = normalize(tag)
-                if norm_tag != "N/A" and norm_tag != tag: # If tag maps to a known category synonym
-                    valid_product_categories.add(norm_tag)
-                # Also check direct mapping if tag IS a standard category key (e.g., '게임')
-                if tag in CATEGORY_SYNONYMS.values(): 
-                     valid_product_categories.add(tag)
-
-            # 2. Check for Match or Mismatch
-            is_match = False
-            
-            # A. Direct overlap
-            if norm_inf_cat in valid_product_categories:
-                is_match = True
-            
-            # B. Substring Overlap (fallback)
-            if not is_match and inf_industry:
-                for vcat in valid_product_categories:
-                    if (vcat in inf_industry) or (inf_industry in vcat):
-                        is_match = True
-                        break
-            
-            if is_match:
-                cat_score = 0.3 # Boost for matching ANY valid category
-            elif (len(valid_product_categories) > 0) and (norm_inf_cat != "N/A"):
-                # Mismatch Penalty
-                # Only penalize if influencer category is completely disjoint from ALL product categories
-                cat_score = -0.5 
-            
-            final_score = (sim_score * 0.4) + (keyword_score * 0.3) + (er_score * 0.1) + cat_score
-            
-            # Ensure score doesn't go below 0
-            final_score = max(final_score, 0.0)
+        # 1. Identify ALL valid categories for this product
+        #    (Primary Category + Tags that are actually categories)
+        valid_product_categories = set()
+        if norm_prod_cat != "N/A":
+            valid_product_categories.add(norm_prod_cat)
             
+        for tag in prod_tags:
+            norm_tag = normalize_category(tag)
+            if norm_tag != "N/A" and norm_tag != tag: # If tag maps to a known category synonym
+                valid_product_categories.add(norm_tag)
+            # Also check direct mapping if tag IS a standard category key (e.g., '게임')
+            if tag in CATEGORY_SYNONYMS.values(): 
+                 valid_product_categories.add(tag)
+
+        # --- Step 1: Candidate Generation (filters pushed down before scoring) ---
+        index = self._get_index() if self.use_index else self._query_candidates(filters)
+        if len(index) == 0:
+            return []
+        rows = np.nonzero(index.filter_mask(filters))[0]
+
+        # --- Step 2: Keyword Overlap (sparse mat-vec over the tag vocabulary) ---
+        prod_tag_ids = index.vocab.lookup(prod_tags)
+        n_prod_tags = len({normalize_tag(t) for t in prod_tags} - {""})
+        overlap = index.overlap_counts([prod_tag_ids], rows=rows)[:, 0]
+
+        # Strict Filter: Require at least 1 keyword match
+        keep = overlap > 0
+        rows, overlap = rows[keep], overlap[keep]
+        if len(rows) == 0:
+            return []
+
+        keyword_scores = overlap / max(n_prod_tags, 1)
+
+        # --- Step 3: Semantic Similarity ---
+        # Only influencers embedded at the product's dimension are compared
+        if prod_embed and len(prod_embed) not in index.embedding_dims():
+            print(f"Warning: No influencer embeddings with dimension {len(prod_embed)}. Similarity is skipped.")
+        sim_scores = index.similarities(prod_embed, rows=rows)
+
+        # --- Step 4: Engagement Rate ---
+        er_scores = index.er_scores[rows]
+
+        # --- Step 5: Multi-Category Matching (once per distinct industry) ---
+        category_cache = {}
+        cat_scores = np.zeros(len(rows))
+        cat_matches = []
+        for i, row in enumerate(rows):
+            inf_industry = index.industries[row]
+            if inf_industry not in category_cache:
+                category_cache[inf_industry] = self._category_score(
+                    inf_industry, valid_product_categories, weights
+                )
+            cat_scores[i], is_match = category_cache[inf_industry]
+            cat_matches.append(is_match)
+
+        final_scores = (
+            (sim_scores * weights["similarity"]) +
+            (keyword_scores * weights["keyword"]) +
+            (er_scores * weights["engagement"]) +
+            cat_scores
+        )
+        
+        # Ensure score doesn't go below 0
+        final_scores = np.maximum(final_scores, 0.0)
+
+        # Sort by score DESC (stable, so ties keep collection order)
+        order = np.argsort(-final_scores, kind="stable")
+
+        # Fetch full documents only for the winners. Influencers deleted since the
+        # last index refresh are dropped and the next-best rows fill their slots.
+        top, docs, start = [], {}, 0
+        while len(top) < limit and start < len(order):
+            chunk = order[start:start + limit - len(top)]
+            start += len(chunk)
+            chunk_ids = [index.ids[rows[i]] for i in chunk]
+            found = {d["_id"]: d for d in self.influencers.find({"_id": {"$in": chunk_ids}})}
+            missing = [_id for _id in chunk_ids if _id not in found]
+            if missing and self.use_index:
+                index.remove(missing)
+            docs.update(found)
+            top.extend(i for i in chunk if index.ids[rows[i]] in found)
+
+        scored_candidates = []
+        for i in top:
+            row = rows[i]
+            inf = docs[index.ids[row]]
             scored_candidates.append({
                 "influencer": inf,
-                "score": final_score,
+                "score": float(final_scores[i]),
                 "details": {
-                    "similarity": round(sim_score, 2),
-                    "keyword_overlap": len(overlap),
-                    "er_score": round(er_score, 2),
-                    "industry": inf_industry,
-                    "matched_category": is_match
+                    "similarity": round(float(sim_scores[i]), 2),
+                    "keyword_overlap": int(overlap[i]),
+                    "er_score": round(float(er_scores[i]), 2),
+                    "industry": index.industries[row],
+                    "matched_category": cat_matches[i]
                 }
             })
         
-        # Sort by score DESC
-        scored_candidates.sort(key=lambda x: x["score"], reverse=True)
+        return scored_candidates
+
+    def find_influencers_for_brand(self, brand_doc, limit=10, weights=None, filters=None, brand_weight=0.5):
+        """
+        Recommend influencers for a brand's whole catalog.
+        Blends the brand embedding with the cached centroid of its product
+        embeddings (brand_weight : 1 - brand_weight) and the brand tags with the
+        most frequent product tags, then runs a single product-style match.
+        """
+        # Built once on the first query; rebuilt if products were deleted since
+        centroid = verify_brand_centroid(self.db, brand_doc)
+
+        embedding = blend_embeddings(brand_doc.get("embedding"), centroid_vector(centroid), brand_weight)
+        tags = set(brand_doc.get("tags", [])) | set(top_product_tags(centroid))
+        structured = brand_doc.get("structured_tags", {}) or {}
+
+        query_doc = {
+            "_id": brand_doc["_id"],
+            "name": brand_doc.get("name", "Unknown"),
+            "embedding": embedding,
+            "tags": list(tags),
+            "structured_tags": {"category": structured.get("industry") or brand_doc.get("industry", "")}
+        }
+        return self.find_influencers_for_product(query_doc, limit=limit, weights=weights, filters=filters)
+
+    def _category_score(self, inf_industry, valid_product_categories, weights):
+        """
+        Category rule for one influencer industry. Returns (cat_score, is_match).
+        """
+        norm_inf_cat = normalize_category(inf_industry)
+
+        # 2. Check for Match or Mismatch
+        is_match = False
+        
+        # A. Direct overlap
+        if norm_inf_cat in valid_product_categories:
+            is_match = True
+        
+        # B. Substring Overlap (fallback)
+        if not is_match and inf_industry:
+            for vcat in valid_product_categories:
+                if (vcat in inf_industry) or (inf_industry in vcat):
+                    is_match = True
+                    break
         
-        return scored_candidates[:limit]
+        if is_match:
+            return weights["category_match"], True # Boost for matching ANY valid category
+        if (len(valid_product_categories) > 0) and (norm_inf_cat != "N/A"):
+            # Mismatch Penalty
+            # Only penalize if influencer category is completely disjoint from ALL product categories
+            return weights["category_mismatch"], False
+        return 0.0, False
 
 if __name__ == "__main__":
     # Test run
@@ -0,0 +1,200 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from pymongo import MongoClient, ASCENDING, UpdateOne
+from dotenv import load_dotenv
+from tagging_utils import (
+    EMBEDDING_DIM, FULL_EMBEDDING_DIM, get_embedding, shorten_embedding, embedding_text,
+    version_fields
+)
+from match_cache import bump_index_version
+from brand_profile import rebuild_brand_centroid
+from token_usage import PRIORITY_LOW
+
+load_dotenv(override=True)
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+# Configuration
+MONGODB_URI = os.getenv("MONGODB_URI")
+DB_NAME = os.getenv("DB_NAME")
+COLLECTIONS = ["influencers", "brands", "products"]
+
+if not all([MONGODB_URI, DB_NAME]):
+    print("Error: Missing environment variables.")
+    exit(1)
+
+mongo_client = MongoClient(MONGODB_URI)
+db = mongo_client[DB_NAME]
+
+
+def migrate_collection(collection_name, dim, mode, batch_size=100, pause=0.5):
+    """
+    Re-embeds ('reembed') or truncates ('truncate') every vector that is not yet
+    `dim`-dimensional. Vectors that already have `dim` values only get their
+    embedding_dim field set. Pages by _id, so it can be stopped and resumed at any time.
+    """
+    collection = db[collection_name]
+    collection.create_index([("embedding_dim", ASCENDING)])
+
+    query = {"embedding": {"$exists": True, "$ne": None}, "embedding_dim": {"$ne": dim}}
+    last_id = None
+    migrated = 0
+    skipped = 0
+    stamped = 0
+
+    while True:
+        page_query = dict(query)
+        if last_id is not None:
+            page_query["_id"] = {"$gt": last_id}
+        docs = list(collection.find(page_query).sort("_id", ASCENDING).limit(batch_size))
+        if not docs:
+            break
+        last_id = docs[-1]["_id"]
+
+        ops = []
+        changed = 0
+        for doc in docs:
+            if len(doc["embedding"]) == dim:
+                # Legacy document without embedding_dim whose vector is already the target size
+                ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"embedding_dim": dim}}))
+                stamped += 1
+                continue
+
+            if mode == "truncate":
+                new_embedding = shorten_embedding(doc.get("embedding"), dim)
+            else:
+                new_embedding = get_embedding(
+                    embedding_text(collection_name, doc),
+                    dimensions=dim,
+                    collection=collection_name,
+                    priority=PRIORITY_LOW
+                )
+
+            if not new_embedding:
+                skipped += 1
+                continue
+
+            update_data = {
+                "embedding": new_embedding,
+                "embedding_dim": len(new_embedding),
+                "last_updated": time.time()
+            }
+            if mode == "reembed":
+                # Re-embedded with the current embedding text recipe
+                update_data.update(version_fields(collection_name, doc, tagged=False))
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": update_data}))
+            changed += 1
+
+        if ops:
+            collection.bulk_write(ops, ordered=False)
+            migrated += changed
+            if collection_name == "influencers" and changed:
+                bump_index_version(db)
+
+        print(f"  [{collection_name}] migrated {migrated}, skipped {skipped}, already {dim}-d {stamped}")
+        # Throttle so live ingestion (watch_db.py) keeps priority
+        time.sleep(pause)
+
+    if collection_name == "products" and migrated:
+        # Cached brand centroids were summed at the old dimension
+        for brand in db["brands"].find({"product_centroid": {"$exists": True}}, {"name": 1, "product_centroid": 1}):
+            rebuild_brand_centroid(db, brand)
+
+    return migrated, skipped
+
+
+def ranking_agreement(dim, sample=50, k=10):
+    """
+    Compares influencer rankings by embedding similarity at 1536-d vs. `dim`
+    (truncated + re-normalized, which matches what the API returns for `dimensions`).
+    Must run before the migration, while full-size vectors still exist.
+    """
+    influencers = [
+        d for d in db["influencers"].find({"embedding": {"$exists": True}}, {"embedding": 1})
+        if len(d.get("embedding") or []) == FULL_EMBEDDING_DIM
+    ]
+    products = [
+        d for d in db["products"].aggregate([
+            {"$match": {"embedding": {"$exists": True}}},
+            {"$sample": {"size": sample}},
+            {"$project": {"embedding": 1}}
+        ])
+        if len(d.get("embedding") or []) == FULL_EMBEDDING_DIM
+    ]
+    if not influencers or not products:
+        print("Not enough 1536-d vectors to compare.")
+        return None
+
+    def normalized(matrix):
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    inf_full = np.array([d["embedding"] for d in influencers], dtype=np.float32)
+    prod_full = np.array([d["embedding"] for d in products], dtype=np.float32)
+
+    sims_full = normalized(prod_full) @ normalized(inf_full).T
+    sims_small = normalized(prod_full[:, :dim]) @ normalized(inf_full[:, :dim]).T
+
+    k = min(k, len(influencers))
+    overlaps, top1, spearman = [], [], []
+    for full_row, small_row in zip(sims_full, sims_small):
+        top_full = np.argsort(-full_row)[:k]
+        top_small = np.argsort(-small_row)[:k]
+        overlaps.append(len(set(top_full) & set(top_small)) / k)
+        top1.append(top_full[0] == top_small[0])
+
+        rank_full = np.argsort(np.argsort(-full_row))
+        rank_small = np.argsort(np.argsort(-small_row))
+        spearman.append(np.corrcoef(rank_full, rank_small)[0, 1] if len(full_row) > 1 else 1.0)
+
+    report = {
+        "dim": dim,
+        "products": len(products),
+        "influencers": len(influencers),
+        f"overlap@{k}": float(np.mean(overlaps)),
+        "top1_agreement": float(np.mean(top1)),
+        "spearman": float(np.mean(spearman))
+    }
+
+    print(f"📊 Ranking agreement 1536-d vs {dim}-d ({len(products)} products x {len(influencers)} influencers)")
+    print(f"   Overlap@{k}: {report[f'overlap@{k}']:.3f}")
+    print(f"   Top-1 agreement: {report['top1_agreement']:.3f}")
+    print(f"   Spearman (full ranking): {report['spearman']:.3f}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate stored embeddings to a new dimension.")
+    parser.add_argument("--dim", type=int, default=EMBEDDING_DIM, help="Target dimension (default: EMBEDDING_DIM)")
+    parser.add_argument("--mode", choices=["truncate", "reembed"], default="truncate",
+                        help="truncate: shorten stored vectors locally (no API cost); reembed: call the API again")
+    parser.add_argument("--collections", nargs="+", default=COLLECTIONS, choices=COLLECTIONS)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--pause", type=float, default=0.5, help="Seconds to sleep between batches")
+    parser.add_argument("--report-only", action="store_true", help="Only print the ranking agreement report")
+    args = parser.parse_args()
+
+    if args.dim > FULL_EMBEDDING_DIM:
+        print(f"Error: --dim must be <= {FULL_EMBEDDING_DIM}.")
+        exit(1)
+
+    if args.dim != FULL_EMBEDDING_DIM:
+        ranking_agreement(args.dim)
+    if args.report_only:
+        return
+
+    if args.dim != EMBEDDING_DIM:
+        print(f"⚠️ EMBEDDING_DIM is {EMBEDDING_DIM}; set EMBEDDING_DIM={args.dim} so new documents match.")
+
+    print(f"Starting embedding migration -> {args.dim}-d ({args.mode})...")
+    for name in args.collections:
+        migrated, skipped = migrate_collection(name, args.dim, args.mode, args.batch, args.pause)
+        print(f"✅ {name}: {migrated} migrated, {skipped} skipped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import os
+import re
+import zlib
+import hashlib
+import unicodedata
+import numpy as np
+from pymongo import ASCENDING
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+# Estimated Jaccard similarity (over character shingles) above which a document
+# reuses the tags/embedding of an already tagged one instead of calling the API.
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", 0.9))
+
+# LSH banding: BANDS x ROWS = number of MinHash permutations.
+# Candidate probability is ~50% at similarity (1/BANDS)^(1/ROWS) (~0.7 for 16x8).
+NEAR_DUP_BANDS = int(os.getenv("NEAR_DUP_BANDS", 16))
+NEAR_DUP_ROWS = int(os.getenv("NEAR_DUP_ROWS", 8))
+
+# Texts shorter than this (after normalization) are never deduplicated
+NEAR_DUP_MIN_CHARS = int(os.getenv("NEAR_DUP_MIN_CHARS", 20))
+
+SHINGLE_SIZE = 4
+
+_MERSENNE_PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(4334)  # Fixed seed: signatures must be stable across runs
+_PERM_A = _rng.randint(1, _MERSENNE_PRIME, size=NEAR_DUP_BANDS * NEAR_DUP_ROWS).astype(np.int64)
+_PERM_B = _rng.randint(0, _MERSENNE_PRIME, size=NEAR_DUP_BANDS * NEAR_DUP_ROWS).astype(np.int64)
+
+_PUNCT_RE = re.compile(r"[^\w\s]", re.UNICODE)
+_SPACE_RE = re.compile(r"\s+")
+
+
+def dedup_text(collection_name, doc):
+    """
+    The source text the tagging prompt sees for a document (name + description).
+    """
+    if collection_name == "influencers":
+        return f"{doc.get('channel_name', '')} {doc.get('channel_desc', '')}"
+    if collection_name == "brands":
+        return " ".join(str(doc.get(k) or "") for k in
+                        ("name", "industry", "product_category", "target_audience", "positioning"))
+    return f"{doc.get('title') or doc.get('name', '')} {doc.get('description') or ''}"
+
+
+def normalize_text(text):
+    text = unicodedata.normalize("NFKC", str(text or "")).lower()
+    text = _PUNCT_RE.sub(" ", text)
+    return _SPACE_RE.sub(" ", text).strip()
+
+
+def minhash_signature(text):
+    """
+    MinHash signature (NEAR_DUP_BANDS * NEAR_DUP_ROWS ints) over character shingles.
+    Returns None for texts too short to compare safely.
+    """
+    norm = normalize_text(text)
+    if len(norm) < NEAR_DUP_MIN_CHARS:
+        return None
+
+    shingles = {norm[i:i + SHINGLE_SIZE] for i in range(len(norm) - SHINGLE_SIZE + 1)}
+    hashes = np.array(
+        [zlib.crc32(s.encode("utf-8")) % _MERSENNE_PRIME for s in shingles],
+        dtype=np.int64
+    )
+    # (a * x + b) mod p for every permutation x shingle, min over shingles
+    permuted = (_PERM_A[:, None] * hashes[None, :] + _PERM_B[:, None]) % _MERSENNE_PRIME
+    return permuted.min(axis=1).tolist()
+
+
+def lsh_bands(signature):
+    """
+    One bucket key per band; documents sharing any key are candidates.
+    """
+    keys = []
+    for band in range(NEAR_DUP_BANDS):
+        rows = signature[band * NEAR_DUP_ROWS:(band + 1) * NEAR_DUP_ROWS]
+        digest = hashlib.md5(",".join(map(str, rows)).encode()).hexdigest()[:16]
+        keys.append(f"{band}:{digest}")
+    return keys
+
+
+def signature_fields(text):
+    """
+    Fields stored on every tagged document so later near-copies can find it.
+    """
+    signature = minhash_signature(text)
+    if signature is None:
+        return {}
+    return {"minhash": signature, "minhash_bands": lsh_bands(signature)}
+
+
+def estimated_similarity(sig_a, sig_b):
+    if not sig_a or not sig_b or len(sig_a) != len(sig_b):
+        return 0.0
+    return float(np.mean(np.asarray(sig_a) == np.asarray(sig_b)))
+
+
+def ensure_dedup_index(collection):
+    collection.create_index([("minhash_bands", ASCENDING)])
+
+
+def backfill_signatures(collection, kind, batch_size=100):
+    """
+    Adds MinHash signatures to tagged documents written without them (tagged
+    before dedup existed, or by other writers). Texts too short to compare get an
+    empty band list so they are not picked up again.
+    Returns the number of updated documents.
+    """
+    cursor = collection.find(
+        {"structured_tags": {"$exists": True}, "minhash_bands": {"$exists": False}}
+    ).limit(batch_size)
+
+    count = 0
+    for doc in cursor:
+        fields = signature_fields(dedup_text(kind, doc)) or {"minhash": None, "minhash_bands": []}
+        collection.update_one({"_id": doc["_id"]}, {"$set": fields})
+        count += 1
+    return count
+
+
+def copy_from_duplicate(collection, doc, dedup_fields, embedding_dim=None, threshold=None):
+    """
+    Looks up an already tagged near-identical document through the LSH band index.
+    Returns the fields to copy (structured_tags/tags/embedding + provenance and the
+    source's version stamps), or None.
+    The embedding is only copied if it has `embedding_dim` dimensions.
+    """
+    threshold = NEAR_DUP_THRESHOLD if threshold is None else threshold
+    if not dedup_fields or threshold > 1.0:
+        return None
+
+    candidates = collection.find(
+        {
+            "minhash_bands": {"$in": dedup_fields["minhash_bands"]},
+            "_id": {"$ne": doc["_id"]},
+            "structured_tags": {"$exists": True}
+        },
+        {"minhash": 1, "structured_tags": 1, "tags": 1, "embedding": 1,
+         "tagging_version": 1, "prompt_hash": 1, "source_hash": 1, "embed_text_version": 1}
+    ).limit(50)
+
+    best, best_sim = None, 0.0
+    for cand in candidates:
+        sim = estimated_similarity(dedup_fields["minhash"], cand.get("minhash"))
+        if sim > best_sim:
+            best, best_sim = cand, sim
+
+    if best is None or best_sim < threshold:
+        return None
+
+    embedding = best.get("embedding")
+    if embedding and embedding_dim and len(embedding) != embedding_dim:
+        embedding = None
+
+    return {
+        "structured_tags": best["structured_tags"],
+        "tags": best.get("tags", []),
+        "embedding": embedding,
+        "duplicate_of": best["_id"],
+        "duplicate_similarity": round(best_sim, 3),
+        "tagging_version": best.get("tagging_version"),
+        "prompt_hash": best.get("prompt_hash"),
+        "source_hash": best.get("source_hash"),
+        "embed_text_version": best.get("embed_text_version") if embedding else None
+    }
+
+
+def match_in_batch(dedup_fields, leaders, threshold=None):
+    """
+    Finds a near-identical document among `leaders` ([(_id, dedup_fields)], the
+    untagged documents of the same polling batch already queued for tagging).
+    Like copy_from_duplicate, candidates must share an LSH band.
+    Returns (_id, similarity) of the best match, or None.
+    """
+    threshold = NEAR_DUP_THRESHOLD if threshold is None else threshold
+    if not dedup_fields or threshold > 1.0:
+        return None
+
+    bands = set(dedup_fields["minhash_bands"])
+    best, best_sim = None, 0.0
+    for _id, fields in leaders:
+        if not fields or not bands.intersection(fields["minhash_bands"]):
+            continue
+        sim = estimated_similarity(dedup_fields["minhash"], fields["minhash"])
+        if sim > best_sim:
+            best, best_sim = _id, sim
+
+    if best is None or best_sim < threshold:
+        return None
+    return best, round(best_sim, 3)
@@ -0,0 +1,205 @@
+import re
+import math
+import unicodedata
+from pymongo import ASCENDING
+
+# Character n-gram size for fuzzy matching.
+# Bigrams work well for Korean (most words are 2-4 syllables) and are still
+# selective enough for English product names.
+NGRAM_SIZE = 2
+
+# Upper bound on documents pulled from the n-gram index for re-ranking
+FUZZY_CANDIDATE_LIMIT = 200
+
+# Minimum Dice similarity for a fuzzy hit to be returned
+FUZZY_MIN_SCORE = 0.3
+
+_PUNCT_RE = re.compile(r"[^\w\s]", re.UNICODE)
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_name(text):
+    """
+    Normalizes a product name for indexing and lookup.
+    NFKC (full-width -> half-width), lowercase, punctuation stripped, whitespace collapsed.
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", str(text)).lower()
+    text = _PUNCT_RE.sub(" ", text)
+    return _SPACE_RE.sub(" ", text).strip()
+
+
+def char_ngrams(text, n=NGRAM_SIZE):
+    """
+    Returns the set of character n-grams of a normalized name (spaces removed,
+    so '네모 팬티' and '네모팬티' share the same grams).
+    """
+    compact = text.replace(" ", "")
+    if len(compact) < n:
+        return {compact} if compact else set()
+    return {compact[i:i + n] for i in range(len(compact) - n + 1)}
+
+
+def build_search_fields(product_doc):
+    """
+    Builds the indexed search fields for a product document.
+    Both 'name' and 'title' are indexed since products use either.
+    """
+    names = []
+    for raw in (product_doc.get("name"), product_doc.get("title")):
+        norm = normalize_name(raw)
+        if norm and norm not in names:
+            names.append(norm)
+
+    grams = set()
+    for norm in names:
+        grams |= char_ngrams(norm)
+
+    return {
+        "name_norm": names,
+        "name_ngrams": sorted(grams)
+    }
+
+
+def ensure_search_indexes(collection):
+    """
+    Creates the indexes used by search_products (idempotent).
+    """
+    collection.create_index([("name_norm", ASCENDING)])
+    collection.create_index([("name_ngrams", ASCENDING)])
+
+
+def backfill_search_fields(collection, batch_size=100):
+    """
+    Adds search fields to products that were inserted without them.
+    Returns the number of updated documents.
+    """
+    cursor = collection.find(
+        {"name_norm": {"$exists": False}},
+        {"name": 1, "title": 1}
+    ).limit(batch_size)
+
+    count = 0
+    for doc in cursor:
+        collection.update_one({"_id": doc["_id"]}, {"$set": build_search_fields(doc)})
+        count += 1
+    return count
+
+
+def _dice(a, b):
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def _prefix_score(norm_query, names):
+    """
+    0.8 ~ 0.99 for the closest name starting with the query (0.0 if none does).
+    """
+    best = max((len(norm_query) / len(n) for n in names if n.startswith(norm_query)), default=0.0)
+    return 0.8 + 0.19 * best if best else 0.0
+
+
+def _fuzzy_score(query_grams, doc_grams):
+    """
+    Dice coefficient, or containment for partial queries ('네모' should still
+    surface long names), capped below the prefix band.
+    """
+    score = _dice(query_grams, doc_grams)
+    containment = len(query_grams & doc_grams) / len(query_grams)
+    return min(max(score, containment * 0.75), 0.79)
+
+
+def _min_shared_grams(n_query_grams):
+    """
+    Fewest shared grams s (out of q query grams) that can still reach FUZZY_MIN_SCORE m.
+    Dice 2s / (q + d) with d >= s needs s >= m*q / (2 - m), which is below what
+    containment (0.75 * s / q) needs, so it is the bound.
+    """
+    bound = n_query_grams * FUZZY_MIN_SCORE / (2 - FUZZY_MIN_SCORE)
+    return max(1, math.ceil(bound - 1e-9))
+
+
+def search_products(collection, query, limit=5):
+    """
+    Ranked product search over the normalized-name and n-gram indexes.
+
+    1. Exact hit on 'name_norm'                          -> score 1.0
+    2. Anchored prefix on 'name_norm' (index range scan)  -> score 0.8 ~ 0.99
+    3. Fuzzy n-gram overlap (Dice coefficient)           -> score < 0.8
+    4. Raw name/title substring for products not indexed yet (backfilled on the
+       spot and scored with the same rules, so a substring hit never outranks a prefix)
+
+    Returns a list of {"product", "score", "match"} sorted by score DESC.
+    """
+    norm_query = normalize_name(query)
+    if not norm_query:
+        return []
+
+    results = {}
+
+    def add(doc, score, match):
+        prev = results.get(doc["_id"])
+        if prev is None or score > prev["score"]:
+            results[doc["_id"]] = {"product": doc, "score": score, "match": match}
+
+    # --- Step 1: Exact ---
+    for doc in collection.find({"name_norm": norm_query}).limit(limit):
+        add(doc, 1.0, "exact")
+
+    # --- Step 2: Prefix ---
+    # Anchored, escaped regex on a normalized field -> bounded index scan
+    if len(results) < limit:
+        prefix_re = "^" + re.escape(norm_query)
+        for doc in collection.find({"name_norm": {"$regex": prefix_re}}).limit(limit * 4):
+            add(doc, _prefix_score(norm_query, doc.get("name_norm", [])), "prefix")
+
+    # --- Step 3: Fuzzy (character n-grams) ---
+    query_grams = char_ngrams(norm_query)
+    if len(results) < limit and query_grams:
+        # Drop documents that share too few grams to reach FUZZY_MIN_SCORE before
+        # ranking, then keep the candidates with the largest overlap
+        grams = sorted(query_grams)
+        overlap = {"$size": {"$filter": {
+            "input": "$name_ngrams", "as": "g", "cond": {"$in": ["$$g", grams]}
+        }}}
+        cursor = collection.aggregate([
+            {"$match": {"name_ngrams": {"$in": grams}}},
+            {"$match": {"$expr": {"$gte": [overlap, _min_shared_grams(len(grams))]}}},
+            {"$addFields": {"_overlap": overlap}},
+            {"$sort": {"_overlap": -1}},
+            {"$limit": FUZZY_CANDIDATE_LIMIT}
+        ])
+        for doc in cursor:
+            doc.pop("_overlap", None)
+            score = _fuzzy_score(query_grams, set(doc.get("name_ngrams", [])))
+            if score >= FUZZY_MIN_SCORE:
+                add(doc, score, "fuzzy")
+
+    # --- Step 4: Not yet indexed ---
+    # Only products without search fields (inserted since the last backfill): match the
+    # raw name/title (escaped substring, like the old lookup) and index them on the spot.
+    if len(results) < limit:
+        raw_re = re.escape(str(query).strip())
+        cursor = collection.find({
+            "name_norm": {"$exists": False},
+            "$or": [
+                {"name": {"$regex": raw_re, "$options": "i"}},
+                {"title": {"$regex": raw_re, "$options": "i"}}
+            ]
+        }).limit(limit)
+        for doc in cursor:
+            fields = build_search_fields(doc)
+            collection.update_one({"_id": doc["_id"]}, {"$set": fields})
+            doc = {**doc, **fields}
+            prefix = _prefix_score(norm_query, fields["name_norm"])
+            if norm_query in fields["name_norm"]:
+                add(doc, 1.0, "exact")
+            elif prefix:
+                add(doc, prefix, "prefix")
+            elif query_grams:
+                add(doc, _fuzzy_score(query_grams, set(fields["name_ngrams"])), "fuzzy")
+
+    ranked = sorted(results.values(), key=lambda x: x["score"], reverse=True)
+    return ranked[:limit]
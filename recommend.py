@@ -1,51 +1,76 @@
 import sys
+import argparse
 from matching_engine import MatchingEngine
 
 sys.stdout.reconfigure(encoding='utf-8')
 
-def match_product(query_name):
+def match_product(query_name, filters=None):
     engine = MatchingEngine()
     
     # 1. Find the product
     print(f"🔎 상품 검색 중: '{query_name}'...")
-    product = engine.products.find_one({"name": {"$regex": query_name, "$options": "i"}})
-    
-    if not product:
-        # Fallback to verify if it's in 'title' or similar
-        product = engine.products.find_one({"title": {"$regex": query_name, "$options": "i"}})
-        
-    if not product:
+    candidates = engine.search_products(query_name, limit=5)
+
+    if not candidates:
         print(f"❌ 상품을 찾을 수 없습니다.")
         return
 
-    print(f"✅ 상품 발견: {product.get('title') or product.get('name')}")
-    
-    # Check for embedding and wait if missing
+    product = candidates[0]["product"]
+    print(f"✅ 상품 발견: {product.get('title') or product.get('name')} ({candidates[0]['match']}, {candidates[0]['score']:.2f})")
+    if len(candidates) > 1:
+        print("   다른 후보:")
+        for cand in candidates[1:]:
+            cand_doc = cand["product"]
+            print(f"   - {cand_doc.get('title') or cand_doc.get('name')} ({cand['match']}, {cand['score']:.2f})")
+
+    # No embedding yet -> tag/embed it right now instead of waiting for watch_db.py
     if not product.get("embedding"):
-        import time
-        print("⏳ 태깅/임베딩 생성 대기 중 (최대 30초)...")
-        for _ in range(10):  # 10 * 3s = 30s
-            time.sleep(3)
-            # Reload product
-            product = engine.products.find_one({"_id": product["_id"]})
-            if product.get("embedding"):
-                print("✅ 임베딩 생성 완료.")
-                break
+        print("⚡ 임베딩이 없어 즉시 태깅/임베딩을 생성합니다...")
+        product = engine.tag_product_now(product)
+        if product.get("embedding"):
+            print("✅ 임베딩 생성 완료.")
         else:
-            print("⚠️ 경고: 임베딩 생성 시간 초과. 결과가 부정확할 수 있습니다.")
+            print("⚠️ 경고: 임베딩 생성 실패. 결과가 부정확할 수 있습니다.")
 
     print(f"   카테고리: {product.get('structured_tags', {}).get('category')}")
     print("-" * 50)
     
     # 2. Run Matching
-    recommendations = engine.find_influencers_for_product(product, limit=5)
+    response = engine.recommend_for_product(product, limit=5, filters=filters)
+    recommendations = response["results"]
     
     if not recommendations:
         print("❌ 적합한 인플루언서를 찾지 못했습니다.")
         return
 
     # 3. Display Results
-    print(f"🏆 추천 인플루언서 TOP 5:")
+    print_recommendations(recommendations, cache_hit=response["cache_hit"])
+
+def match_brand(brand_name, filters=None):
+    engine = MatchingEngine()
+
+    print(f"🔎 브랜드 검색 중: '{brand_name}'...")
+    brand = engine.brands.find_one({"name": brand_name})
+    if not brand:
+        print(f"❌ 브랜드를 찾을 수 없습니다.")
+        return
+
+    print(f"✅ 브랜드 발견: {brand.get('name')}")
+    print(f"   카테고리: {brand.get('structured_tags', {}).get('industry') or brand.get('industry')}")
+    print("-" * 50)
+
+    # Brand embedding + cached centroid of the catalog -> one vector search
+    recommendations = engine.find_influencers_for_brand(brand, limit=5, filters=filters)
+
+    if not recommendations:
+        print("❌ 적합한 인플루언서를 찾지 못했습니다.")
+        return
+
+    print_recommendations(recommendations)
+
+def print_recommendations(recommendations, cache_hit=False):
+    cache_note = " (캐시 결과)" if cache_hit else ""
+    print(f"🏆 추천 인플루언서 TOP {len(recommendations)}:{cache_note}")
     print("=" * 60)
     
     for i, rec in enumerate(recommendations, 1):
@@ -65,10 +90,37 @@ def match_product(query_name):
         print(f"   📈 참여율 점수: {details['er_score']}")
         print("-" * 60)
 
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="상품에 적합한 인플루언서를 추천합니다.",
+        epilog="Example: python recommend.py 네모팬티 --min-subs 10000 --exclude-industry 게임"
+    )
+    parser.add_argument("product_name", nargs="+", help="검색할 상품명 (--brand 사용 시 브랜드명)")
+    parser.add_argument("--brand", action="store_true", help="브랜드 전체 카탈로그 기준으로 추천")
+    parser.add_argument("--min-subs", type=int, help="최소 구독자 수")
+    parser.add_argument("--max-subs", type=int, help="최대 구독자 수")
+    parser.add_argument("--min-er", type=float, help="최소 참여율 (평균 좋아요 / 구독자, 예: 0.02)")
+    parser.add_argument("--industry", action="append", help="허용 카테고리 (반복 가능)")
+    parser.add_argument("--exclude-industry", action="append", help="제외 카테고리 (반복 가능)")
+    parser.add_argument("--exclude", action="append", help="제외할 인플루언서 _id (반복 가능, 예: 기존 계약)")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python recommend.py <product_name>")
+        print("Usage: python recommend.py <product_name> [--min-subs N] [--max-subs N] [--min-er R] [--industry X] [--exclude-industry X] [--exclude ID]")
         print("Example: python recommend.py 네모팬티")
     else:
-        product_name = " ".join(sys.argv[1:])
-        match_product(product_name)
+        args = parse_args(sys.argv[1:])
+        filters = {
+            "min_subscribers": args.min_subs,
+            "max_subscribers": args.max_subs,
+            "min_er": args.min_er,
+            "industries": args.industry,
+            "exclude_industries": args.exclude_industry,
+            "exclude_ids": args.exclude
+        }
+        filters = {k: v for k, v in filters.items() if v is not None}
+        if args.brand:
+            match_brand(" ".join(args.product_name), filters=filters or None)
+        else:
+            match_product(" ".join(args.product_name), filters=filters or None)
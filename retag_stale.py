@@ -0,0 +1,267 @@
+import os
+import sys
+import time
+import argparse
+from collections import deque
+from pymongo import MongoClient, ASCENDING
+from dotenv import load_dotenv
+from tagging_utils import (
+    generate_tags_batch, get_embedding, embedding_text, flatten_tags,
+    prompt_hash, source_hash, current_tagging_version, version_fields,
+    EMBED_TEXT_VERSION
+)
+from token_usage import PRIORITY_LOW
+from product_search import build_search_fields
+from near_duplicate import dedup_text, signature_fields
+from match_cache import bump_index_version
+from brand_profile import update_brand_centroid, brand_centroid_revision
+
+load_dotenv(override=True)
+
+COLLECTIONS = ["influencers", "brands", "products"]
+
+# Stale documents handled per call (watch_db.py runs one batch per idle cycle)
+RETAG_BATCH_SIZE = int(os.getenv("RETAG_BATCH_SIZE", 8))
+
+# Documents that need API calls (re-tag or re-embed) per rolling hour. Applies
+# even when no TOKEN_BUDGET_* is configured (0 = unlimited).
+RETAG_MAX_DOCS_PER_HOUR = int(os.getenv("RETAG_MAX_DOCS_PER_HOUR", 120))
+
+# tagging_version values written before version tracking. Such documents (without
+# prompt_hash) were tagged with the same prompts, so their tags are kept; the
+# embedding is only kept if embed_text_version shows it was built with the current
+# recipe, otherwise they are re-embedded.
+LEGACY_TAGGING_VERSIONS = {"v1_structured", "v2_structured", "v_poll_1.0", None}
+
+# Actions for a stale document, cheapest first
+ACTION_STAMP = "stamp"      # prompt, source and embedding recipe unchanged -> only the version fields
+ACTION_REEMBED = "reembed"  # only the embedding text recipe changed (or unknown for legacy) -> 1 embedding call
+ACTION_RETAG = "retag"      # prompt or source fields changed -> tags + embedding
+
+
+def ensure_version_index(collection):
+    collection.create_index([("tagging_version", ASCENDING)])
+
+
+def stale_query(kind):
+    """
+    Tagged + embedded documents whose tagging_version is not the current one.
+    Untagged documents are left to watch_db.py, documents in flight in a Batch API
+    job to batch_tagging.py.
+    """
+    return {
+        "tagging_version": {"$ne": current_tagging_version(kind)},
+        "structured_tags": {"$exists": True},
+        "embedding": {"$exists": True, "$ne": None},
+        "batch_pending": {"$exists": False}
+    }
+
+
+def is_legacy(doc):
+    return "prompt_hash" not in doc and doc.get("tagging_version") in LEGACY_TAGGING_VERSIONS
+
+
+def plan_action(kind, doc):
+    if is_legacy(doc):
+        return ACTION_STAMP if doc.get("embed_text_version") == EMBED_TEXT_VERSION else ACTION_REEMBED
+    if doc.get("prompt_hash") != prompt_hash(kind) or doc.get("source_hash") != source_hash(kind, doc):
+        return ACTION_RETAG
+    if doc.get("embed_text_version") != EMBED_TEXT_VERSION:
+        return ACTION_REEMBED
+    return ACTION_STAMP
+
+
+# Timestamps of documents sent to the API within the last hour (this process)
+_api_docs = deque()
+
+
+def _api_allowance():
+    if RETAG_MAX_DOCS_PER_HOUR <= 0:
+        return float("inf")
+    cutoff = time.time() - 3600
+    while _api_docs and _api_docs[0] < cutoff:
+        _api_docs.popleft()
+    return RETAG_MAX_DOCS_PER_HOUR - len(_api_docs)
+
+
+def retag_collection(db, kind, limit=RETAG_BATCH_SIZE, after_id=None):
+    """
+    Reprocesses up to `limit` stale documents of one collection at low priority.
+    Returns ({action: count}, last _id seen) so callers can page through the backlog;
+    counts["deferred"] > 0 means the batch was cut short by RETAG_MAX_DOCS_PER_HOUR.
+    """
+    collection = db[kind]
+    query = stale_query(kind)
+    if after_id is not None:
+        query["_id"] = {"$gt": after_id}
+    docs = list(collection.find(query).sort("_id", ASCENDING).limit(limit))
+
+    counts = {ACTION_STAMP: 0, ACTION_REEMBED: 0, ACTION_RETAG: 0, "failed": 0, "deferred": 0}
+    if not docs:
+        return counts, None
+
+    plans = {doc["_id"]: plan_action(kind, doc) for doc in docs}
+
+    # Own rate limit: stop the batch at the first document over the hourly allowance,
+    # so it stays stale and is picked up (in order) once the window frees up.
+    allowance = _api_allowance()
+    for pos, doc in enumerate(docs):
+        if plans[doc["_id"]] != ACTION_STAMP:
+            if allowance <= 0:
+                counts["deferred"] = len(docs) - pos
+                docs = docs[:pos]
+                break
+            allowance -= 1
+    if not docs:
+        return counts, None
+    _api_docs.extend([time.time()] * sum(plans[d["_id"]] != ACTION_STAMP for d in docs))
+
+    to_retag = [doc for doc in docs if plans[doc["_id"]] == ACTION_RETAG]
+    new_tags = generate_tags_batch(kind, to_retag, priority=PRIORITY_LOW) if to_retag else {}
+
+    for doc in docs:
+        action = plans[doc["_id"]]
+        try:
+            if action == ACTION_STAMP:
+                # Legacy tags are adopted as current (the embedding recipe already is)
+                update_data = version_fields(kind, doc, tagged=is_legacy(doc), embedded=False)
+            else:
+                seed = doc
+                if action == ACTION_RETAG:
+                    tag_data = new_tags.get(doc["_id"])
+                    if not tag_data:
+                        counts["failed"] += 1
+                        continue
+                    seed = {**doc, "structured_tags": tag_data, "tags": flatten_tags(kind, tag_data)}
+
+                embedding = get_embedding(embedding_text(kind, seed), collection=kind, priority=PRIORITY_LOW)
+                if not embedding:
+                    counts["failed"] += 1
+                    continue
+
+                update_data = {
+                    "embedding": embedding,
+                    "embedding_dim": len(embedding),
+                    "last_updated": time.time()
+                }
+                if action == ACTION_RETAG:
+                    update_data["structured_tags"] = seed["structured_tags"]
+                    update_data["tags"] = seed["tags"]
+                    update_data.update(signature_fields(dedup_text(kind, doc)))
+                    if kind == "products":
+                        update_data.update(build_search_fields(doc))
+                # Legacy tags are adopted as current along with the new embedding
+                tagged = action == ACTION_RETAG or is_legacy(doc)
+                update_data.update(version_fields(kind, doc, tagged=tagged))
+
+            centroid_sync = kind == "products" and action != ACTION_STAMP
+            revision = brand_centroid_revision(db, doc) if centroid_sync else None
+            collection.update_one({"_id": doc["_id"]}, {"$set": update_data})
+            if centroid_sync:
+                update_brand_centroid(
+                    db, doc, update_data["embedding"], update_data.get("tags", doc.get("tags")), revision
+                )
+            counts[action] += 1
+        except Exception as e:
+            print(f"  ❌ [Retag] Error on {kind} {doc.get('_id')}: {e}")
+            counts["failed"] += 1
+
+    if kind == "influencers" and counts[ACTION_REEMBED] + counts[ACTION_RETAG] > 0:
+        # Invalidate cached recommendations
+        bump_index_version(db)
+
+    return counts, docs[-1]["_id"]
+
+
+# Per-collection paging position between retag_stale() calls, so documents that
+# keep failing are retried once per pass instead of blocking every batch.
+_cursors = {}
+
+
+def retag_stale(db, limit=RETAG_BATCH_SIZE):
+    """
+    One low-priority batch: the first collection that has stale documents.
+    Returns the number of processed documents (0 = nothing stale).
+    """
+    for kind in COLLECTIONS:
+        counts, last_id = retag_collection(db, kind, limit, after_id=_cursors.get(kind))
+        if last_id is None and counts["deferred"]:
+            # Hourly allowance used up: keep the position and stay idle
+            return 0
+        if last_id is None and _cursors.get(kind) is not None:
+            # End of a pass: start over from the beginning
+            _cursors[kind] = None
+            counts, last_id = retag_collection(db, kind, limit)
+        _cursors[kind] = last_id
+
+        done = counts[ACTION_STAMP] + counts[ACTION_REEMBED] + counts[ACTION_RETAG]
+        if last_id is not None:
+            print(f"  🔁 [Retag] {kind}: {counts}")
+            return done
+    return 0
+
+
+def adopt_current(db, kind):
+    """
+    Stamps legacy documents (tagged before version tracking) as current without
+    any API call, i.e. accepts their existing tags as-is. Embeddings are only
+    accepted if embed_text_version matches the current recipe; the others keep
+    their old tagging_version and are re-embedded by retag_stale().
+    """
+    collection = db[kind]
+    count = 0
+    for doc in collection.find({**stale_query(kind), "prompt_hash": {"$exists": False}}):
+        update_data = version_fields(kind, doc, tagged=True, embedded=False)
+        collection.update_one({"_id": doc["_id"]}, {"$set": update_data})
+        count += 1
+    return count
+
+
+def main():
+    sys.stdout.reconfigure(encoding='utf-8')
+    parser = argparse.ArgumentParser(description="Re-tag documents tagged with an outdated prompt/embedding recipe.")
+    parser.add_argument("--collections", nargs="+", default=COLLECTIONS, choices=COLLECTIONS)
+    parser.add_argument("--batch", type=int, default=RETAG_BATCH_SIZE)
+    parser.add_argument("--pause", type=float, default=1.0, help="Seconds to sleep between batches")
+    parser.add_argument("--adopt-legacy", action="store_true",
+                        help="Mark the tags of documents without version fields as current instead of "
+                             "re-tagging them (embeddings of unknown recipe are still re-embedded)")
+    args = parser.parse_args()
+
+    mongodb_uri = os.getenv("MONGODB_URI")
+    db_name = os.getenv("DB_NAME")
+    if not all([mongodb_uri, db_name]):
+        print("Error: Missing environment variables.")
+        exit(1)
+    db = MongoClient(mongodb_uri)[db_name]
+
+    for kind in args.collections:
+        ensure_version_index(db[kind])
+        print(f"[{kind}] current version: {current_tagging_version(kind)}, "
+              f"stale: {db[kind].count_documents(stale_query(kind))}")
+
+        if args.adopt_legacy:
+            print(f"✅ {kind}: {adopt_current(db, kind)} legacy documents adopted")
+            continue
+
+        totals = {}
+        last_id = None
+        while True:
+            counts, next_id = retag_collection(db, kind, args.batch, after_id=last_id)
+            if next_id is None and counts["deferred"]:
+                print(f"⏸️ RETAG_MAX_DOCS_PER_HOUR ({RETAG_MAX_DOCS_PER_HOUR}) reached. Waiting...")
+                time.sleep(60)
+                continue
+            last_id = next_id
+            if last_id is None:
+                break
+            for action, n in counts.items():
+                if action != "deferred":
+                    totals[action] = totals.get(action, 0) + n
+            print(f"  [{kind}] {totals}")
+            time.sleep(args.pause)
+        print(f"✅ {kind}: {totals or 'nothing stale'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -24,7 +24,9 @@ mongo_client = MongoClient(MONGODB_URI)
 db = mongo_client[DB_NAME]
 collection = db[COLLECTION_NAME]
 
-from tagging_utils import generate_brand_tags
+from tagging_utils import generate_brand_tags, version_fields
+from near_duplicate import dedup_text, signature_fields
+from token_usage import PRIORITY_LOW
 
 # removed local generate_brand_tags definition
 
@@ -48,7 +50,7 @@ def main():
             print("  Skipping: Insufficient data.")
             continue
 
-        tag_data = generate_brand_tags(doc)
+        tag_data = generate_brand_tags(doc, priority=PRIORITY_LOW)
         
         if tag_data:
             print(f"  > Industry: {tag_data.get('industry')}")
@@ -65,9 +67,11 @@ def main():
 
             update_data = {
                 "structured_tags": tag_data,
-                "tags": flat_tags,
-                "tagging_version": "v1_structured"
+                "tags": flat_tags
             }
+            # Any stored embedding was built from the old tags: retag_stale.py re-embeds it
+            update_data.update(version_fields("brands", doc, embedded=False, prior={}))
+            update_data.update(signature_fields(dedup_text("brands", doc)))
 
             collection.update_one(
                 {"_id": doc["_id"]},
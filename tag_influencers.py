@@ -3,6 +3,7 @@ import json
 from pymongo import MongoClient
 from openai import OpenAI
 from dotenv import load_dotenv
+import time
 
 # Load environment variables
 load_dotenv(override=True)
@@ -25,7 +26,10 @@ mongo_client = MongoClient(MONGODB_URI)
 db = mongo_client[DB_NAME]
 collection = db[COLLECTION_NAME]
 
-from tagging_utils import generate_influencer_tags as generate_tags
+from tagging_utils import generate_influencer_tags as generate_tags, version_fields
+from near_duplicate import dedup_text, signature_fields
+from token_usage import PRIORITY_LOW
+from match_cache import bump_index_version
 
 def main():
     print("Starting structured influencer tagging process...")
@@ -56,7 +60,7 @@ def main():
         channel_name = doc.get("title") or doc.get("channel_name", "Unknown")
         combined_text = f"Channel Name: {channel_name}\nDescription: {channel_desc}"
         
-        tag_data = generate_tags(combined_text)
+        tag_data = generate_tags(combined_text, priority=PRIORITY_LOW)
         
         if tag_data:
             print(f"  > Industry: {tag_data.get('industry')}")
@@ -85,8 +89,11 @@ def main():
             update_data = {
                 "structured_tags": tag_data,
                 "tags": flat_tags, # Updating the main tags field with a flattened version for easy indexing
-                "tagging_version": "v2_structured"
+                "last_updated": time.time()
             }
+            # Any stored embedding was built from the old tags: retag_stale.py re-embeds it
+            update_data.update(version_fields("influencers", doc, embedded=False, prior={}))
+            update_data.update(signature_fields(dedup_text("influencers", doc)))
 
             collection.update_one(
                 {"_id": doc["_id"]},
@@ -97,6 +104,10 @@ def main():
         else:
             print("  No tags generated.")
             
+    if updated_count > 0:
+        # Invalidate cached recommendations
+        bump_index_version(db)
+
     print(f"\nProcessing complete.")
     print(f"Total documents processed: {count}")
     print(f"Total documents updated: {updated_count}")
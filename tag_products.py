@@ -2,7 +2,10 @@ import os
 import time
 from pymongo import MongoClient
 from dotenv import load_dotenv
-from tagging_utils import generate_product_tags
+from tagging_utils import generate_product_tags, version_fields
+from near_duplicate import dedup_text, signature_fields
+from token_usage import PRIORITY_LOW
+from brand_profile import update_brand_centroid, brand_centroid_revision
 
 load_dotenv(override=True)
 
@@ -34,7 +37,7 @@ def main():
         name = doc.get("name", "Unknown")
         print(f"Processing: {name} (ID: {doc.get('_id')})")
         
-        tag_data = generate_product_tags(doc)
+        tag_data = generate_product_tags(doc, priority=PRIORITY_LOW)
         
         if tag_data:
             print(f"  > Category: {tag_data.get('category')}")
@@ -58,13 +61,18 @@ def main():
             update_data = {
                 "structured_tags": tag_data,
                 "tags": flat_tags,
-                "tagging_version": "v1_structured"
+                "last_updated": time.time()
             }
+            # Any stored embedding was built from the old tags: retag_stale.py re-embeds it
+            update_data.update(version_fields("products", doc, embedded=False, prior={}))
+            update_data.update(signature_fields(dedup_text("products", doc)))
 
+            revision = brand_centroid_revision(db, doc)
             collection.update_one(
                 {"_id": doc["_id"]},
                 {"$set": update_data}
             )
+            update_brand_centroid(db, doc, new_tags=flat_tags, expected_revision=revision)
             updated_count += 1
             print("  [Saved]")
             
@@ -1,7 +1,9 @@
 import os
 import json
+import hashlib
 from openai import OpenAI
 from dotenv import load_dotenv
+from token_usage import record_usage, wait_for_budget, PRIORITY_NORMAL
 
 # Ensure env vars are loaded with override
 load_dotenv(override=True)
@@ -9,17 +11,27 @@ load_dotenv(override=True)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 client = OpenAI(api_key=OPENAI_API_KEY)
 
-def generate_influencer_tags(channel_data_text):
-    """
-    Generates structured tags for an influencer based on channel data (Name + Description).
-    """
-    if not channel_data_text:
-        return None
+CHAT_MODEL = "gpt-4o-mini"
 
-    prompt = f"""
-    Act as a Senior AI Data Expert specializing in Influencer Marketing in Korea.
-    Analyze the following YouTube channel information and extract a structured "Unified Tag Profile".
-    
+# Embedding size. text-embedding-3-small is 1536-d natively and accepts a smaller
+# `dimensions`; changing EMBEDDING_DIM requires running migrate_embeddings.py.
+EMBEDDING_MODEL = "text-embedding-3-small"
+FULL_EMBEDDING_DIM = 1536
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", FULL_EMBEDDING_DIM))
+
+# --- Prompt building blocks ---
+# Shared by the single-document prompts, the packed multi-document prompt
+# (generate_tags_batch) and offline batch exports, so all paths stay in sync.
+
+INFLUENCER_SYSTEM = "You are an expert data analyst. Output only valid JSON. Ensure all text values are in Korean."
+BRAND_SYSTEM = "You are an expert brand analyst. Output only valid JSON. Ensure all text values are in Korean."
+PRODUCT_SYSTEM = "You are an expert product analyst. Output only valid JSON. Ensure all text values are in Korean."
+
+INFLUENCER_ROLE = "Act as a Senior AI Data Expert specializing in Influencer Marketing in Korea."
+BRAND_ROLE = "Act as a Senior Brand Strategist in Korea."
+PRODUCT_ROLE = "Act as an e-commerce AI Specialist in Korea."
+
+INFLUENCER_GUIDE = """
     CRITICAL INSTRUCTION:
     - If the Channel Name or Description contains explicit keywords, you MUST prioritize them for the 'industry' field.
     - Examples:
@@ -29,11 +41,9 @@ def generate_influencer_tags(channel_data_text):
       - '뷰티', 'Beauty' -> industry: '뷰티'
       - '푸드', 'Food', '요리', '레시피' -> industry: '푸드'
     - Do NOT default to 'Lifestyle' if a specific keyword exists in the title.
-    
-    Channel Data:
-    "{channel_data_text}"
-    
-    Construct a JSON object with the following fields (ALL VALUES MUST BE IN KOREAN):
+    """
+
+INFLUENCER_FIELDS = """
     1. industry: The broader industry (e.g., 뷰티, 패션, 테크, 게임, 푸드, 여행, 라이프스타일, 육아, 키즈, 운동, 자동차 etc).
     2. niche: valid sub-categories (e.g., '저가 코스프레', '가성비 여행', '데스크 셋업').
     3. content_style: The format/vibe (e.g., '브이로그', '상세 리뷰', '튜토리얼', '쇼츠').
@@ -41,30 +51,41 @@ def generate_influencer_tags(channel_data_text):
     5. matching_tags: 5-10 core keywords for matching.
     6. brand_affinity: What kind of brands would be a perfect match?
     7. confidence_score: Confidence (0.0 - 1.0).
+"""
 
-    Output STRICT JSON only.
-    """
+BRAND_FIELDS = """
+    1. industry: Broader industry category.
+    2. product_category: Specific product niche.
+    3. brand_values: 3-5 keywords describing ethos.
+    4. target_demographic: Standardized detailed demographic.
+    5. marketing_goals: Inferred marketing goals.
+    6. influencer_affinity: Types of influencers that match.
+    7. matching_tags: 5-10 core keywords for matching.
+    8. confidence_score: Confidence (0.0 - 1.0).
+"""
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are an expert data analyst. Output only valid JSON. Ensure all text values are in Korean."},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"}
-        )
-        content = response.choices[0].message.content
-        return json.loads(content)
-    except Exception as e:
-        print(f"Error generating influencer tags: {e}")
-        return None
+PRODUCT_FIELDS = """
+    1. category: Refined classification (e.g., '스마트워치', '러닝화'). For ANY vehicle (EV, Hybrid, Car), output '자동차'. If 'Slim9'/'슬림나인'/'편해브라'/'네모팬티', output '패션'. If 'Logitech'/'로지텍', output 'IT'.
+    2. features: List of 3-5 key features. If Slim9, include '편안함', '신축성'. If Logitech, include '반응속도', '내구성'.
+    3. target_audience: Who is this for?
+    4. usage_scenario: When/Where to use? If Slim9, MUST include '운동', '육아', '데일리'. If Logitech, MUST include '게임', '업무'.
+    2. features: List of 3-5 key features (e.g., '방수', '노이즈 캔슬링', '초경량').
+    3. target_audience: Who is this for? (e.g., '2030 직장인', '학생', '게이머').
+    4. usage_scenario: When/Where to use? (e.g., '출퇴근', '운동', '여행').
+    5. matching_tags: 5-10 core keywords for search optimization.
+    6. confidence_score: Confidence (0.0 - 1.0).
+"""
 
-def generate_brand_tags(brand_doc):
+def influencer_tag_input(influencer_doc):
     """
-    Generates structured tags for a brand based on its profile.
+    The channel text the influencer prompt analyzes (Name + Description).
     """
-    context = f"""
+    name = influencer_doc.get("channel_name", "Unknown")
+    desc = influencer_doc.get("channel_desc", "")
+    return f"Channel Name: {name}\nDescription: {desc}"
+
+def brand_context(brand_doc):
+    return f"""
     Brand Name: {brand_doc.get("name", "Unknown")}
     Industry: {brand_doc.get("industry", "")}
     Product Category: {brand_doc.get("product_category", "")}
@@ -72,104 +93,581 @@ def generate_brand_tags(brand_doc):
     Positioning: {brand_doc.get("positioning", "")}
     """
 
+def product_context(product_doc):
+    return f"""
+    Product Name: {product_doc.get("title") or product_doc.get("name", "Unknown Product")}
+    Category (Raw): {product_doc.get("category") or ""}
+    Price: {product_doc.get("price") or ""}
+    Description: {(product_doc.get("description") or "")[:1000]} 
+    """
+
+def build_influencer_messages(channel_data_text):
+    prompt = f"""
+    {INFLUENCER_ROLE}
+    Analyze the following YouTube channel information and extract a structured "Unified Tag Profile".
+    {INFLUENCER_GUIDE}
+    Channel Data:
+    "{channel_data_text}"
+    
+    Construct a JSON object with the following fields (ALL VALUES MUST BE IN KOREAN):{INFLUENCER_FIELDS}
+    Output STRICT JSON only.
+    """
+    return [
+        {"role": "system", "content": INFLUENCER_SYSTEM},
+        {"role": "user", "content": prompt}
+    ]
+
+def build_brand_messages(brand_doc):
     prompt = f"""
-    Act as a Senior Brand Strategist in Korea.
+    {BRAND_ROLE}
     Analyze the following brand profile and extract a structured "Unified Tag Profile".
     
     Brand Profile:
-    "{context}"
+    "{brand_context(brand_doc)}"
     
-    Construct a JSON object with the following fields (ALL VALUES MUST BE IN KOREAN):
-    1. industry: Broader industry category.
-    2. product_category: Specific product niche.
-    3. brand_values: 3-5 keywords describing ethos.
-    4. target_demographic: Standardized detailed demographic.
-    5. marketing_goals: Inferred marketing goals.
-    6. influencer_affinity: Types of influencers that match.
-    7. matching_tags: 5-10 core keywords for matching.
-    8. confidence_score: Confidence (0.0 - 1.0).
+    Construct a JSON object with the following fields (ALL VALUES MUST BE IN KOREAN):{BRAND_FIELDS}
+    Output STRICT JSON only.
+    """
+    return [
+        {"role": "system", "content": BRAND_SYSTEM},
+        {"role": "user", "content": prompt}
+    ]
 
+def build_product_messages(product_doc):
+    prompt = f"""
+    {PRODUCT_ROLE}
+    Analyze the following product information and extract a structured "Unified Tag Profile".
+    
+    Product Info:
+    "{product_context(product_doc)}"
+    
+    Construct a JSON object with the following fields (ALL VALUES MUST BE IN KOREAN):{PRODUCT_FIELDS}
     Output STRICT JSON only.
     """
+    return [
+        {"role": "system", "content": PRODUCT_SYSTEM},
+        {"role": "user", "content": prompt}
+    ]
+
+def chat_request(messages, response_format=None):
+    """
+    Request body for a JSON-mode tagging call (also used for offline batch files).
+    `response_format` overrides plain JSON mode (e.g. a json_schema for packed calls).
+    """
+    return {
+        "model": CHAT_MODEL,
+        "messages": messages,
+        "response_format": response_format or {"type": "json_object"}
+    }
+
+def _chat_json(messages, function, collection, priority, response_format=None):
+    wait_for_budget(priority)
+    response = client.chat.completions.create(**chat_request(messages, response_format))
+    record_usage(function, collection, CHAT_MODEL, response.usage)
+    content = response.choices[0].message.content
+    return json.loads(content)
+
+def generate_influencer_tags(channel_data_text, priority=PRIORITY_NORMAL):
+    """
+    Generates structured tags for an influencer based on channel data (Name + Description).
+    """
+    if not channel_data_text:
+        return None
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are an expert brand analyst. Output only valid JSON. Ensure all text values are in Korean."},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"}
+        return _chat_json(
+            build_influencer_messages(channel_data_text),
+            "generate_influencer_tags", "influencers", priority
+        )
+    except Exception as e:
+        print(f"Error generating influencer tags: {e}")
+        return None
+
+def generate_brand_tags(brand_doc, priority=PRIORITY_NORMAL):
+    """
+    Generates structured tags for a brand based on its profile.
+    """
+    try:
+        return _chat_json(
+            build_brand_messages(brand_doc),
+            "generate_brand_tags", "brands", priority
         )
-        content = response.choices[0].message.content
-        return json.loads(content)
     except Exception as e:
         print(f"Error generating brand tags: {e}")
         return None
 
-def generate_product_tags(product_doc):
+def generate_product_tags(product_doc, priority=PRIORITY_NORMAL):
     """
     Generates structured tags for a product based on its description.
     """
-    context = f"""
-    Product Name: {product_doc.get("title") or product_doc.get("name", "Unknown Product")}
-    Category (Raw): {product_doc.get("category") or ""}
-    Price: {product_doc.get("price") or ""}
-    Description: {(product_doc.get("description") or "")[:1000]} 
+    try:
+        return _chat_json(
+            build_product_messages(product_doc),
+            "generate_product_tags", "products", priority
+        )
+    except Exception as e:
+        print(f"Error generating product tags: {e}")
+        return None
+
+# --- Multi-document packing ---
+# Several documents share one chat request, so the fixed instruction block
+# (most of the prompt tokens) is paid once per batch instead of once per document.
+TAG_BATCH_MAX_ITEMS = int(os.getenv("TAG_BATCH_MAX_ITEMS", 8))
+TAG_BATCH_MAX_INPUT_CHARS = int(os.getenv("TAG_BATCH_MAX_INPUT_CHARS", 6000))
+
+_BATCH_SPECS = {
+    "influencers": {
+        "role": INFLUENCER_ROLE,
+        "system": INFLUENCER_SYSTEM,
+        "entity": "YouTube channel",
+        "guide": INFLUENCER_GUIDE,
+        "fields": INFLUENCER_FIELDS,
+        "required": ("industry", "matching_tags"),
+        "input": influencer_tag_input,
+        "schema": {
+            "industry": "string",
+            "niche": "array",
+            "content_style": "string",
+            "audience_demographic": "string",
+            "matching_tags": "array",
+            "brand_affinity": "string",
+            "confidence_score": "number"
+        }
+    },
+    "brands": {
+        "role": BRAND_ROLE,
+        "system": BRAND_SYSTEM,
+        "entity": "brand profile",
+        "guide": "",
+        "fields": BRAND_FIELDS,
+        "required": ("industry", "matching_tags"),
+        "input": brand_context,
+        "schema": {
+            "industry": "string",
+            "product_category": "string",
+            "brand_values": "array",
+            "target_demographic": "string",
+            "marketing_goals": "array",
+            "influencer_affinity": "array",
+            "matching_tags": "array",
+            "confidence_score": "number"
+        }
+    },
+    "products": {
+        "role": PRODUCT_ROLE,
+        "system": PRODUCT_SYSTEM,
+        "entity": "product",
+        "guide": "",
+        "fields": PRODUCT_FIELDS,
+        "required": ("category", "matching_tags"),
+        "input": product_context,
+        "schema": {
+            "category": "string",
+            "features": "array",
+            "target_audience": "string",
+            "usage_scenario": "array",
+            "matching_tags": "array",
+            "confidence_score": "number"
+        }
+    }
+}
+
+def _batch_input(kind, doc):
+    text = _BATCH_SPECS[kind]["input"](doc)
+    return "\n".join(line.strip() for line in text.strip().splitlines())
+
+def _single_tags(kind, doc, priority):
+    if kind == "influencers":
+        return generate_influencer_tags(influencer_tag_input(doc), priority=priority)
+    if kind == "brands":
+        return generate_brand_tags(doc, priority=priority)
+    return generate_product_tags(doc, priority=priority)
+
+def build_batch_messages(kind, docs):
     """
+    One prompt for several documents of the same kind ('influencers', 'brands', 'products').
+    The model must answer {"items": [{"id": ..., "tags": {...}}]} keyed by document id.
+    """
+    spec = _BATCH_SPECS[kind]
+    entries = [{"id": str(doc["_id"]), "data": _batch_input(kind, doc)} for doc in docs]
 
     prompt = f"""
-    Act as an e-commerce AI Specialist in Korea.
-    Analyze the following product information and extract a structured "Unified Tag Profile".
+    {spec["role"]}
+    Analyze EACH of the following {spec["entity"]} entries independently and extract a structured "Unified Tag Profile" for each.
+    {spec["guide"]}
+    Entries (JSON):
+    {json.dumps(entries, ensure_ascii=False)}
     
-    Product Info:
-    "{context}"
-    
-    Construct a JSON object with the following fields (ALL VALUES MUST BE IN KOREAN):
-    1. category: Refined classification (e.g., '스마트워치', '러닝화'). For ANY vehicle (EV, Hybrid, Car), output '자동차'. If 'Slim9'/'슬림나인'/'편해브라'/'네모팬티', output '패션'. If 'Logitech'/'로지텍', output 'IT'.
-    2. features: List of 3-5 key features. If Slim9, include '편안함', '신축성'. If Logitech, include '반응속도', '내구성'.
-    3. target_audience: Who is this for?
-    4. usage_scenario: When/Where to use? If Slim9, MUST include '운동', '육아', '데일리'. If Logitech, MUST include '게임', '업무'.
-    2. features: List of 3-5 key features (e.g., '방수', '노이즈 캔슬링', '초경량').
-    3. target_audience: Who is this for? (e.g., '2030 직장인', '학생', '게이머').
-    4. usage_scenario: When/Where to use? (e.g., '출퇴근', '운동', '여행').
-    5. matching_tags: 5-10 core keywords for search optimization.
-    6. confidence_score: Confidence (0.0 - 1.0).
+    For EACH entry, construct a JSON object with the following fields (ALL VALUES MUST BE IN KOREAN):{spec["fields"]}
+    Output STRICT JSON only, in exactly this shape, with one item per entry and the ids copied unchanged:
+    {{"items": [{{"id": "<entry id>", "tags": {{<fields above>}}}}]}}
+    """
+    return [
+        {"role": "system", "content": spec["system"]},
+        {"role": "user", "content": prompt}
+    ]
 
-    Output STRICT JSON only.
+def batch_response_format(kind):
     """
+    Strict JSON schema for the packed response: {"items": [{"id", "tags": {fields}}]},
+    so the shape is enforced by the API rather than only described in the prompt.
+    """
+    properties = {}
+    for field, field_type in _BATCH_SPECS[kind]["schema"].items():
+        if field_type == "array":
+            properties[field] = {"type": "array", "items": {"type": "string"}}
+        else:
+            properties[field] = {"type": field_type}
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are an expert product analyst. Output only valid JSON. Ensure all text values are in Korean."},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"}
-        )
-        content = response.choices[0].message.content
-        return json.loads(content)
-    except Exception as e:
-        print(f"Error generating product tags: {e}")
-        return None
+    tags = {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False
+    }
+    item = {
+        "type": "object",
+        "properties": {"id": {"type": "string"}, "tags": tags},
+        "required": ["id", "tags"],
+        "additionalProperties": False
+    }
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": f"{kind}_tag_batch",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {"items": {"type": "array", "items": item}},
+                "required": ["items"],
+                "additionalProperties": False
+            }
+        }
+    }
+
+def validate_tag_item(kind, tags):
+    """
+    True if a tag object has every required field with a usable value.
+    """
+    if not isinstance(tags, dict):
+        return False
+    for field in _BATCH_SPECS[kind]["required"]:
+        value = tags.get(field)
+        if not value or not isinstance(value, (str, list)):
+            return False
+    return True
 
-def get_embedding(text):
+def pack_batches(kind, docs):
+    """
+    Greedily groups documents so each request stays under TAG_BATCH_MAX_INPUT_CHARS
+    of entry data and TAG_BATCH_MAX_ITEMS entries (long descriptions -> smaller batches).
+    """
+    batches, current, current_chars = [], [], 0
+    for doc in docs:
+        size = len(_batch_input(kind, doc))
+        if current and (len(current) >= TAG_BATCH_MAX_ITEMS or current_chars + size > TAG_BATCH_MAX_INPUT_CHARS):
+            batches.append(current)
+            current, current_chars = [], 0
+        current.append(doc)
+        current_chars += size
+    if current:
+        batches.append(current)
+    return batches
+
+def generate_tags_batch(kind, docs, priority=PRIORITY_NORMAL):
+    """
+    Tags several documents with packed requests. Items that are missing or
+    malformed in the response fall back to the single-document call.
+    Returns {doc _id: tag_data or None}.
+    """
+    results = {}
+    for batch in pack_batches(kind, docs):
+        if len(batch) == 1:
+            results[batch[0]["_id"]] = _single_tags(kind, batch[0], priority)
+            continue
+
+        try:
+            data = _chat_json(
+                build_batch_messages(kind, batch), "generate_tags_batch", kind, priority,
+                response_format=batch_response_format(kind)
+            )
+            items = data.get("items", []) if isinstance(data, dict) else []
+        except Exception as e:
+            print(f"Error generating batch tags ({kind}): {e}")
+            items = []
+
+        by_id = {
+            str(item.get("id")): item.get("tags")
+            for item in items if isinstance(item, dict)
+        }
+        for doc in batch:
+            tags = by_id.get(str(doc["_id"]))
+            if validate_tag_item(kind, tags):
+                results[doc["_id"]] = tags
+            else:
+                results[doc["_id"]] = _single_tags(kind, doc, priority)
+    return results
+
+def embedding_request(text, dimensions=None):
+    """
+    Request body for an embedding call (also used for offline batch files).
+    """
+    dimensions = dimensions or EMBEDDING_DIM
+
+    # Simplify text to reduce token usage and noise
+    text = text.replace("\n", " ")[:8000] 
+
+    body = {
+        "input": [text],
+        "model": EMBEDDING_MODEL
+    }
+    if dimensions != FULL_EMBEDDING_DIM:
+        body["dimensions"] = dimensions
+    return body
+
+def get_embedding(text, dimensions=None, collection=None, priority=PRIORITY_NORMAL):
     """
     Generates a vector embedding for the given text using OpenAI 'text-embedding-3-small'.
+    Output size is EMBEDDING_DIM unless `dimensions` is given.
+    `collection` is only used for token accounting.
     """
     if not text:
         return None
 
     try:
-        # Simplify text to reduce token usage and noise
-        text = text.replace("\n", " ")[:8000] 
-        
-        response = client.embeddings.create(
-            input=[text],
-            model="text-embedding-3-small"
-        )
+        wait_for_budget(priority)
+        response = client.embeddings.create(**embedding_request(text, dimensions))
+        record_usage("get_embedding", collection, EMBEDDING_MODEL, response.usage)
         return response.data[0].embedding
     except Exception as e:
         print(f"Error generating embedding: {e}")
         return None
+
+def shorten_embedding(embedding, dimensions):
+    """
+    Truncates a text-embedding-3 vector to `dimensions` and re-normalizes it.
+    For this model family that is equivalent to requesting `dimensions` from the
+    API, so shortened and freshly generated vectors are directly comparable.
+    """
+    if not embedding or len(embedding) < dimensions:
+        return None
+    head = embedding[:dimensions]
+    norm = sum(x * x for x in head) ** 0.5
+    if norm == 0:
+        return None
+    return [x / norm for x in head]
+
+def influencer_embedding_text(influencer_doc, tag_data):
+    """
+    Builds the text that is embedded for an influencer (name + description + matching tags).
+    """
+    name = influencer_doc.get("channel_name", "Unknown")
+    desc = influencer_doc.get("channel_desc", "")
+    tags_list = tag_data.get('matching_tags', []) if tag_data else []
+    if isinstance(tags_list, str): tags_list = [tags_list]
+    return f"{name} {desc} {' '.join(tags_list)}"
+
+def brand_embedding_text(brand_doc, tag_data, flat_tags):
+    """
+    Builds the text that is embedded for a brand (name + industry + product category + tags).
+    """
+    name = brand_doc.get("name", "Unknown")
+    industry = tag_data.get('industry', '') if tag_data else ''
+    prod_cat = tag_data.get('product_category', '') if tag_data else ''
+    tags_str = " ".join(flat_tags)
+    return f"{name} {industry} {prod_cat} {tags_str}"
+
+def flatten_influencer_tags(tag_data):
+    """
+    Flattens structured influencer tags (industry + niche + matching tags).
+    """
+    if not tag_data:
+        return []
+
+    niche = tag_data.get('niche', [])
+    if isinstance(niche, str): niche = [niche]
+    
+    matching = tag_data.get('matching_tags', [])
+    if isinstance(matching, str): matching = [matching]
+
+    flat_tags = list(set(
+        [tag_data.get('industry', '')] + 
+        niche + 
+        matching
+    ))
+    return [t for t in flat_tags if t]
+
+def flatten_brand_tags(tag_data):
+    """
+    Flattens structured brand tags (industry + product category + values + matching tags).
+    """
+    if not tag_data:
+        return []
+
+    b_vals = tag_data.get('brand_values', [])
+    if isinstance(b_vals, str): b_vals = [b_vals]
+    
+    matching = tag_data.get('matching_tags', [])
+    if isinstance(matching, str): matching = [matching]
+
+    flat_tags = list(set(
+        [tag_data.get('industry', '')] + 
+        [tag_data.get('product_category', '')] +
+        b_vals +
+        matching
+    ))
+    return [t for t in flat_tags if t]
+
+def flatten_tags(kind, tag_data):
+    """
+    Flattens structured tags for 'influencers', 'brands' or 'products'.
+    """
+    if kind == "influencers":
+        return flatten_influencer_tags(tag_data)
+    if kind == "brands":
+        return flatten_brand_tags(tag_data)
+    return flatten_product_tags(tag_data)
+
+def flatten_product_tags(tag_data):
+    """
+    Flattens structured product tags into the 'tags' list used for keyword matching.
+    """
+    if not tag_data:
+        return []
+
+    cat = tag_data.get('category', '')
+    feats = tag_data.get('features', [])
+    usage = tag_data.get('usage_scenario', [])
+    matching = tag_data.get('matching_tags', [])
+
+    if isinstance(feats, str): feats = [feats]
+    if isinstance(usage, str): usage = [usage]
+    if isinstance(matching, str): matching = [matching]
+
+    flat_tags = list(set([cat] + feats + usage + matching))
+    return [t for t in flat_tags if t]
+
+def product_embedding_text(product_doc, tag_data, flat_tags):
+    """
+    Builds the text that is embedded for a product (name + category + description + tags).
+    """
+    name = product_doc.get("title") or product_doc.get("name", "Unknown")
+    cat_text = tag_data.get('category', '') if tag_data else product_doc.get('category', '')
+    desc = product_doc.get("description", "")
+    tags_str = " ".join(flat_tags)
+    return f"{name} {cat_text} {desc} {tags_str}"
+
+def embedding_text(kind, doc):
+    """
+    Rebuilds the embedding text watch_db.py uses for a tagged document.
+    """
+    tag_data = doc.get("structured_tags")
+    if not tag_data:
+        return None
+    if kind == "influencers":
+        return influencer_embedding_text(doc, tag_data)
+    if kind == "brands":
+        return brand_embedding_text(doc, tag_data, doc.get("tags", []))
+    return product_embedding_text(doc, tag_data, doc.get("tags", []))
+
+def build_tag_messages(kind, doc):
+    """
+    Single-document tagging messages for 'influencers', 'brands' or 'products'.
+    """
+    if kind == "influencers":
+        return build_influencer_messages(influencer_tag_input(doc))
+    if kind == "brands":
+        return build_brand_messages(doc)
+    return build_product_messages(doc)
+
+def tag_and_embed_product(product_doc, priority=PRIORITY_NORMAL):
+    """
+    Tags (if needed) and embeds a single product synchronously.
+    Returns the fields to $set on the document, or None on failure.
+    """
+    tag_data = product_doc.get("structured_tags")
+    flat_tags = product_doc.get("tags", [])
+
+    if not tag_data:
+        tag_data = generate_product_tags(product_doc, priority=priority)
+        flat_tags = flatten_product_tags(tag_data)
+
+    if not tag_data:
+        return None
+
+    embedding = get_embedding(
+        product_embedding_text(product_doc, tag_data, flat_tags),
+        collection="products",
+        priority=priority
+    )
+    if not embedding:
+        return None
+
+    return {
+        "structured_tags": tag_data,
+        "tags": flat_tags,
+        "embedding": embedding,
+        "embedding_dim": len(embedding)
+    }
+
+# --- Tagging / embedding versions ---
+# Stored on every tagged document so retag_stale.py can find outdated ones:
+#   tagging_version    TAGGING_VERSION.<prompt hash>.EMBED_TEXT_VERSION (indexed, used for the stale query)
+#   prompt_hash        hash of the rendered prompt templates for the collection
+#   embed_text_version embedding text recipe the vector was built from
+#   source_hash        hash of the document fields the prompt/embedding text read
+# Bump TAGGING_VERSION to force re-tagging; prompt edits change the hash automatically.
+# Bump EMBED_TEXT_VERSION when *_embedding_text or EMBEDDING_MODEL changes (re-embeds only, no chat calls).
+TAGGING_VERSION = "v3"
+EMBED_TEXT_VERSION = "e1"
+
+SOURCE_FIELDS = {
+    "influencers": ("channel_name", "channel_desc"),
+    "brands": ("name", "industry", "product_category", "target_audience", "positioning"),
+    "products": ("title", "name", "category", "price", "description")
+}
+
+_prompt_hashes = {}
+
+def _hash(value):
+    return hashlib.sha1(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+def prompt_hash(kind):
+    """
+    Hash of the single-document and packed prompts (rendered for an empty document)
+    plus the model settings, so any template edit marks existing tags as stale.
+    """
+    if kind not in _prompt_hashes:
+        placeholder = {"_id": ""}
+        _prompt_hashes[kind] = _hash([
+            TAGGING_VERSION,
+            chat_request(build_tag_messages(kind, placeholder)),
+            chat_request(build_batch_messages(kind, [placeholder]), batch_response_format(kind))
+        ])
+    return _prompt_hashes[kind]
+
+def current_tagging_version(kind):
+    return f"{TAGGING_VERSION}.{prompt_hash(kind)[:8]}.{EMBED_TEXT_VERSION}"
+
+def source_hash(kind, doc):
+    return _hash([doc.get(field) for field in SOURCE_FIELDS[kind]])
+
+def version_fields(kind, doc, tagged=True, embedded=True, prior=None):
+    """
+    Version fields to $set with a tagging update of `doc`.
+    `tagged`/`embedded` say whether the tags/embedding were generated now with the
+    current recipes; otherwise the stamps are kept from `prior` (the stored document,
+    or the near-duplicate the data was copied from). tagging_version only becomes
+    current when both parts are current.
+    """
+    prior = doc if prior is None else prior
+    fields = {
+        "prompt_hash": prompt_hash(kind) if tagged else prior.get("prompt_hash"),
+        "source_hash": source_hash(kind, doc) if tagged else prior.get("source_hash"),
+        "embed_text_version": EMBED_TEXT_VERSION if embedded else prior.get("embed_text_version")
+    }
+    if fields["prompt_hash"] == prompt_hash(kind) and fields["embed_text_version"] == EMBED_TEXT_VERSION:
+        fields["tagging_version"] = current_tagging_version(kind)
+    else:
+        fields["tagging_version"] = prior.get("tagging_version")
+    return fields
@@ -0,0 +1,30 @@
+import os
+
+import pytest
+
+# Modules read these at import time; nothing here talks to a real server
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test")
+
+import token_usage  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    """
+    In-memory MongoDB (mongomock) plus a throwaway token usage store.
+    """
+    mongomock = pytest.importorskip("mongomock")
+    from mongomock.collection import BulkOperationBuilder
+
+    # mongomock 4.x predates the `sort` argument newer pymongo passes for UpdateOne
+    add_update = BulkOperationBuilder.add_update
+
+    def add_update_compat(self, *args, sort=None, **kwargs):
+        return add_update(self, *args, **kwargs)
+
+    monkeypatch.setattr(BulkOperationBuilder, "add_update", add_update_compat)
+    monkeypatch.setattr(token_usage, "TOKEN_USAGE_DB", str(tmp_path / "usage.db"))
+    monkeypatch.setattr(token_usage, "_initialized", False)
+    return mongomock.MongoClient()["test"]
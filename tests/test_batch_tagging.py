@@ -0,0 +1,249 @@
+import json
+import os
+import time
+
+import pytest
+
+import token_usage
+import batch_tagging
+import retag_stale
+import watch_db
+
+
+def _product(db, title, brand_id):
+    return db["products"].insert_one({
+        "title": title,
+        "description": "편안한 착용감의 데일리 속옷",
+        "brand_id": brand_id
+    }).inserted_id
+
+
+def _tag_line(doc_id, tags):
+    body = {
+        "model": "gpt-4o-mini",
+        "usage": {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150},
+        "choices": [{"message": {"content": json.dumps(tags, ensure_ascii=False)}}]
+    }
+    return {
+        "custom_id": batch_tagging.make_custom_id("tags", "products", doc_id),
+        "response": {"status_code": 200, "body": body},
+        "error": None
+    }
+
+
+def _embed_line(doc_id, embedding=(0.1, 0.2)):
+    body = {
+        "model": "text-embedding-3-small",
+        "usage": {"prompt_tokens": 10, "total_tokens": 10},
+        "data": [{"embedding": list(embedding)}]
+    }
+    return {
+        "custom_id": batch_tagging.make_custom_id("embed", "products", doc_id),
+        "response": {"status_code": 200, "body": body},
+        "error": None
+    }
+
+
+def _write_results(path, lines):
+    with open(path, "w", encoding="utf-8") as f:
+        for line in lines:
+            f.write((line if isinstance(line, str) else json.dumps(line, ensure_ascii=False)) + "\n")
+
+
+VALID_TAGS = {"category": "패션", "features": ["편안함"], "usage_scenario": ["데일리"], "matching_tags": ["속옷"]}
+
+
+def test_import_twice_is_idempotent(db, tmp_path):
+    brand_id = db["brands"].insert_one({"name": "B"}).inserted_id
+    ok_a = _product(db, "네모팬티 A", brand_id)
+    ok_b = _product(db, "네모팬티 B", brand_id)
+    bad = _product(db, "네모팬티 C", brand_id)
+    failed = _product(db, "네모팬티 D", brand_id)
+
+    results = tmp_path / "results.jsonl"
+    _write_results(results, [
+        _tag_line(ok_a, VALID_TAGS),
+        _tag_line(ok_b, VALID_TAGS),
+        _tag_line(bad, {"category": ""}),  # malformed tag object
+        {
+            "custom_id": batch_tagging.make_custom_id("tags", "products", failed),
+            "response": None,
+            "error": {"code": "server_error", "message": "boom"}
+        },
+        "not json"
+    ])
+
+    first = batch_tagging.import_results(db, str(results), chunk_size=2)
+    assert first == {"valid": 2, "imported": 2, "skipped": 0, "failed": 3}
+    assert set(db["products"].find_one({"_id": ok_a})["tags"]) == {"속옷", "데일리", "편안함", "패션"}
+    assert "structured_tags" not in db["products"].find_one({"_id": bad})
+    assert "structured_tags" not in db["products"].find_one({"_id": failed})
+    assert "product_centroid" in db["brands"].find_one({"_id": brand_id})
+
+    # Full re-import (checkpoint removed): nothing is written or counted again
+    os.remove(str(results) + ".progress")
+    second = batch_tagging.import_results(db, str(results), chunk_size=2)
+    assert second == {"valid": 2, "imported": 0, "skipped": 2, "failed": 3}
+
+    calls = sum(row[3] for row in token_usage.usage_summary(days=1))
+    total = sum(row[6] for row in token_usage.usage_summary(days=1))
+    assert (calls, total) == (2, 300)
+    # Offline usage does not count against the live budget
+    assert token_usage.tokens_used(token_usage._current_hour()) == 0
+
+
+def test_dry_run_writes_nothing(db, tmp_path):
+    brand_id = db["brands"].insert_one({"name": "B"}).inserted_id
+    doc_id = _product(db, "네모팬티 A", brand_id)
+    results = tmp_path / "results.jsonl"
+    _write_results(results, [_tag_line(doc_id, VALID_TAGS)])
+
+    stats = batch_tagging.import_results(db, str(results), dry_run=True)
+    assert stats == {"valid": 1, "imported": 0, "skipped": 0, "failed": 0}
+    assert "structured_tags" not in db["products"].find_one({"_id": doc_id})
+    assert not os.path.exists(str(results) + ".progress")
+
+
+def test_resume_rebuilds_brands_from_earlier_chunks(db, tmp_path, monkeypatch):
+    brand_a = db["brands"].insert_one({"name": "A"}).inserted_id
+    brand_b = db["brands"].insert_one({"name": "B"}).inserted_id
+    doc_a = _product(db, "네모팬티 A", brand_a)
+    doc_b = _product(db, "네모팬티 B", brand_b)
+    results = tmp_path / "results.jsonl"
+    _write_results(results, [_tag_line(doc_a, VALID_TAGS), _tag_line(doc_b, VALID_TAGS)])
+
+    apply_chunk = batch_tagging._apply_chunk
+    calls = []
+
+    def crash_on_second_chunk(*args):
+        calls.append(1)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        return apply_chunk(*args)
+
+    monkeypatch.setattr(batch_tagging, "_apply_chunk", crash_on_second_chunk)
+    with pytest.raises(KeyboardInterrupt):
+        batch_tagging.import_results(db, str(results), chunk_size=1)
+    monkeypatch.setattr(batch_tagging, "_apply_chunk", apply_chunk)
+
+    stats = batch_tagging.import_results(db, str(results), chunk_size=1)
+    assert stats["imported"] == 1
+    assert "product_centroid" in db["brands"].find_one({"_id": brand_a})
+    assert "product_centroid" in db["brands"].find_one({"_id": brand_b})
+
+
+@pytest.fixture
+def live(db, monkeypatch):
+    """
+    watch_db.py on the same database; returns the list of live API calls it made.
+    """
+    calls = []
+
+    def api(name):
+        def call(*args, **kwargs):
+            calls.append(name)
+            return None
+        return call
+
+    monkeypatch.setattr(watch_db, "db", db)
+    monkeypatch.setattr(watch_db, "generate_tags_batch", lambda kind, docs, priority=None:
+                        calls.extend(["tags"] * len(docs)) or {})
+    monkeypatch.setattr(watch_db, "get_embedding", api("embedding"))
+    monkeypatch.setattr(watch_db, "tag_and_embed_product", api("tag_and_embed"))
+    monkeypatch.setattr(watch_db.time, "sleep", lambda seconds: None)
+    return calls
+
+
+def test_export_marks_documents_in_flight(db, tmp_path, live):
+    brand_id = db["brands"].insert_one({"name": "B"}).inserted_id
+    ids = [_product(db, f"네모팬티 {i}", brand_id) for i in range(3)]
+    out = tmp_path / "requests_tags.jsonl"
+
+    assert batch_tagging.export_requests(db, "products", "tags", str(out), limit=2) == 2
+    with open(out, encoding="utf-8") as f:
+        exported = [batch_tagging.parse_custom_id(json.loads(line)["custom_id"])[2] for line in f]
+    assert exported == ids[:2]
+    for doc_id in ids[:2]:
+        assert db["products"].find_one({"_id": doc_id})["batch_pending"] == "requests_tags.jsonl"
+    assert "batch_pending" not in db["products"].find_one({"_id": ids[2]})
+
+    # Not tagged live while the job runs, and not exported again
+    watch_db.process_products()
+    assert live == ["tags"]  # only the document that was not exported
+    assert batch_tagging.export_requests(db, "products", "tags", str(tmp_path / "again.jsonl")) == 1
+
+
+def test_tags_import_waits_for_the_embed_phase(db, tmp_path, live):
+    brand_id = db["brands"].insert_one({"name": "B"}).inserted_id
+    doc_id = _product(db, "네모팬티 A", brand_id)
+    batch_tagging.export_requests(db, "products", "tags", str(tmp_path / "requests_tags.jsonl"))
+    results = tmp_path / "results_tags.jsonl"
+    _write_results(results, [_tag_line(doc_id, VALID_TAGS)])
+    batch_tagging.import_results(db, str(results))
+
+    doc = db["products"].find_one({"_id": doc_id})
+    assert doc["batch_pending"] == batch_tagging.BATCH_AWAITING_EMBED
+    # Tagged but not embedded: watch_db.py does not embed it in real time
+    watch_db.process_products()
+    assert live == []
+
+    out = tmp_path / "requests_embed.jsonl"
+    assert batch_tagging.export_requests(db, "products", "embed", str(out)) == 1
+    assert db["products"].find_one({"_id": doc_id})["batch_pending"] == "requests_embed.jsonl"
+    assert batch_tagging.export_requests(db, "products", "embed", str(tmp_path / "again.jsonl")) == 0
+
+    results = tmp_path / "results_embed.jsonl"
+    _write_results(results, [_embed_line(doc_id)])
+    assert batch_tagging.import_results(db, str(results))["imported"] == 1
+    doc = db["products"].find_one({"_id": doc_id})
+    assert doc["embedding"] == [0.1, 0.2]
+    assert "batch_pending" not in doc and "batch_pending_at" not in doc
+
+
+def test_failed_lines_are_released(db, tmp_path):
+    brand_id = db["brands"].insert_one({"name": "B"}).inserted_id
+    ok = _product(db, "네모팬티 A", brand_id)
+    failed = _product(db, "네모팬티 B", brand_id)
+    batch_tagging.export_requests(db, "products", "tags", str(tmp_path / "requests_tags.jsonl"))
+
+    results = tmp_path / "results_tags.jsonl"
+    _write_results(results, [
+        _tag_line(ok, VALID_TAGS),
+        {
+            "custom_id": batch_tagging.make_custom_id("tags", "products", failed),
+            "response": None,
+            "error": {"code": "server_error", "message": "boom"}
+        }
+    ])
+
+    # Dry runs leave the markers alone
+    batch_tagging.import_results(db, str(results), dry_run=True)
+    assert db["products"].find_one({"_id": failed})["batch_pending"] == "requests_tags.jsonl"
+
+    batch_tagging.import_results(db, str(results))
+    assert db["products"].find_one({"_id": ok})["batch_pending"] == batch_tagging.BATCH_AWAITING_EMBED
+    assert "batch_pending" not in db["products"].find_one({"_id": failed})
+
+
+def test_expired_jobs_are_released(db, tmp_path):
+    brand_id = db["brands"].insert_one({"name": "B"}).inserted_id
+    old = _product(db, "네모팬티 A", brand_id)
+    batch_tagging.export_requests(db, "products", "tags", str(tmp_path / "old.jsonl"))
+    db["products"].update_one({"_id": old}, {"$set": {"batch_pending_at": time.time() - 2 * 86400}})
+    recent = _product(db, "네모팬티 B", brand_id)
+    batch_tagging.export_requests(db, "products", "tags", str(tmp_path / "recent.jsonl"))
+
+    assert batch_tagging.release_expired_batches(db) == 1
+    assert "batch_pending" not in db["products"].find_one({"_id": old})
+    assert db["products"].find_one({"_id": recent})["batch_pending"] == "recent.jsonl"
+
+
+def test_retagger_skips_documents_in_flight(db, tmp_path):
+    doc_id = db["products"].insert_one({
+        "title": "네모팬티", "structured_tags": VALID_TAGS, "tags": ["속옷"],
+        "embedding": [0.1, 0.2], "tagging_version": "old", "prompt_hash": "old"
+    }).inserted_id
+    assert db["products"].count_documents(retag_stale.stale_query("products")) == 1
+
+    db["products"].update_one({"_id": doc_id}, {"$set": {"batch_pending": "requests_tags.jsonl"}})
+    assert db["products"].count_documents(retag_stale.stale_query("products")) == 0
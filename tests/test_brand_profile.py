@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+import brand_profile
+from brand_profile import (
+    brand_centroid_revision, rebuild_brand_centroid, update_brand_centroid, verify_brand_centroid
+)
+
+
+@pytest.fixture
+def brand_id(db):
+    return db["brands"].insert_one({"name": "슬림나인"}).inserted_id
+
+
+def _centroid(db, brand_id):
+    return db["brands"].find_one({"_id": brand_id})["product_centroid"]
+
+
+def _same(a, b):
+    assert np.allclose(a["sum"], b["sum"])
+    assert a["count"] == b["count"]
+    assert sorted((t["tag"], t["count"]) for t in a["tag_counts"]) == \
+        sorted((t["tag"], t["count"]) for t in b["tag_counts"])
+
+
+def _write(db, product, embedding, tags):
+    """
+    Writes a product the way watch_db.py does: revision first, then the product, then the delta.
+    """
+    revision = brand_centroid_revision(db, product)
+    db["products"].update_one({"_id": product["_id"]}, {"$set": {"embedding": embedding, "tags": tags}})
+    update_brand_centroid(db, product, embedding, tags, revision)
+
+
+def test_incremental_updates_match_rebuild(db, brand_id):
+    products = []
+    for i in range(3):
+        doc = {"brand_id": brand_id, "title": f"p{i}"}
+        doc["_id"] = db["products"].insert_one(dict(doc)).inserted_id
+        products.append(doc)
+
+    _write(db, products[0], [1.0, 0.0], ["속옷"])        # first product -> initial rebuild
+    _write(db, products[1], [0.0, 2.0], ["속옷", "데일리"])  # incremental add
+    _write(db, products[2], [3.0, 3.0], ["운동"])
+    # Re-embed + re-tag: the old vector/tags are subtracted
+    old = db["products"].find_one({"_id": products[1]["_id"]})
+    _write(db, old, [5.0, 5.0], ["데일리"])
+
+    incremental = _centroid(db, brand_id)
+    assert incremental["count"] == 3
+    assert np.allclose(incremental["sum"], [9.0, 8.0])
+    _same(incremental, rebuild_brand_centroid(db, db["brands"].find_one({"_id": brand_id})))
+
+
+def test_rebuild_between_write_and_delta_is_not_counted_twice(db, brand_id):
+    first = {"brand_id": brand_id}
+    first["_id"] = db["products"].insert_one(dict(first)).inserted_id
+    _write(db, first, [1.0, 1.0], ["a"])
+
+    second = {"brand_id": brand_id}
+    second["_id"] = db["products"].insert_one(dict(second)).inserted_id
+    revision = brand_centroid_revision(db, second)
+    db["products"].update_one({"_id": second["_id"]}, {"$set": {"embedding": [2.0, 2.0], "tags": ["b"]}})
+    # A rebuild (e.g. a batch import) runs before this writer applies its delta
+    rebuild_brand_centroid(db, db["brands"].find_one({"_id": brand_id}))
+    update_brand_centroid(db, second, [2.0, 2.0], ["b"], revision)
+
+    centroid = _centroid(db, brand_id)
+    assert centroid["count"] == 2
+    assert np.allclose(centroid["sum"], [3.0, 3.0])
+
+
+def test_rebuild_retries_when_an_update_lands_during_the_scan(db, brand_id, monkeypatch):
+    doc = {"brand_id": brand_id}
+    doc["_id"] = db["products"].insert_one(dict(doc)).inserted_id
+    _write(db, doc, [1.0, 0.0], ["a"])
+
+    late = {"brand_id": brand_id}
+    late["_id"] = db["products"].insert_one(dict(late)).inserted_id
+    query_for_brand = brand_profile.products_query_for_brand
+    scans = []
+
+    def scan_then_concurrent_write(brand_doc):
+        scans.append(1)
+        if len(scans) == 1:
+            # Another writer finishes its product write + delta before the rebuild stores
+            _write(db, late, [0.0, 1.0], ["b"])
+        return query_for_brand(brand_doc)
+
+    monkeypatch.setattr(brand_profile, "products_query_for_brand", scan_then_concurrent_write)
+    centroid = rebuild_brand_centroid(db, db["brands"].find_one({"_id": brand_id}))
+    assert len(scans) == 2
+    assert centroid["count"] == 2
+    assert np.allclose(_centroid(db, brand_id)["sum"], [1.0, 1.0])
+
+
+def test_deleted_products_trigger_a_rebuild(db, brand_id):
+    ids = []
+    for vec in ([1.0, 0.0], [0.0, 1.0]):
+        doc = {"brand_id": brand_id}
+        doc["_id"] = db["products"].insert_one(dict(doc)).inserted_id
+        _write(db, doc, vec, ["a"])
+        ids.append(doc["_id"])
+
+    brand = db["brands"].find_one({"_id": brand_id})
+    assert verify_brand_centroid(db, brand)["count"] == 2
+
+    db["products"].delete_one({"_id": ids[0]})
+    centroid = verify_brand_centroid(db, db["brands"].find_one({"_id": brand_id}))
+    assert centroid["count"] == 1
+    assert np.allclose(centroid["sum"], [0.0, 1.0])
+    assert centroid["tag_counts"] == [{"tag": "a", "count": 1}]
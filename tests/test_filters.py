@@ -0,0 +1,105 @@
+import pytest
+
+from matching_engine import MatchingEngine, normalize_category
+
+INFLUENCERS = [
+    # name, industry, subscribers, avg_likes
+    ("yoga", "요가", 5000, 400),
+    ("run", "러닝 크루", 120000, 1200),
+    ("fashion", "패션", 800000, 40000),
+    ("game", "게임", 30000, 30),
+    ("no-stats", "패션", None, None),
+    ("zero", "운동", 0, 0),
+    ("mid", "뷰티", 50000, 2500),
+]
+
+FILTERS = [
+    {"min_subscribers": 10000},
+    {"max_subscribers": 50000},
+    {"min_subscribers": 0, "max_subscribers": 50000},
+    {"min_subscribers": 10000, "max_subscribers": 200000},
+    {"min_er": 0.02},
+    {"min_er": 0.05, "max_subscribers": 100000},
+    {"industries": ["운동"]},
+    {"industries": ["패션", "뷰티"], "min_subscribers": 1000},
+    {"exclude_industries": ["운동"]},
+    {"exclude_industries": ["게임"], "min_er": 0.01},
+]
+
+
+@pytest.fixture
+def ids(db):
+    result = {}
+    for name, industry, subscribers, avg_likes in INFLUENCERS:
+        stats = {}
+        if subscribers is not None:
+            stats = {"subscribers": subscribers, "avg_likes": avg_likes}
+        result[name] = db["influencers"].insert_one({
+            "channel_name": name,
+            "tags": ["데일리", "운동"],
+            "embedding": [1.0, float(len(name))],
+            "structured_tags": {"industry": industry},
+            "stats": stats,
+            "last_updated": 1.0
+        }).inserted_id
+    return result
+
+
+PRODUCT = {"_id": "p", "name": "레깅스", "tags": ["데일리", "운동"], "embedding": [1.0, 2.0],
+           "structured_tags": {"category": "운동"}}
+
+
+def _expected(db, filters):
+    """
+    Unfiltered ranking, filtered afterwards (what callers did before pushdown).
+    """
+    ranked = MatchingEngine(db=db).find_influencers_for_product(PRODUCT, limit=100)
+    kept = []
+    for r in ranked:
+        stats = r["influencer"].get("stats") or {}
+        subs = stats.get("subscribers") or 0
+        er = (stats.get("avg_likes") or 0) / max(subs, 1)
+        category = normalize_category(r["details"]["industry"])
+        if filters.get("min_subscribers") is not None and subs < filters["min_subscribers"]:
+            continue
+        if filters.get("max_subscribers") is not None and subs > filters["max_subscribers"]:
+            continue
+        if filters.get("min_er") is not None and er < filters["min_er"]:
+            continue
+        if filters.get("industries") and category not in map(normalize_category, filters["industries"]):
+            continue
+        if category in map(normalize_category, filters.get("exclude_industries") or []):
+            continue
+        kept.append(r["influencer"]["channel_name"])
+    return kept
+
+
+@pytest.mark.parametrize("use_index", [True, False])
+@pytest.mark.parametrize("filters", FILTERS)
+def test_filters_applied_before_scoring(db, ids, use_index, filters):
+    engine = MatchingEngine(db=db, use_index=use_index)
+    results = engine.find_influencers_for_product(PRODUCT, limit=100, filters=filters)
+    assert [r["influencer"]["channel_name"] for r in results] == _expected(db, filters)
+
+
+@pytest.mark.parametrize("use_index", [True, False])
+def test_exclude_ids(db, ids, use_index):
+    engine = MatchingEngine(db=db, use_index=use_index)
+    # ObjectIds and their string form (CLI) are both accepted
+    filters = {"exclude_ids": [ids["yoga"], str(ids["fashion"])]}
+    names = {r["influencer"]["channel_name"] for r in engine.find_influencers_for_product(PRODUCT, 100, filters=filters)}
+    assert names == {name for name, *_ in INFLUENCERS} - {"yoga", "fashion"}
+
+
+def test_subscriber_index_created_at_startup(db, ids, monkeypatch):
+    engine = MatchingEngine(db=db, use_index=False)
+    assert any(
+        key == [("stats.subscribers", 1)] for key in
+        (info["key"] for info in db["influencers"].index_information().values())
+    )
+
+    def no_index(*args, **kwargs):
+        raise AssertionError("create_index called per query")
+
+    monkeypatch.setattr(engine.influencers, "create_index", no_index)
+    assert engine.find_influencers_for_product(PRODUCT, filters={"min_subscribers": 1000})
@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+
+import influencer_index
+from influencer_index import InfluencerIndex
+from match_cache import bump_index_version, get_index_version
+from matching_engine import CATEGORY_SYNONYMS, MatchingEngine, normalize_category
+
+TAG_POOL = ["속옷", "데일리", "운동", "요가", "캠핑", "뷰티", "게임", "여행", "육아", "패션"]
+INDUSTRIES = ["운동", "패션", "뷰티", "게임", ""]
+
+
+def _fixture(db, n=40, dim=8, seed=7):
+    rng = np.random.RandomState(seed)
+    for i in range(n):
+        doc = {
+            "channel_name": f"inf{i}",
+            "tags": list(rng.choice(TAG_POOL, size=rng.randint(0, 5), replace=False)),
+            "structured_tags": {"industry": INDUSTRIES[i % len(INDUSTRIES)]},
+            "stats": {"subscribers": int(rng.randint(0, 100000)), "avg_likes": int(rng.randint(0, 5000))},
+            "last_updated": float(i)
+        }
+        if i % 6:
+            doc["embedding"] = rng.normal(size=dim).tolist()
+        db["influencers"].insert_one(doc)
+    return {
+        "_id": "p", "name": "상품", "tags": ["속옷", "데일리", "운동", "패션"],
+        "embedding": rng.normal(size=dim).tolist(), "structured_tags": {"category": "운동"}
+    }
+
+
+def _old_loop(engine, product):
+    """
+    Per-document scoring loop the index replaced (weights/category rule unchanged).
+    """
+    prod_tags = set(product["tags"])
+    valid = {normalize_category(product["structured_tags"]["category"])}
+    for tag in prod_tags:
+        if normalize_category(tag) != tag:
+            valid.add(normalize_category(tag))
+        if tag in CATEGORY_SYNONYMS.values():
+            valid.add(tag)
+    scored = []
+    for inf in engine.influencers.find({}):
+        overlap = prod_tags & set(inf.get("tags", []))
+        if not overlap:
+            continue
+        sim = engine.calculate_similarity(product["embedding"], inf.get("embedding")) if inf.get("embedding") else 0.0
+        stats = inf.get("stats", {})
+        subs = stats.get("subscribers", 1) or 1
+        er = min(stats.get("avg_likes", 0) / subs * 20, 1.0)
+        industry = inf["structured_tags"]["industry"]
+        cat, _ = engine._category_score(industry, valid, {"category_match": 0.3, "category_mismatch": -0.5})
+        score = max(sim * 0.4 + len(overlap) / len(prod_tags) * 0.3 + er * 0.1 + cat, 0.0)
+        scored.append((inf["_id"], score, len(overlap), sim))
+    scored.sort(key=lambda x: x[1], reverse=True)
+    return scored
+
+
+@pytest.mark.parametrize("use_index", [True, False])
+def test_scores_match_per_document_loop(db, use_index):
+    product = _fixture(db)
+    engine = MatchingEngine(db=db, use_index=use_index)
+    expected = _old_loop(engine, product)
+
+    results = engine.find_influencers_for_product(product, limit=len(expected))
+    assert [r["influencer"]["_id"] for r in results] == [e[0] for e in expected]
+    assert [r["score"] for r in results] == pytest.approx([e[1] for e in expected], abs=1e-6)
+    assert [r["details"]["keyword_overlap"] for r in results] == [e[2] for e in expected]
+
+
+def test_overlap_and_similarity_primitives(db):
+    product = _fixture(db)
+    docs = list(db["influencers"].find({}))
+    index = InfluencerIndex.from_documents(docs)
+
+    overlap = index.overlap_counts([index.vocab.lookup(product["tags"])])[:, 0]
+    assert overlap.tolist() == [len(set(product["tags"]) & set(d["tags"])) for d in docs]
+
+    vec = np.asarray(product["embedding"])
+    expected = [
+        float(np.dot(vec, d["embedding"]) / (np.linalg.norm(vec) * np.linalg.norm(d["embedding"])))
+        if d.get("embedding") else 0.0
+        for d in docs
+    ]
+    assert index.similarities(product["embedding"]).tolist() == pytest.approx(expected, abs=1e-5)
+
+
+class CountingCollection:
+    def __init__(self, collection):
+        self.collection = collection
+        self.calls = []
+
+    def find(self, *args, **kwargs):
+        self.calls.append(("find", args))
+        return self.collection.find(*args, **kwargs)
+
+    def find_one(self, *args, **kwargs):
+        self.calls.append(("find_one", args))
+        return self.collection.find_one(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+def test_refresh_pulls_updates_and_masks_deletions(db, monkeypatch):
+    _fixture(db, n=10)
+    collection = CountingCollection(db["influencers"])
+    index = InfluencerIndex(collection, categorize=normalize_category).load(get_index_version(db))
+    first, second = index.ids[0], index.ids[1]
+
+    db["influencers"].update_one({"_id": first}, {"$set": {"tags": ["신규태그"], "last_updated": 100.0}})
+    db["influencers"].delete_one({"_id": second})
+    bump_index_version(db)
+
+    collection.calls.clear()
+    index.refresh(get_index_version(db))
+    # One last_updated range query + one _id-only $in query, no per-document lookups
+    assert [name for name, _ in collection.calls] == ["find", "find"]
+    assert collection.calls[0][1][0] == {"last_updated": {"$gt": 9.0 - influencer_index.INDEX_SYNC_OVERLAP}}
+    assert collection.calls[1][1][1] == {"_id": 1}
+
+    row = index.row_of[first]
+    assert index.overlap_counts([index.vocab.lookup(["신규태그"])])[row, 0] == 1
+    assert not index.filter_mask()[index.row_of[second]]
+    assert index.filter_mask().sum() == 9
+
+
+def test_deletions_are_found_without_a_version_bump(db, monkeypatch):
+    _fixture(db, n=5)
+    index = InfluencerIndex(db["influencers"]).load(0)
+    db["influencers"].delete_one({"_id": index.ids[0]})
+
+    # Within the interval nothing is queried
+    assert index.refresh(0) == 0
+    monkeypatch.setattr(influencer_index, "INDEX_RECONCILE_INTERVAL", 0)
+    assert index.refresh(0) >= 1
+    assert index.filter_mask().tolist() == [False, True, True, True, True]
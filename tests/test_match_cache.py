@@ -0,0 +1,76 @@
+import sqlite3
+
+from match_cache import ResultCache, bump_index_version
+from matching_engine import MatchingEngine
+
+
+def _influencer(db, name, tags, embedding):
+    return db["influencers"].insert_one({
+        "channel_name": name,
+        "tags": tags,
+        "embedding": embedding,
+        "structured_tags": {"industry": "패션"},
+        "stats": {"subscribers": 1000, "avg_likes": 10},
+        "last_updated": 1.0
+    }).inserted_id
+
+
+PRODUCT = {"_id": "p1", "name": "네모팬티", "tags": ["속옷", "데일리"],
+           "embedding": [1.0, 0.0], "structured_tags": {"category": "패션"}, "last_updated": 1.0}
+
+
+def test_shared_file_round_trips_as_json(tmp_path):
+    path = str(tmp_path / "cache.db")
+    entries = [{"influencer_id": "a" * 24, "score": 0.5, "details": {"keyword_overlap": 1}}]
+    ResultCache(path=path).put("k", entries, index_version=1)
+
+    # A second process (empty LRU) reads it back from the file
+    assert ResultCache(path=path).get("k") == entries
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT typeof(value) FROM match_cache").fetchone()[0] == "text"
+    conn.close()
+
+
+def test_unreadable_entry_is_a_miss(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ResultCache(path=path)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("INSERT INTO match_cache VALUES ('k', 1, 0, ?)", (b"\x80\x04garbage",))
+    conn.close()
+    assert cache.get("k") is None
+
+
+def test_newer_version_evicts_older_entries(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ResultCache(path=path)
+    cache.put("old", [], index_version=1)
+    cache.put("new", [], index_version=2)
+    assert ResultCache(path=path).get("old") is None
+    assert ResultCache(path=path).get("new") == []
+
+
+def test_engine_hit_miss_and_invalidation(db, tmp_path):
+    path = str(tmp_path / "cache.db")
+    first = _influencer(db, "A", ["속옷"], [1.0, 0.0])
+    _influencer(db, "B", ["데일리"], [0.0, 1.0])
+
+    engine = MatchingEngine(db=db, cache_path=path)
+    miss = engine.recommend_for_product(PRODUCT)
+    assert not miss["cache_hit"]
+    assert [r["influencer"]["channel_name"] for r in miss["results"]] == ["A", "B"]
+
+    # Hit from the shared file in a fresh engine: ObjectIds are rebuilt and documents re-fetched
+    other = MatchingEngine(db=db, cache_path=path)
+    hit = other.recommend_for_product(PRODUCT)
+    assert hit["cache_hit"]
+    assert [r["influencer"]["_id"] for r in hit["results"]] == [r["influencer"]["_id"] for r in miss["results"]]
+    assert [r["score"] for r in hit["results"]] == [r["score"] for r in miss["results"]]
+
+    # Deleted influencers are dropped from a hit
+    db["influencers"].delete_one({"_id": first})
+    assert [r["influencer"]["channel_name"] for r in other.recommend_for_product(PRODUCT)["results"]] == ["B"]
+
+    # A version bump (watch_db.py wrote influencers) invalidates every entry
+    bump_index_version(db)
+    assert not other.recommend_for_product(PRODUCT)["cache_hit"]
@@ -0,0 +1,124 @@
+import pytest
+
+from near_duplicate import (
+    backfill_signatures, copy_from_duplicate, dedup_text, estimated_similarity,
+    lsh_bands, match_in_batch, minhash_signature, signature_fields
+)
+
+BASE = ("남성용 네모팬티 드로즈 5종 세트 통기성 좋은 모달 소재로 하루 종일 편안한 착용감을 제공합니다 "
+        "허리 밴드 자국이 남지 않는 부드러운 마감 데일리 속옷")
+NEAR = BASE.replace("5종", "7종")
+HALF = BASE[:len(BASE) // 2] + " 캠핑용 접이식 의자 초경량 알루미늄 프레임 휴대용 가방 포함"
+
+
+def _tagged(db, description, embedding=(0.1, 0.2)):
+    doc = {
+        "title": "네모팬티",
+        "description": description,
+        "structured_tags": {"category": "패션"},
+        "tags": ["속옷", "데일리"],
+        "embedding": list(embedding),
+        "prompt_hash": "h",
+        "tagging_version": "v"
+    }
+    doc.update(signature_fields(dedup_text("products", doc)))
+    doc["_id"] = db["products"].insert_one(doc).inserted_id
+    return doc
+
+
+def _new(db, description):
+    doc = {"title": "네모팬티", "description": description}
+    doc["_id"] = db["products"].insert_one(dict(doc)).inserted_id
+    return doc, signature_fields(dedup_text("products", doc))
+
+
+def test_signatures_are_stable_and_normalized():
+    assert minhash_signature(BASE) == minhash_signature(BASE)
+    # Case, punctuation and spacing do not matter
+    assert minhash_signature(BASE) == minhash_signature("  " + BASE.upper().replace(" ", "  ") + "!!")
+    assert minhash_signature("짧은 이름") is None
+    assert signature_fields("짧은 이름") == {}
+    assert len(lsh_bands(minhash_signature(BASE))) == 16
+
+
+def test_exact_copy_reuses_tags_and_embedding(db):
+    source = _tagged(db, BASE)
+    doc, fields = _new(db, BASE)
+
+    copied = copy_from_duplicate(db["products"], doc, fields, embedding_dim=2)
+    assert copied["duplicate_of"] == source["_id"]
+    assert copied["duplicate_similarity"] == 1.0
+    assert copied["structured_tags"] == source["structured_tags"]
+    assert copied["embedding"] == source["embedding"]
+    assert copied["prompt_hash"] == "h"
+
+
+def test_near_copy_above_threshold(db):
+    source = _tagged(db, BASE)
+    doc, fields = _new(db, NEAR)
+    assert estimated_similarity(fields["minhash"], source["minhash"]) >= 0.9
+
+    copied = copy_from_duplicate(db["products"], doc, fields, embedding_dim=2)
+    assert copied["duplicate_of"] == source["_id"]
+    assert 0.9 <= copied["duplicate_similarity"] < 1.0
+
+
+def test_partial_overlap_below_threshold(db):
+    source = _tagged(db, BASE)
+    doc, fields = _new(db, HALF)
+    assert 0.2 < estimated_similarity(fields["minhash"], source["minhash"]) < 0.9
+    assert copy_from_duplicate(db["products"], doc, fields, embedding_dim=2) is None
+
+
+def test_band_candidate_below_threshold(db):
+    source = _tagged(db, BASE)
+    doc, fields = _new(db, NEAR)
+    # Found through a shared band, but rejected by the similarity check
+    assert set(fields["minhash_bands"]) & set(source["minhash_bands"])
+    assert copy_from_duplicate(db["products"], doc, fields, embedding_dim=2, threshold=0.99) is None
+
+
+@pytest.mark.parametrize("threshold", [1.01, None])
+def test_disabled_or_short_texts_never_copy(db, threshold):
+    _tagged(db, BASE)
+    doc, fields = _new(db, BASE)
+    if threshold is None:
+        fields = {}
+    assert copy_from_duplicate(db["products"], doc, fields, embedding_dim=2, threshold=threshold) is None
+
+
+def test_embedding_of_another_dimension_is_not_copied(db):
+    _tagged(db, BASE, embedding=(0.1, 0.2, 0.3))
+    doc, fields = _new(db, BASE)
+    copied = copy_from_duplicate(db["products"], doc, fields, embedding_dim=2)
+    assert copied["structured_tags"] and copied["embedding"] is None
+    assert copied["embed_text_version"] is None
+
+
+def test_backfill_signatures(db):
+    tagged = db["products"].insert_one({"title": "네모팬티", "description": BASE, "structured_tags": {}}).inserted_id
+    short = db["products"].insert_one({"title": "양말", "structured_tags": {}}).inserted_id
+    untagged = db["products"].insert_one({"title": "네모팬티", "description": BASE}).inserted_id
+
+    assert backfill_signatures(db["products"], "products") == 2
+    assert db["products"].find_one({"_id": tagged})["minhash_bands"] == \
+        signature_fields(dedup_text("products", {"title": "네모팬티", "description": BASE}))["minhash_bands"]
+    # Too short to compare: marked so it is not picked up again
+    assert db["products"].find_one({"_id": short})["minhash_bands"] == []
+    assert "minhash" not in db["products"].find_one({"_id": untagged})
+    assert backfill_signatures(db["products"], "products") == 0
+
+    # Backfilled documents are found by later copies
+    doc, fields = _new(db, BASE)
+    assert copy_from_duplicate(db["products"], doc, fields)["duplicate_of"] == tagged
+
+
+def test_match_in_batch():
+    base, near, half = (signature_fields(dedup_text("products", {"title": "네모팬티", "description": text}))
+                        for text in (BASE, NEAR, HALF))
+    assert match_in_batch(base, []) is None
+    assert match_in_batch(near, [("half", half), ("base", base)]) == ("base", pytest.approx(0.9, abs=0.1))
+    assert match_in_batch(base, [("base", base)]) == ("base", 1.0)
+    assert match_in_batch(half, [("base", base)]) is None
+    assert match_in_batch(base, [("base", base)], threshold=1.01) is None
+    assert match_in_batch({}, [("base", base)]) is None
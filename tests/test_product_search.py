@@ -0,0 +1,71 @@
+from matching_engine import MatchingEngine
+from product_search import build_search_fields, search_products, _min_shared_grams
+
+
+def _insert(db, name, indexed=True):
+    doc = {"name": name}
+    if indexed:
+        doc.update(build_search_fields(doc))
+    return db["products"].insert_one(doc).inserted_id
+
+
+def _ranking(db, query):
+    return [(r["product"]["name"], r["match"]) for r in search_products(db["products"], query, limit=10)]
+
+
+def test_exact_before_prefix_before_fuzzy(db):
+    _insert(db, "네모팬티 블랙 3종")
+    _insert(db, "네모팬티")
+    _insert(db, "슬림 네모 팬티")
+    _insert(db, "에어 쿠션")
+
+    ranked = search_products(db["products"], "네모팬티", limit=10)
+    assert [(r["product"]["name"], r["match"]) for r in ranked] == [
+        ("네모팬티", "exact"),
+        ("네모팬티 블랙 3종", "prefix"),
+        ("슬림 네모 팬티", "fuzzy")
+    ]
+    assert ranked[0]["score"] == 1.0
+    assert 0.8 <= ranked[1]["score"] < 1.0
+    assert ranked[2]["score"] < 0.8
+
+
+def test_normalized_lookup(db):
+    _insert(db, "ＮＥＭＯ Pants!")
+    assert _ranking(db, "nemo pants") == [("ＮＥＭＯ Pants!", "exact")]
+
+
+def test_fuzzy_needs_enough_shared_grams(db):
+    _insert(db, "초경량 러닝 자켓")
+    _insert(db, "러닝머신 매트")
+    # 6 query grams -> at least 2 must be shared ('러닝머신 매트' shares only '러닝')
+    assert _min_shared_grams(6) == 2
+    assert _ranking(db, "초경량 러닝 조끼") == [("초경량 러닝 자켓", "fuzzy")]
+
+
+def test_unindexed_substring_ranks_below_prefix(db):
+    _insert(db, "수분크림 리필")
+    _insert(db, "데일리 수분크림", indexed=False)
+
+    ranked = search_products(db["products"], "수분크림", limit=10)
+    assert [(r["product"]["name"], r["match"]) for r in ranked] == [
+        ("수분크림 리필", "prefix"),
+        ("데일리 수분크림", "fuzzy")
+    ]
+    # The raw hit is indexed on the spot
+    assert "name_norm" in db["products"].find_one({"name": "데일리 수분크림"})
+
+
+def test_unindexed_exact_hit(db):
+    _insert(db, "수분크림", indexed=False)
+    assert _ranking(db, "수분크림") == [("수분크림", "exact")]
+
+
+def test_engine_creates_search_indexes_once(db, monkeypatch):
+    calls = []
+    monkeypatch.setattr("matching_engine.ensure_search_indexes", lambda collection: calls.append(1))
+    engine = MatchingEngine(db=db)
+    _insert(db, "네모팬티")
+    engine.search_products("네모팬티")
+    engine.search_products("네모")
+    assert calls == [1]
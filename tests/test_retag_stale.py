@@ -0,0 +1,126 @@
+import time
+from collections import deque
+
+import pytest
+
+import retag_stale
+import tagging_utils
+from retag_stale import ACTION_REEMBED, ACTION_RETAG, ACTION_STAMP, plan_action
+from tagging_utils import EMBED_TEXT_VERSION, current_tagging_version
+
+TAGS = {"category": "패션", "keywords": ["속옷"]}
+
+
+def _product(**overrides):
+    doc = {"title": "네모팬티", "description": "데일리 속옷", "structured_tags": dict(TAGS), "tags": ["속옷"],
+           "embedding": [0.1, 0.2]}
+    doc.update(tagging_utils.version_fields("products", doc))
+    doc["tagging_version"] = "old"
+    for key, value in overrides.items():
+        if value is None:
+            doc.pop(key, None)
+        else:
+            doc[key] = value
+    return doc
+
+
+@pytest.fixture
+def api(db, monkeypatch):
+    calls = {"tagged": 0, "embedded": 0}
+
+    def generate_tags_batch(kind, docs, priority=None):
+        calls["tagged"] += len(docs)
+        return {doc["_id"]: dict(TAGS) for doc in docs}
+
+    def get_embedding(text, collection=None, priority=None):
+        calls["embedded"] += 1
+        return [0.3, 0.4]
+
+    monkeypatch.setattr(retag_stale, "generate_tags_batch", generate_tags_batch)
+    monkeypatch.setattr(retag_stale, "get_embedding", get_embedding)
+    monkeypatch.setattr(retag_stale, "_api_docs", deque())
+    monkeypatch.setattr(retag_stale, "_cursors", {})
+    return calls
+
+
+LEGACY = {"prompt_hash": None, "source_hash": None, "tagging_version": "v2_structured"}
+
+
+@pytest.mark.parametrize("overrides, action", [
+    ({}, ACTION_STAMP),                                                       # only the version string is outdated
+    ({"prompt_hash": "edited"}, ACTION_RETAG),
+    ({"description": "새 설명"}, ACTION_RETAG),                                 # source changed since tagging
+    ({"embed_text_version": "e0"}, ACTION_REEMBED),
+    ({"prompt_hash": "edited", "embed_text_version": "e0"}, ACTION_RETAG),
+    ({**LEGACY, "embed_text_version": EMBED_TEXT_VERSION}, ACTION_STAMP),     # legacy, embedding provably current
+    ({**LEGACY, "embed_text_version": None}, ACTION_REEMBED),                 # legacy, recipe unknown
+    ({**LEGACY, "embed_text_version": "e0"}, ACTION_REEMBED),
+    ({**LEGACY, "tagging_version": "custom"}, ACTION_RETAG),                  # not a known legacy version
+])
+def test_plan_action(overrides, action):
+    assert plan_action("products", _product(**overrides)) == action
+
+
+@pytest.mark.parametrize("embed_text_version, embedded", [(EMBED_TEXT_VERSION, 0), (None, 1)])
+def test_legacy_documents_become_current(db, api, embed_text_version, embedded):
+    doc_id = db["products"].insert_one(_product(**LEGACY, embed_text_version=embed_text_version)).inserted_id
+
+    counts, _ = retag_stale.retag_collection(db, "products")
+    assert counts[ACTION_STAMP] + counts[ACTION_REEMBED] == 1
+    assert (api["tagged"], api["embedded"]) == (0, embedded)
+
+    doc = db["products"].find_one({"_id": doc_id})
+    assert doc["tagging_version"] == current_tagging_version("products")
+    assert doc["embed_text_version"] == EMBED_TEXT_VERSION
+    assert doc["embedding"] == ([0.3, 0.4] if embedded else [0.1, 0.2])
+    assert doc["structured_tags"] == TAGS
+    assert db["products"].count_documents(retag_stale.stale_query("products")) == 0
+
+
+def test_adopt_current_only_accepts_current_embeddings(db, api):
+    current = db["products"].insert_one(_product(**LEGACY, embed_text_version=EMBED_TEXT_VERSION)).inserted_id
+    unknown = db["products"].insert_one(_product(**LEGACY, embed_text_version=None)).inserted_id
+
+    assert retag_stale.adopt_current(db, "products") == 2
+    assert db["products"].find_one({"_id": current})["tagging_version"] == current_tagging_version("products")
+    assert db["products"].find_one({"_id": unknown})["tagging_version"] == "v2_structured"
+
+    # The remaining one is queued for a re-embed only
+    counts, _ = retag_stale.retag_collection(db, "products")
+    assert counts[ACTION_REEMBED] == 1
+    assert (api["tagged"], api["embedded"]) == (0, 1)
+    assert db["products"].find_one({"_id": unknown})["tagging_version"] == current_tagging_version("products")
+
+
+def test_hourly_rate_limit(db, api, monkeypatch):
+    monkeypatch.setattr(retag_stale, "RETAG_MAX_DOCS_PER_HOUR", 2)
+    ids = [db["products"].insert_one(_product(embed_text_version="e0")).inserted_id for _ in range(3)]
+    stamp = db["products"].insert_one(_product()).inserted_id
+
+    counts, last_id = retag_stale.retag_collection(db, "products")
+    assert counts[ACTION_REEMBED] == 2 and counts["deferred"] == 2
+    assert last_id == ids[1]
+
+    # Allowance used up: nothing is processed, the stamp-only document waits its turn
+    counts, last_id = retag_stale.retag_collection(db, "products", after_id=last_id)
+    assert last_id is None and counts["deferred"] == 2
+    assert retag_stale.retag_stale(db) == 0
+    assert api["embedded"] == 2
+
+    # An hour later the window frees up
+    monkeypatch.setattr(retag_stale, "_api_docs", deque(t - 3601 for t in retag_stale._api_docs))
+    counts, last_id = retag_stale.retag_collection(db, "products", after_id=ids[1])
+    assert (counts[ACTION_REEMBED], counts[ACTION_STAMP], counts["deferred"]) == (1, 1, 0)
+    assert last_id == stamp
+    assert db["products"].count_documents(retag_stale.stale_query("products")) == 0
+
+
+def test_stamp_only_documents_do_not_use_the_allowance(db, api, monkeypatch):
+    monkeypatch.setattr(retag_stale, "RETAG_MAX_DOCS_PER_HOUR", 1)
+    retag_stale._api_docs.append(time.time())
+    for _ in range(3):
+        db["products"].insert_one(_product())
+
+    counts, _ = retag_stale.retag_collection(db, "products")
+    assert (counts[ACTION_STAMP], counts["deferred"]) == (3, 0)
+    assert api["embedded"] == 0
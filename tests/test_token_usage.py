@@ -0,0 +1,107 @@
+import sqlite3
+
+import pytest
+
+import token_usage
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    monkeypatch.setattr(token_usage, "TOKEN_USAGE_DB", str(tmp_path / "usage.db"))
+    monkeypatch.setattr(token_usage, "_initialized", False)
+    monkeypatch.setattr(token_usage, "TOKEN_BUDGET_HOURLY", 0)
+    monkeypatch.setattr(token_usage, "TOKEN_BUDGET_DAILY", 0)
+    return tmp_path / "usage.db"
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    calls = []
+    monkeypatch.setattr(token_usage.time, "sleep", calls.append)
+    return calls
+
+
+def _use(tokens, function="generate_tags_batch"):
+    token_usage.record_usage(function, "products", "gpt-4o-mini", {"prompt_tokens": tokens, "total_tokens": tokens})
+
+
+def test_record_usage_aggregates_tokens_and_cost(store):
+    usage = {"prompt_tokens": 1000, "completion_tokens": 500, "total_tokens": 1500}
+    token_usage.record_usage("generate_product_tags", "products", "gpt-4o-mini-2024-07-18", usage)
+    token_usage.record_usage("generate_product_tags", "products", "gpt-4o-mini-2024-07-18", usage)
+    token_usage.record_usage("get_embedding", "products", "text-embedding-3-small", {"prompt_tokens": 100})
+    token_usage.record_usage("batch_tags", "products", "gpt-4o-mini", usage)
+
+    rows = {row[2]: row for row in token_usage.usage_summary(days=1)}
+    _, _, _, calls, prompt, completion, total, cost = rows["generate_product_tags"]
+    assert (calls, prompt, completion, total) == (2, 2000, 1000, 3000)
+    assert cost == pytest.approx(2 * (1000 * 0.15 + 500 * 0.60) / 1e6)
+    assert rows["get_embedding"][6] == 100  # total falls back to prompt + completion
+    assert rows["get_embedding"][7] == pytest.approx(100 * 0.02 / 1e6)
+    assert rows["batch_tags"][7] == pytest.approx((1000 * 0.15 + 500 * 0.60) / 1e6 * 0.5)
+
+
+def test_unknown_model_costs_nothing():
+    assert token_usage.model_price("gpt-4o-2024-08-06") == (2.50, 10.00)
+    assert token_usage.model_price("gpt-4o-mini") == (0.15, 0.60)
+    assert token_usage.usage_cost("f", "some-new-model", 1000, 1000) == 0.0
+    assert token_usage.usage_cost("f", None, 1000, 1000) == 0.0
+
+
+def test_store_without_cost_column_is_migrated(store):
+    conn = sqlite3.connect(str(store))
+    conn.execute(
+        "CREATE TABLE token_usage (hour TEXT, collection TEXT, function TEXT, model TEXT,"
+        " calls INTEGER, prompt_tokens INTEGER, completion_tokens INTEGER, total_tokens INTEGER,"
+        " PRIMARY KEY (hour, collection, function, model))"
+    )
+    conn.execute("INSERT INTO token_usage VALUES (?, 'products', 'get_embedding', 'text-embedding-3-small', 1, 1000000, 0, 1000000)",
+                 (token_usage._current_hour(),))
+    conn.commit()
+    conn.close()
+
+    token_usage.record_usage("get_embedding", "products", "text-embedding-3-small", {"prompt_tokens": 1000000})
+    (row,) = token_usage.usage_summary(days=1)
+    assert row[3] == 2
+    assert row[7] == pytest.approx(0.04)
+
+
+def test_budget_ratio_ignores_batch_usage(store, monkeypatch):
+    assert token_usage.budget_ratio() == 0.0
+    monkeypatch.setattr(token_usage, "TOKEN_BUDGET_HOURLY", 1000)
+    monkeypatch.setattr(token_usage, "TOKEN_BUDGET_DAILY", 4000)
+    _use(500)
+    _use(5000, function="batch_tags")
+    assert token_usage.budget_ratio() == pytest.approx(0.5)
+    assert token_usage.tokens_used(token_usage._current_hour(), include_batch=True) == 5500
+
+
+def test_high_priority_never_waits(store, sleeps, monkeypatch):
+    monkeypatch.setattr(token_usage, "TOKEN_BUDGET_HOURLY", 100)
+    _use(1000)
+    token_usage.wait_for_budget(token_usage.PRIORITY_HIGH)
+    assert sleeps == []
+
+
+@pytest.mark.parametrize("used, delay", [(500, 0.0), (900, 5.0), (1000, 10.0), (3000, 10.0)])
+def test_normal_priority_is_throttled_but_never_paused(store, sleeps, monkeypatch, used, delay):
+    monkeypatch.setattr(token_usage, "TOKEN_BUDGET_HOURLY", 1000)
+    _use(used)
+    token_usage.wait_for_budget(token_usage.PRIORITY_NORMAL)
+    assert sleeps == ([] if delay == 0.0 else [pytest.approx(delay)])
+
+
+def test_low_priority_pauses_until_the_budget_frees_up(store, monkeypatch):
+    monkeypatch.setattr(token_usage, "TOKEN_BUDGET_HOURLY", 1000)
+    _use(1000)
+    pauses = []
+
+    def sleep(seconds):
+        pauses.append(seconds)
+        if len(pauses) == 2:
+            # The hour rolls over
+            monkeypatch.setattr(token_usage, "_current_hour", lambda: "2000-01-01T00")
+
+    monkeypatch.setattr(token_usage.time, "sleep", sleep)
+    token_usage.wait_for_budget(token_usage.PRIORITY_LOW)
+    assert pauses == [token_usage.PAUSE_RECHECK_INTERVAL] * 2
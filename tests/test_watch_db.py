@@ -0,0 +1,133 @@
+from collections import deque
+
+import pytest
+
+import retag_stale
+import tagging_utils
+import token_usage
+import watch_db
+
+DESCRIPTION = ("남성용 네모팬티 드로즈 5종 세트 통기성 좋은 모달 소재로 하루 종일 편안한 착용감을 제공합니다 "
+               "허리 밴드 자국이 남지 않는 부드러운 마감 데일리 속옷")
+TAGS = {"category": "패션", "keywords": ["속옷"]}
+
+
+@pytest.fixture
+def api(db, monkeypatch):
+    """
+    watch_db against mongomock with the OpenAI calls replaced by counters.
+    """
+    calls = {"tagged": [], "embedded": 0}
+
+    def generate_tags_batch(kind, docs, priority=None):
+        calls["tagged"].extend(doc["_id"] for doc in docs)
+        return {doc["_id"]: dict(TAGS) for doc in docs}
+
+    def get_embedding(text, collection=None, priority=None):
+        calls["embedded"] += 1
+        return [0.1] * tagging_utils.EMBEDDING_DIM
+
+    monkeypatch.setattr(watch_db, "db", db)
+    monkeypatch.setattr(watch_db, "generate_tags_batch", generate_tags_batch)
+    monkeypatch.setattr(watch_db, "get_embedding", get_embedding)
+    monkeypatch.setattr(tagging_utils, "get_embedding", get_embedding)
+    monkeypatch.setattr(retag_stale, "get_embedding", get_embedding)
+    monkeypatch.setattr(retag_stale, "_cursors", {})
+    monkeypatch.setattr(retag_stale, "_api_docs", deque())
+    monkeypatch.setattr(watch_db.time, "sleep", lambda seconds: None)
+    return calls
+
+
+def test_in_batch_duplicates_are_tagged_once(db, api):
+    ids = [db["products"].insert_one({"title": "네모팬티", "description": DESCRIPTION}).inserted_id
+           for _ in range(3)]
+
+    assert watch_db.process_products() == 3
+    assert api["tagged"] == [ids[0]]
+    assert api["embedded"] == 1
+
+    leader = db["products"].find_one({"_id": ids[0]})
+    assert "duplicate_of" not in leader
+    for _id in ids[1:]:
+        doc = db["products"].find_one({"_id": _id})
+        assert doc["duplicate_of"] == ids[0]
+        assert doc["duplicate_similarity"] == 1.0
+        assert doc["structured_tags"] == leader["structured_tags"]
+        assert doc["embedding"] == leader["embedding"]
+        assert doc["tagging_version"] == leader["tagging_version"]
+
+
+def test_in_batch_influencer_duplicates(db, api):
+    inf = [db["influencers"].insert_one({"channel_name": "데일리핏", "channel_desc": DESCRIPTION}).inserted_id
+           for _ in range(2)]
+
+    assert watch_db.process_influencers() == 2
+    assert api["tagged"] == [inf[0]]
+    assert api["embedded"] == 1
+    assert db["influencers"].find_one({"_id": inf[1]})["duplicate_of"] == inf[0]
+
+
+def test_distinct_documents_are_all_tagged(db, api):
+    ids = [db["products"].insert_one({"title": f"상품 {i}", "description": text}).inserted_id
+           for i, text in enumerate([DESCRIPTION, "캠핑용 접이식 의자 초경량 알루미늄 프레임 휴대용 가방 포함"])]
+
+    assert watch_db.process_products() == 2
+    assert api["tagged"] == ids
+    assert api["embedded"] == 2
+
+
+def test_followers_of_a_failed_leader_wait_for_the_next_cycle(db, api, monkeypatch):
+    ids = [db["products"].insert_one({"title": "네모팬티", "description": DESCRIPTION}).inserted_id
+           for _ in range(2)]
+    monkeypatch.setattr(watch_db, "generate_tags_batch", lambda kind, docs, priority=None: {})
+
+    assert watch_db.process_products() == 0
+    assert all("structured_tags" not in db["products"].find_one({"_id": _id}) for _id in ids)
+
+
+@pytest.fixture
+def stale_product(db):
+    doc = {"title": "양말", "description": "발목 양말 10켤레", "structured_tags": dict(TAGS), "tags": ["속옷"],
+           "embedding": [0.1] * tagging_utils.EMBEDDING_DIM}
+    doc.update(tagging_utils.version_fields("products", doc))
+    doc["embed_text_version"] = "e0"  # needs a re-embed
+    doc["tagging_version"] = "old"
+    return db["products"].insert_one(doc).inserted_id
+
+
+def test_exhausted_budget_does_not_stall_the_cycle(db, api, stale_product, monkeypatch):
+    monkeypatch.setattr(token_usage, "TOKEN_BUDGET_HOURLY", 1000)
+    token_usage.record_usage("generate_tags_batch", "products", "gpt-4o-mini", {"total_tokens": 1000})
+
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) > 5:
+            raise RuntimeError("stalled")
+
+    def get_embedding(text, collection=None, priority=token_usage.PRIORITY_NORMAL):
+        token_usage.wait_for_budget(priority)
+        api["embedded"] += 1
+        return [0.2] * tagging_utils.EMBEDDING_DIM
+
+    monkeypatch.setattr(token_usage.time, "sleep", sleep)
+    monkeypatch.setattr(tagging_utils, "get_embedding", get_embedding)
+    monkeypatch.setattr(retag_stale, "get_embedding", get_embedding)
+
+    # Idle cycle: the low-priority re-tagger is skipped instead of pausing
+    assert watch_db.run_cycle() == 0
+    assert token_usage.PAUSE_RECHECK_INTERVAL not in sleeps
+    assert db["products"].find_one({"_id": stale_product})["embed_text_version"] == "e0"
+
+    # New documents are still processed
+    new_id = db["products"].insert_one({"title": "네모팬티", "description": DESCRIPTION}).inserted_id
+    assert watch_db.run_cycle() == 1
+    assert "embedding" in db["products"].find_one({"_id": new_id})
+    assert token_usage.PAUSE_RECHECK_INTERVAL not in sleeps
+
+
+def test_idle_cycle_retags_within_budget(db, api, stale_product):
+    assert watch_db.run_cycle() == 0
+    assert api["embedded"] == 1
+    assert db["products"].find_one({"_id": stale_product})["embed_text_version"] == tagging_utils.EMBED_TEXT_VERSION
@@ -0,0 +1,237 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+# Local usage store (aggregated per UTC hour x collection x function x model)
+TOKEN_USAGE_DB = os.getenv("TOKEN_USAGE_DB", "token_usage.db")
+
+# Token budgets (0 = unlimited). Hours/days are UTC.
+TOKEN_BUDGET_DAILY = int(os.getenv("TOKEN_BUDGET_DAILY", 0))
+TOKEN_BUDGET_HOURLY = int(os.getenv("TOKEN_BUDGET_HOURLY", 0))
+
+# Above this fraction of a budget, non-interactive work starts slowing down
+BUDGET_SOFT_RATIO = float(os.getenv("TOKEN_BUDGET_SOFT_RATIO", 0.8))
+
+# Priorities
+#   high:   interactive (recommend.py priority lane) - never throttled
+#   normal: live ingestion (watch_db.py)             - slowed down near/over budget
+#   low:    backfills (tag_*.py, migrations)         - slowed down, paused over budget
+PRIORITY_HIGH = "high"
+PRIORITY_NORMAL = "normal"
+PRIORITY_LOW = "low"
+
+# Offline Batch API usage (batch_tagging.py) is recorded under these function
+# names; it is billed and rate-limited separately, so it does not count against
+# the live budgets above.
+BATCH_FUNCTION_PREFIX = "batch_"
+
+# USD per 1M tokens (input, output). Model names returned by the API carry a
+# date suffix ('gpt-4o-mini-2024-07-18'), so the longest matching prefix is used.
+# Unknown models are recorded with cost 0. Update when OpenAI pricing changes.
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+
+# Batch API requests are billed at half price
+BATCH_PRICE_FACTOR = 0.5
+
+MAX_THROTTLE_DELAY = 10.0
+PAUSE_RECHECK_INTERVAL = 60.0
+
+_lock = threading.Lock()
+_initialized = False
+
+
+def _connect():
+    global _initialized
+    conn = sqlite3.connect(TOKEN_USAGE_DB, timeout=5)
+    if not _initialized:
+        with _lock:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS token_usage ("
+                " hour TEXT, collection TEXT, function TEXT, model TEXT,"
+                " calls INTEGER, prompt_tokens INTEGER, completion_tokens INTEGER, total_tokens INTEGER,"
+                " cost_usd REAL DEFAULT 0,"
+                " PRIMARY KEY (hour, collection, function, model))"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(token_usage)")]
+            if "cost_usd" not in columns:
+                # Store created before cost tracking: price the recorded tokens once
+                conn.execute("ALTER TABLE token_usage ADD COLUMN cost_usd REAL DEFAULT 0")
+                rows = conn.execute(
+                    "SELECT rowid, function, model, prompt_tokens, completion_tokens FROM token_usage"
+                ).fetchall()
+                for rowid, function, model, prompt, completion in rows:
+                    conn.execute("UPDATE token_usage SET cost_usd = ? WHERE rowid = ?",
+                                 (usage_cost(function, model, prompt, completion), rowid))
+            conn.commit()
+            _initialized = True
+    return conn
+
+
+def _current_hour():
+    return time.strftime("%Y-%m-%dT%H", time.gmtime())
+
+
+def _usage_value(usage, name):
+    if usage is None:
+        return 0
+    if isinstance(usage, dict):
+        return usage.get(name, 0) or 0
+    return getattr(usage, name, 0) or 0
+
+
+def model_price(model):
+    """
+    (input, output) USD per 1M tokens for a model name, or None if unknown.
+    """
+    matches = [name for name in MODEL_PRICES if model and model.startswith(name)]
+    return MODEL_PRICES[max(matches, key=len)] if matches else None
+
+
+def usage_cost(function, model, prompt_tokens, completion_tokens):
+    """
+    USD cost of one call (0.0 for models missing from MODEL_PRICES).
+    """
+    price = model_price(model)
+    if price is None:
+        return 0.0
+    cost = (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000
+    if function.startswith(BATCH_FUNCTION_PREFIX):
+        cost *= BATCH_PRICE_FACTOR
+    return cost
+
+
+def record_usage(function, collection, model, usage):
+    """
+    Adds one API call's `usage` (OpenAI response.usage object or dict) and its
+    cost (see MODEL_PRICES) to the local store.
+    """
+    prompt = _usage_value(usage, "prompt_tokens")
+    completion = _usage_value(usage, "completion_tokens")
+    total = _usage_value(usage, "total_tokens") or (prompt + completion)
+    cost = usage_cost(function, model, prompt, completion)
+
+    try:
+        conn = _connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO token_usage VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?) "
+                "ON CONFLICT (hour, collection, function, model) DO UPDATE SET"
+                " calls = calls + 1,"
+                " prompt_tokens = prompt_tokens + excluded.prompt_tokens,"
+                " completion_tokens = completion_tokens + excluded.completion_tokens,"
+                " total_tokens = total_tokens + excluded.total_tokens,"
+                " cost_usd = cost_usd + excluded.cost_usd",
+                (_current_hour(), collection or "unknown", function, model, prompt, completion, total, cost)
+            )
+        conn.close()
+    except sqlite3.Error as e:
+        # Accounting must never break tagging
+        print(f"Error recording token usage: {e}")
+
+
+def tokens_used(period_prefix, include_batch=False):
+    """
+    Total tokens for an hour ('YYYY-MM-DDTHH') or a day ('YYYY-MM-DD') prefix.
+    Offline batch usage is excluded unless `include_batch` is set.
+    """
+    conn = _connect()
+    query = "SELECT COALESCE(SUM(total_tokens), 0) FROM token_usage WHERE hour LIKE ?"
+    params = [period_prefix + "%"]
+    if not include_batch:
+        query += " AND substr(function, 1, ?) != ?"
+        params += [len(BATCH_FUNCTION_PREFIX), BATCH_FUNCTION_PREFIX]
+    row = conn.execute(query, params).fetchone()
+    conn.close()
+    return row[0]
+
+
+def budget_ratio():
+    """
+    Highest fraction used of the configured hourly/daily budgets (0.0 if none set).
+    """
+    hour = _current_hour()
+    ratios = [0.0]
+    if TOKEN_BUDGET_HOURLY > 0:
+        ratios.append(tokens_used(hour) / TOKEN_BUDGET_HOURLY)
+    if TOKEN_BUDGET_DAILY > 0:
+        ratios.append(tokens_used(hour[:10]) / TOKEN_BUDGET_DAILY)
+    return max(ratios)
+
+
+def wait_for_budget(priority=PRIORITY_NORMAL):
+    """
+    Blocks before an API call according to priority and budget usage:
+    slows down between BUDGET_SOFT_RATIO and 100%, and above 100% pauses
+    low-priority work until the hour/day rolls over. High priority never waits.
+    """
+    if priority == PRIORITY_HIGH or (TOKEN_BUDGET_HOURLY <= 0 and TOKEN_BUDGET_DAILY <= 0):
+        return
+
+    while True:
+        ratio = budget_ratio()
+        if ratio < BUDGET_SOFT_RATIO:
+            return
+
+        if ratio >= 1.0 and priority == PRIORITY_LOW:
+            print(f"⏸️ Token budget exhausted ({ratio:.0%}). Pausing low-priority work...")
+            time.sleep(PAUSE_RECHECK_INTERVAL)
+            continue
+
+        # Linear back-off from 0s at the soft limit to MAX_THROTTLE_DELAY at 100%
+        span = max(1.0 - BUDGET_SOFT_RATIO, 1e-6)
+        delay = MAX_THROTTLE_DELAY * min((ratio - BUDGET_SOFT_RATIO) / span, 1.0)
+        time.sleep(delay)
+        return
+
+
+def usage_summary(days=7):
+    """
+    Per-day x collection x function totals (tokens and USD cost) for the last `days` days (UTC).
+    """
+    since = time.strftime("%Y-%m-%d", time.gmtime(time.time() - (days - 1) * 86400))
+    conn = _connect()
+    rows = conn.execute(
+        "SELECT substr(hour, 1, 10) AS day, collection, function,"
+        " SUM(calls), SUM(prompt_tokens), SUM(completion_tokens), SUM(total_tokens), SUM(cost_usd)"
+        " FROM token_usage WHERE hour >= ?"
+        " GROUP BY day, collection, function ORDER BY day, collection, function",
+        (since,)
+    ).fetchall()
+    conn.close()
+    return rows
+
+
+def main():
+    sys.stdout.reconfigure(encoding='utf-8')
+    parser = argparse.ArgumentParser(description="Show OpenAI token usage recorded by the tagging pipeline.")
+    parser.add_argument("--days", type=int, default=7)
+    args = parser.parse_args()
+
+    print(f"{'Day':<12}{'Collection':<14}{'Function':<28}{'Calls':>8}{'Prompt':>12}{'Completion':>12}"
+          f"{'Total':>12}{'Cost ($)':>12}")
+    print("-" * 110)
+    total_cost = 0.0
+    for day, collection, function, calls, prompt, completion, total, cost in usage_summary(args.days):
+        print(f"{day:<12}{collection:<14}{function:<28}{calls:>8,}{prompt:>12,}{completion:>12,}"
+              f"{total:>12,}{cost:>12.4f}")
+        total_cost += cost
+
+    print("-" * 110)
+    print(f"Cost: ${total_cost:.4f} over {args.days} days (prices in token_usage.MODEL_PRICES)")
+    print(f"Budget usage: {budget_ratio():.0%} "
+          f"(hourly: {TOKEN_BUDGET_HOURLY or 'unlimited'}, daily: {TOKEN_BUDGET_DAILY or 'unlimited'})")
+
+
+if __name__ == "__main__":
+    main()
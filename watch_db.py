@@ -4,7 +4,22 @@ import threading
 import traceback
 from pymongo import MongoClient
 from dotenv import load_dotenv
-from tagging_utils import generate_influencer_tags, generate_brand_tags, generate_product_tags, get_embedding
+from tagging_utils import (
+    get_embedding, tag_and_embed_product, generate_tags_batch,
+    flatten_influencer_tags, flatten_brand_tags, flatten_product_tags,
+    influencer_embedding_text, brand_embedding_text, version_fields, EMBEDDING_DIM,
+    TAG_BATCH_MAX_ITEMS
+)
+from product_search import build_search_fields, ensure_search_indexes, backfill_search_fields
+from match_cache import bump_index_version
+from brand_profile import update_brand_centroid, brand_centroid_revision
+from near_duplicate import (
+    dedup_text, signature_fields, copy_from_duplicate, match_in_batch, ensure_dedup_index,
+    backfill_signatures
+)
+from retag_stale import retag_stale, ensure_version_index
+from batch_tagging import release_expired_batches
+from token_usage import budget_ratio, BUDGET_SOFT_RATIO
 
 load_dotenv(override=True)
 
@@ -18,57 +33,112 @@ if not all([MONGODB_URI, DB_NAME]):
 client = MongoClient(MONGODB_URI)
 db = client[DB_NAME]
 
+# Documents fetched per cycle; untagged ones are packed into shared tagging requests
+BATCH_SIZE = TAG_BATCH_MAX_ITEMS
+
+def untagged_query():
+    """
+    Untagged OR missing embedding, except documents in flight in an offline
+    Batch API job (see batch_tagging.py).
+    """
+    return {
+        "$or": [{"structured_tags": {"$exists": False}}, {"embedding": {"$exists": False}}],
+        "batch_pending": {"$exists": False}
+    }
+
+def prepare_documents(collection, kind, docs):
+    """
+    Pre-pass over one polling batch:
+    1. Near-duplicates of already tagged documents are copied (no API call).
+    2. Near-duplicates within the batch are grouped; only the first document of
+       each group (the leader) is sent for tagging.
+    3. The leaders are tagged with packed multi-document requests.
+    Returns {_id: (dedup_fields, copied, batch_tags, leader_id)}; see resolve_prepared.
+    """
+    prepared = {}
+    leaders = []
+    for doc in docs:
+        dedup_fields = signature_fields(dedup_text(kind, doc))
+        copied, leader_id = None, None
+        if not doc.get("structured_tags"):
+            copied = copy_from_duplicate(collection, doc, dedup_fields, EMBEDDING_DIM)
+            if not copied:
+                match = match_in_batch(dedup_fields, [(d["_id"], f) for d, f in leaders])
+                if match:
+                    leader_id = match[0]
+                else:
+                    leaders.append((doc, dedup_fields))
+        prepared[doc["_id"]] = (dedup_fields, copied, None, leader_id)
+
+    if leaders:
+        for _id, tag_data in generate_tags_batch(kind, [doc for doc, _ in leaders]).items():
+            dedup_fields, copied, _, leader_id = prepared[_id]
+            prepared[_id] = (dedup_fields, copied, tag_data, leader_id)
+
+    return prepared
+
+def resolve_prepared(collection, doc, prepared):
+    """
+    (dedup_fields, copied, batch_tags) for `doc` from prepare_documents.
+    In-batch near-duplicates are copied here, after their leader (which comes
+    earlier in the same batch) has been written. If the leader failed, nothing is
+    copied and the document is picked up again next cycle.
+    """
+    dedup_fields, copied, batch_tags, leader_id = prepared[doc["_id"]]
+    if leader_id is not None:
+        copied = copy_from_duplicate(collection, doc, dedup_fields, EMBEDDING_DIM)
+    return dedup_fields, copied, batch_tags
+
 def process_influencers():
     collection = db["influencers"]
-    # Check for untagged OR missing embedding
-    query = {"$or": [{"structured_tags": {"$exists": False}}, {"embedding": {"$exists": False}}]}
-    cursor = collection.find(query).limit(5)  # Batch size 5
+    docs = list(collection.find(untagged_query()).limit(BATCH_SIZE))
+    prepared = prepare_documents(collection, "influencers", docs)
     
     count = 0
-    for doc in cursor:
+    for doc in docs:
         try:
             name = doc.get("channel_name", "Unknown")
-            desc = doc.get("channel_desc", "")
             print(f"[Influencer] Updating: {name}")
 
             # 1. Generate Tags if missing
             tag_data = doc.get("structured_tags")
             flat_tags = doc.get("tags", [])
             embedding = doc.get("embedding")
+
+            # 0. Near-duplicate copy / packed batch tags (see prepare_documents)
+            dedup_fields, copied, batch_tags = resolve_prepared(collection, doc, prepared)
+            if copied:
+                tag_data, flat_tags = copied["structured_tags"], copied["tags"]
+                embedding = embedding or copied["embedding"]
+                print(f"  ♻️ [Influencer] Near-duplicate of {copied['duplicate_of']} ({copied['duplicate_similarity']})")
             
+            tagged_now = False
             if not tag_data:
-                combined_text = f"Channel Name: {name}\nDescription: {desc}"
-                tag_data = generate_influencer_tags(combined_text)
+                tag_data = batch_tags
                 
                 if tag_data:
-                    niche = tag_data.get('niche', [])
-                    if isinstance(niche, str): niche = [niche]
-                    
-                    matching = tag_data.get('matching_tags', [])
-                    if isinstance(matching, str): matching = [matching]
-
-                    flat_tags = list(set(
-                        [tag_data.get('industry', '')] + 
-                        niche + 
-                        matching
-                    ))
-                    flat_tags = [t for t in flat_tags if t]
+                    flat_tags = flatten_influencer_tags(tag_data)
+                    tagged_now = True
 
             # 2. Generate Embedding if missing
-            if (tag_data and not embedding) or (tag_data and not doc.get("embedding")):
-                tags_list = tag_data.get('matching_tags', [])
-                if isinstance(tags_list, str): tags_list = [tags_list]
-                text_for_embed = f"{name} {desc} {' '.join(tags_list)}"
-                embedding = get_embedding(text_for_embed)
+            embedded_now = False
+            if tag_data and not embedding:
+                embedding = get_embedding(influencer_embedding_text(doc, tag_data), collection="influencers")
+                embedded_now = True
 
             if tag_data and embedding:
                 update_data = {
                     "structured_tags": tag_data,
                     "tags": flat_tags,
                     "embedding": embedding,
-                    "tagging_version": "v_poll_1.0",
+                    "embedding_dim": len(embedding),
                     "last_updated": time.time()
                 }
+                update_data.update(version_fields("influencers", doc, tagged_now, embedded_now, prior=copied))
+                update_data.update(dedup_fields)
+                if copied:
+                    update_data["duplicate_of"] = copied["duplicate_of"]
+                    update_data["duplicate_similarity"] = copied["duplicate_similarity"]
 
                 collection.update_one({"_id": doc["_id"]}, {"$set": update_data})
                 print(f"  ✅ [Influencer] Done: {name}")
@@ -78,16 +148,19 @@ def process_influencers():
         except Exception as e:
             print(f"  ❌ [Influencer] Error on {doc.get('_id')}: {e}")
 
+    if count > 0:
+        # Invalidate cached recommendations
+        bump_index_version(db)
+
     return count
 
 def process_brands():
     collection = db["brands"]
-    # Check for untagged OR missing embedding
-    query = {"$or": [{"structured_tags": {"$exists": False}}, {"embedding": {"$exists": False}}]}
-    cursor = collection.find(query).limit(5)  # Batch size 5
+    docs = list(collection.find(untagged_query()).limit(BATCH_SIZE))
+    prepared = prepare_documents(collection, "brands", docs)
     
     count = 0
-    for doc in cursor:
+    for doc in docs:
         try:
             name = doc.get("name", "Unknown")
             print(f"[Brand] Updating: {name}")
@@ -96,41 +169,41 @@ def process_brands():
             tag_data = doc.get("structured_tags")
             flat_tags = doc.get("tags", [])
             embedding = doc.get("embedding")
+
+            # 0. Near-duplicate copy / packed batch tags (see prepare_documents)
+            dedup_fields, copied, batch_tags = resolve_prepared(collection, doc, prepared)
+            if copied:
+                tag_data, flat_tags = copied["structured_tags"], copied["tags"]
+                embedding = embedding or copied["embedding"]
+                print(f"  ♻️ [Brand] Near-duplicate of {copied['duplicate_of']} ({copied['duplicate_similarity']})")
             
+            tagged_now = False
             if not tag_data:
-                tag_data = generate_brand_tags(doc)
+                tag_data = batch_tags
                 
                 if tag_data:
-                    b_vals = tag_data.get('brand_values', [])
-                    if isinstance(b_vals, str): b_vals = [b_vals]
-                    
-                    matching = tag_data.get('matching_tags', [])
-                    if isinstance(matching, str): matching = [matching]
-
-                    flat_tags = list(set(
-                        [tag_data.get('industry', '')] + 
-                        [tag_data.get('product_category', '')] +
-                        b_vals +
-                        matching
-                    ))
-                    flat_tags = [t for t in flat_tags if t]
+                    flat_tags = flatten_brand_tags(tag_data)
+                    tagged_now = True
             
             # 2. Generate Embedding if missing
-            if (tag_data and not embedding) or (tag_data and not doc.get("embedding")):
-                industry = tag_data.get('industry', '')
-                prod_cat = tag_data.get('product_category', '')
-                tags_str = " ".join(flat_tags)
-                text_for_embed = f"{name} {industry} {prod_cat} {tags_str}"
-                embedding = get_embedding(text_for_embed)
+            embedded_now = False
+            if tag_data and not embedding:
+                embedding = get_embedding(brand_embedding_text(doc, tag_data, flat_tags), collection="brands")
+                embedded_now = True
 
             if tag_data and embedding:
                 update_data = {
                     "structured_tags": tag_data,
                     "tags": flat_tags,
                     "embedding": embedding,
-                    "tagging_version": "v_poll_1.0",
+                    "embedding_dim": len(embedding),
                     "last_updated": time.time()
                 }
+                update_data.update(version_fields("brands", doc, tagged_now, embedded_now, prior=copied))
+                update_data.update(dedup_fields)
+                if copied:
+                    update_data["duplicate_of"] = copied["duplicate_of"]
+                    update_data["duplicate_similarity"] = copied["duplicate_similarity"]
                 
                 collection.update_one({"_id": doc["_id"]}, {"$set": update_data})
                 print(f"  ✅ [Brand] Done: {name}")
@@ -143,54 +216,54 @@ def process_brands():
 
 def process_products():
     collection = db["products"]
-    # Check for untagged OR missing embedding
-    query = {"$or": [{"structured_tags": {"$exists": False}}, {"embedding": {"$exists": False}}]}
-    cursor = collection.find(query).limit(5)  # Batch size 5
+    docs = list(collection.find(untagged_query()).limit(BATCH_SIZE))
+    prepared = prepare_documents(collection, "products", docs)
     
     count = 0
-    for doc in cursor:
+    for doc in docs:
         try:
             name = doc.get("title") or doc.get("name", "Unknown")
             print(f"[Product] Updating: {name}")
             
-            # 1. Generate Tags if missing
-            tag_data = doc.get("structured_tags")
-            flat_tags = doc.get("tags", [])
-            
-            if not tag_data:
-                tag_data = generate_product_tags(doc)
-                if tag_data:
-                    cat = tag_data.get('category', '')
-                    feats = tag_data.get('features', [])
-                    usage = tag_data.get('usage_scenario', [])
-                    matching = tag_data.get('matching_tags', [])
-                    
-                    if isinstance(feats, str): feats = [feats]
-                    if isinstance(usage, str): usage = [usage]
-                    if isinstance(matching, str): matching = [matching]
-
-                    flat_tags = list(set([cat] + feats + usage + matching))
-                    flat_tags = [t for t in flat_tags if t]
-
-            # 2. Generate Embedding (Always run if we are here)
-            # Use data from tag_data if available, else doc
-            cat_text = tag_data.get('category', '') if tag_data else doc.get('category', '')
-            desc = doc.get("description", "")
-            tags_str = " ".join(flat_tags)
-            
-            text_embed = f"{name} {cat_text} {desc} {tags_str}"
-            embedding = get_embedding(text_embed)
-            
-            if tag_data and embedding:
+            # 0. Near-duplicate copy / packed batch tags (see prepare_documents)
+            dedup_fields, copied, batch_tags = resolve_prepared(collection, doc, prepared)
+
+            if copied and copied["embedding"]:
+                print(f"  ♻️ [Product] Near-duplicate of {copied['duplicate_of']} ({copied['duplicate_similarity']})")
                 update_data = {
-                    "structured_tags": tag_data,
-                    "tags": flat_tags,
-                    "embedding": embedding,
-                    "tagging_version": "v_poll_1.0",
-                    "last_updated": time.time()
+                    "structured_tags": copied["structured_tags"],
+                    "tags": copied["tags"],
+                    "embedding": copied["embedding"],
+                    "embedding_dim": len(copied["embedding"])
                 }
+                versions = version_fields("products", doc, tagged=False, embedded=False, prior=copied)
+            else:
+                # Tags (if missing) + Embedding (always run if we are here)
+                seed = doc
+                if copied:
+                    seed = {**doc, "structured_tags": copied["structured_tags"], "tags": copied["tags"]}
+                elif batch_tags:
+                    seed = {**doc, "structured_tags": batch_tags, "tags": flatten_product_tags(batch_tags)}
+                elif not doc.get("structured_tags"):
+                    seed = None  # Tagging already failed in prepare_documents
+                update_data = tag_and_embed_product(seed) if seed else None
+                # The embedding is always new here; the tags only if they came from the batch
+                tagged_now = not copied and not doc.get("structured_tags")
+                versions = version_fields("products", doc, tagged_now, embedded=True, prior=copied)
+            
+            if update_data:
+                update_data["last_updated"] = time.time()
+                update_data.update(versions)
+                update_data.update(build_search_fields(doc))
+                update_data.update(dedup_fields)
+                if copied:
+                    update_data["duplicate_of"] = copied["duplicate_of"]
+                    update_data["duplicate_similarity"] = copied["duplicate_similarity"]
                 
+                revision = brand_centroid_revision(db, doc)
                 collection.update_one({"_id": doc["_id"]}, {"$set": update_data})
+                # Keep the brand's cached product centroid in sync
+                update_brand_centroid(db, doc, update_data["embedding"], update_data["tags"], revision)
                 print(f"  ✅ [Product] Done: {name}")
                 count += 1
                 time.sleep(1)
@@ -200,24 +273,54 @@ def process_products():
 
     return count
 
+def process_product_search_fields():
+    # Products inserted before the search index existed (or already tagged)
+    return backfill_search_fields(db["products"])
+
+def process_signatures():
+    # Tagged documents without MinHash signatures (tagged before dedup or by other writers)
+    return sum(backfill_signatures(db[name], name) for name in ("influencers", "brands", "products"))
+
+def process_expired_batches():
+    # Documents of Batch API jobs that were never imported go back to live tagging
+    return release_expired_batches(db)
+
+def run_cycle():
+    """
+    One polling cycle. Returns the number of new documents tagged.
+    """
+    c_inf = process_influencers()
+    c_brd = process_brands()
+    c_prd = process_products()
+    process_product_search_fields()
+    process_signatures()
+    process_expired_batches()
+
+    total = c_inf + c_brd + c_prd
+    if total > 0:
+        print(f"✅ Cycle Complete. Updated {total} docs (I:{c_inf}, B:{c_brd}, P:{c_prd}).")
+    elif budget_ratio() >= BUDGET_SOFT_RATIO:
+        # The re-tagger runs at low priority and would block in wait_for_budget,
+        # stalling new documents; skip it until the budget frees up.
+        print("💤 No new data found. Token budget near its limit, skipping re-tagging. Sleeping...")
+    elif retag_stale(db) == 0:
+        # Idle cycles re-tag documents with an outdated prompt/embedding recipe (low priority)
+        print("💤 No new data found. Sleeping...")
+    return total
+
 def run_polling_loop():
     print("🚀 Auto-Tagging Service Started (Interval: 3 sec)")
     print("   Targets: Influencers, Brands, Products")
+    ensure_search_indexes(db["products"])
+    for name in ("influencers", "brands", "products"):
+        ensure_dedup_index(db[name])
+        ensure_version_index(db[name])
     
     while True:
         print("\n⏰ Starting Polling Cycle...")
         
         try:
-            c_inf = process_influencers()
-            c_brd = process_brands()
-            c_prd = process_products()
-            
-            total = c_inf + c_brd + c_prd
-            if total > 0:
-                print(f"✅ Cycle Complete. Updated {total} docs (I:{c_inf}, B:{c_brd}, P:{c_prd}).")
-            else:
-                print("💤 No new data found. Sleeping...")
-                
+            run_cycle()
         except Exception as e:
             print(f"❌ Critical Error in Polling Loop: {e}")
         